@@ -1,11 +1,17 @@
 import os
 import h5py
 import numpy as np
+import torch
 from torch.utils.data import DataLoader
-from cnibp.datasets.BPNetDataset import BPNetDataset
+from torch.utils.data.sampler import Sampler
+from cnibp.datasets.BPNetDataset import BPNetDataset, H5BPNetDataset
 
 
-def dataset_loader(dataset_name, in_channel, batch_size, device, gender):
+def dataset_loader(dataset_name, in_channel, batch_size, device, gender, in_memory=False, num_workers=0):
+    '''
+    in_memory : False streams contiguous batch slices of the hdf5 files through pinned memory,
+                True keeps whole splits on the device and gathers every batch with one index tensor
+    '''
     train_shuffle: bool = True
     test_shuffle: bool = True
 
@@ -19,53 +25,127 @@ def dataset_loader(dataset_name, in_channel, batch_size, device, gender):
         print("datasets exist")
     else:
         print("preprocessing needed... run mimic3temp.py")
-    with h5py.File(train_file_path, 'r') as train_data:
-        train_ple, train_ple_cycle, train_abp, train_abp_cycle, \
-        train_dbp, train_sbp, train_info = np.array(train_data['ple']), \
-                                           np.array(train_data['ple_cycle']), \
-                                           np.array(train_data['abp']), \
-                                           np.array(train_data['abp_cycle']), \
-                                           np.array(train_data['dbp']), \
-                                           np.array(train_data['sbp']), \
-                                           np.array(train_data['info'])
-    with h5py.File(valid_file_path, 'r') as valid_data:
-        valid_ple, valid_ple_cycle, valid_abp, valid_abp_cycle, \
-        valid_dbp, valid_sbp, valid_info = np.array(valid_data['ple']), \
-                                           np.array(valid_data['ple_cycle']), \
-                                           np.array(valid_data['abp']), \
-                                           np.array(valid_data['abp_cycle']), \
-                                           np.array(valid_data['dbp']), \
-                                           np.array(valid_data['sbp']), \
-                                           np.array(valid_data['info'])
-        # valid_ple, valid_abp, valid_size, valid_info, valid_ohe = np.array(valid_data['ple'][:, in_channel, :]), \
-        #                                                           np.array(valid_data['abp']), np.array(
-        #     valid_data['size']), np.array(valid_data['info']), np.array(
-        #     valid_data['ohe'])
-    with h5py.File(test_file_path, 'r') as test_data:
-        test_ple, test_ple_cycle, test_abp, test_abp_cycle, \
-        test_dbp, test_sbp, test_info = np.array(test_data['ple']), \
-                                        np.array(test_data['ple_cycle']), \
-                                        np.array(test_data['abp']), \
-                                        np.array(test_data['abp_cycle']), \
-                                        np.array(test_data['dbp']), \
-                                        np.array(test_data['sbp']), \
-                                        np.array(test_data['info'])
-        # test_ple, test_abp, test_size, test_info, test_ohe = np.array(test_data['ple'][:, in_channel, :]), \
-        #                                                      np.array(test_data['abp']), np.array(
-        #     test_data['size']), np.array(test_data['info']), np.array(
-        #     test_data['ohe'])
-
-    train_dataset = BPNetDataset(train_ple, train_ple_cycle, train_abp, train_abp_cycle,
-                                 train_dbp, train_sbp, train_info, device)
-    valid_dataset = BPNetDataset(valid_ple, valid_ple_cycle, valid_abp, valid_abp_cycle,
-                                 valid_dbp, valid_sbp, valid_info, device)
-    test_dataset = BPNetDataset(test_ple, test_ple_cycle, test_abp, test_abp_cycle,
-                                test_dbp, test_sbp, test_info, device)
-
-    train_loader = DataLoader(train_dataset, batch_size=batch_size, shuffle=train_shuffle)
-    valid_loader = DataLoader(valid_dataset, batch_size=batch_size, shuffle=test_shuffle)
-    test_loader = DataLoader(test_dataset, batch_size=batch_size, shuffle=test_shuffle)
+
+    if in_memory:
+        train_loader = GatherLoader(BPNetDataset(*read_split(train_file_path), device), batch_size, train_shuffle)
+        valid_loader = GatherLoader(BPNetDataset(*read_split(valid_file_path), device), batch_size, test_shuffle)
+        test_loader = GatherLoader(BPNetDataset(*read_split(test_file_path), device), batch_size, test_shuffle)
+    else:
+        train_loader = stream_loader(train_file_path, batch_size, train_shuffle, device, num_workers)
+        valid_loader = stream_loader(valid_file_path, batch_size, test_shuffle, device, num_workers)
+        test_loader = stream_loader(test_file_path, batch_size, test_shuffle, device, num_workers)
 
     return [train_loader, valid_loader, test_loader]
 
+
+def read_split(file_path):
+    with h5py.File(file_path, 'r') as data:
+        return np.array(data['ple']), np.array(data['ple_cycle']), np.array(data['abp']), \
+               np.array(data['abp_cycle']), np.array(data['dbp']), np.array(data['sbp']), np.array(data['info'])
+
+
+def stream_loader(file_path, batch_size, shuffle, device, num_workers=0):
+    dataset = H5BPNetDataset(file_path)
+    # batch_size=None : the dataset returns whole batches for the slice lists of the sampler, no per-row collation
+    loader = DataLoader(dataset, batch_size=None, sampler=BlockBatchSampler(len(dataset), batch_size, shuffle),
+                        num_workers=num_workers, pin_memory=torch.device(device).type == 'cuda',
+                        persistent_workers=num_workers > 0)
+    return DeviceLoader(loader, device)
+
+
+class BlockBatchSampler(Sampler):
+    '''
+    yields every batch as a list of slices of consecutive rows
+    the rows are cut into blocks of block_size rows at a random offset every epoch, the blocks are shuffled
+    and every batch takes batch_size rows of them, so a batch is made of ~batch_size / block_size blocks
+    of different places of the file (consecutive rows of a split come from the same segment)
+    '''
+
+    def __init__(self, data_len, batch_size, shuffle=True, block_size=None):
+        self.data_len = data_len
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.block_size = block_size or max(batch_size // 8, 1)
+
+    def blocks(self):
+        if not self.shuffle:
+            return [0], [self.data_len]
+        offset = np.random.randint(self.block_size)
+        bounds = np.unique(np.concatenate(([0], np.arange(offset, self.data_len, self.block_size), [self.data_len])))
+        order = np.random.permutation(len(bounds) - 1)
+        return bounds[:-1][order].tolist(), bounds[1:][order].tolist()
+
+    def __iter__(self):
+        batch, batch_len = [], 0
+        for start, end in zip(*self.blocks()):
+            while start < end:
+                stop = min(end, start + self.batch_size - batch_len)
+                batch.append((start, stop))
+                batch_len += stop - start
+                start = stop
+                if batch_len == self.batch_size:
+                    yield merge_slices(batch)
+                    batch, batch_len = [], 0
+        if batch:
+            yield merge_slices(batch)
+
+    def __len__(self):
+        return (self.data_len + self.batch_size - 1) // self.batch_size
+
+
+def merge_slices(ranges):
+    # forward reads in the file, adjacent blocks are read as one slice
+    slices = []
+    for start, stop in sorted(ranges):
+        if slices and slices[-1].stop == start:
+            slices[-1] = slice(slices[-1].start, stop)
+        else:
+            slices.append(slice(start, stop))
+    return slices
+
+
+class DeviceLoader:
+    '''
+    moves the (pinned) batches of a DataLoader to the device without blocking the host
+    '''
+
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = device
+
+    @property
+    def dataset(self):
+        return self.loader.dataset
+
+    def __iter__(self):
+        for batch in self.loader:
+            yield [b.to(self.device, non_blocking=True) for b in batch]
+
+    def __len__(self):
+        return len(self.loader)
+
+
+class GatherLoader:
+    '''
+    in-memory fast path, BPNetDataset keeps the split on the device and
+    every batch is read with a single index tensor instead of collating single rows
+    '''
+
+    def __init__(self, dataset, batch_size, shuffle=True):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+
+    def __iter__(self):
+        device = self.dataset.y_data.device
+        if self.shuffle:
+            order = torch.randperm(len(self.dataset), device=device)
+        else:
+            order = torch.arange(len(self.dataset), device=device)
+        for index in order.split(self.batch_size):
+            yield self.dataset[index]
+
+    def __len__(self):
+        return (len(self.dataset) + self.batch_size - 1) // self.batch_size
+
 # dataset_loader(dataset_name='mimiciii', channel=3)
@@ -1,3 +1,5 @@
+import os
+import h5py
 import torch
 from torch.utils.data import Dataset
 import numpy as np
@@ -16,6 +18,7 @@ class BPNetDataset(Dataset):
         self.len = self.y_data.shape[0]
 
     def __getitem__(self, index):
+        # index is a single row or, for GatherLoader, a tensor of rows gathered at once
         x = self.x_data[index]
         x_cycle = self.ple_cycle[index]
         y = self.y_data[index]
@@ -24,8 +27,8 @@ class BPNetDataset(Dataset):
         size[index][0] = np.min(diastolic list) 
         size[index][1] = np.max(systolic list) 
         '''
-        d = self.dbp[index][-1]
-        s = self.sbp[index][-1]
+        d = self.dbp[index][..., -1, :]
+        s = self.sbp[index][..., -1, :]
         info = self.info[index]
 
 
@@ -33,3 +36,48 @@ class BPNetDataset(Dataset):
 
     def __len__(self):
         return self.len
+
+
+class H5BPNetDataset(Dataset):
+    """
+        BPNetDataset read on demand from a preprocessed split .hdf5 file.
+
+        Indexed with a slice or a list of slices (see BlockBatchSampler), every array of the batch is read as
+        a few contiguous HDF5 slices and returned as CPU tensors; the DataLoader pins them for the copy to the device.
+    """
+    keys = ('ple', 'ple_cycle', 'abp', 'abp_cycle', 'dbp', 'sbp', 'info')
+
+    def __init__(self, path):
+        self.path = path
+        with h5py.File(path, 'r') as file:
+            self.len = len(file['abp'])
+        self._pid = None
+        self._file = None
+
+    def get_file(self):
+        # h5py handles must not be shared across processes, reopen the file in every worker
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._file = h5py.File(self.path, 'r')
+        return self._file
+
+    def read(self, key, index):
+        file = self.get_file()
+        if isinstance(index, list):
+            # list of slices of one batch, see BlockBatchSampler
+            return np.concatenate([file[key][s] for s in index])
+        return file[key][index]
+
+    def __getitem__(self, index):
+        x, x_cycle, y, y_cycle, dbp, sbp, info = [torch.from_numpy(np.asarray(self.read(key, index), dtype=np.float32))
+                                                  for key in self.keys]
+        return x, x_cycle, y, y_cycle, dbp[..., -1, :], sbp[..., -1, :], info
+
+    def __len__(self):
+        return self.len
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_pid'] = None
+        state['_file'] = None
+        return state
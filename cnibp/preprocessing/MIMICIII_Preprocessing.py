@@ -11,7 +11,7 @@ from tqdm import tqdm
 from scipy import signal
 import matplotlib.pyplot as plt
 
-from cnibp.preprocessing.utils.signal_utils import signal_comparator
+from cnibp.preprocessing.utils.signal_utils import signal_comparator_batch
 from cnibp.preprocessing.utils.signal_utils import DualSignalHandler as dsh
 from cnibp.preprocessing.utils import mp_functions as mf, wfdb_functions as wf
 import cnibp.preprocessing.mimiciii_matched as match_prep
@@ -187,35 +187,41 @@ def read_total_data(process_id: int, segments: list,
         if length_flag:
 
             ple_chunks, abp_chunks = dsh(raw_ple_segment, raw_abp_segment).shuffle_lists()
-
-            for p_chunk, a_chunk in zip(ple_chunks, abp_chunks):
-                p_flat_range = np.where(p_chunk == np.max(p_chunk))[0]
-                a_flat_range = np.where(a_chunk == np.max(a_chunk))[0]
-                if len(p_flat_range) > chunk_size * 0.3 or len(a_flat_range) > chunk_size * 0.3:
-                    continue
-                '''-----------------------------------------'''
-                confirm_flag, ple_info, abp_info = signal_comparator(p_chunk, a_chunk, ple_scale,
-                                                                     preprocessing_mode, threshold, sampling_rate)
-                if confirm_flag is hdf_flag:  # 학습에 사용할 데이터셋 # ple_info.valid_flag and abp_info.valid_flag and corr > 0.9
+            ple_chunks, abp_chunks = np.asarray(ple_chunks), np.asarray(abp_chunks)
+
+            p_flat_range = np.sum(ple_chunks == np.max(ple_chunks, axis=1, keepdims=True), axis=1)
+            a_flat_range = np.sum(abp_chunks == np.max(abp_chunks, axis=1, keepdims=True), axis=1)
+            not_flat = (p_flat_range <= chunk_size * 0.3) & (a_flat_range <= chunk_size * 0.3)
+            if not np.any(not_flat):
+                continue
+            '''-----------------------------------------'''
+            # all chunks of the segment are checked at once, then taken in the shuffled order as before
+            confirm_flags, ple_info, abp_info = signal_comparator_batch(ple_chunks[not_flat], abp_chunks[not_flat],
+                                                                        ple_scale, preprocessing_mode, threshold,
+                                                                        sampling_rate)
+            for i in range(len(confirm_flags)):
+                p_status = list(ple_info.status[i])
+                a_status = list(abp_info.status[i]) + list(abp_info.detail_status[i])
+                if bool(confirm_flags[i]) is hdf_flag:  # 학습에 사용할 데이터셋 # ple_info.valid_flag and abp_info.valid_flag and corr > 0.9
                     chunk_per_segment += 1
                     if chunk_per_segment == 30:
                         break
-                    ple_total.append(ple_info.input_sig)
-                    ple_cycle_len.append(len(ple_info.cycle))
-                    ple_cycle.append(signal.resample(ple_info.cycle, 100))
+                    ple_total.append(ple_info.input_sig[i])
+                    ple_cycle_len.append(len(ple_info.cycle[i]))
+                    ple_cycle.append(signal.resample(ple_info.cycle[i], 100))
 
-                    abp_total.append(abp_info.input_sig)
-                    abp_cycle_len.append(len(abp_info.cycle))
-                    abp_cycle.append(signal.resample(abp_info.cycle, 100))
-                    dbp_total.append(dsh(abp_info.dbp_idx, abp_info.dbp_value).stack_sigs('vertical', resize_n=15))
-                    sbp_total.append(dsh(abp_info.sbp_idx, abp_info.sbp_value).stack_sigs('vertical', resize_n=15))
+                    abp_total.append(abp_info.input_sig[i])
+                    abp_cycle_len.append(len(abp_info.cycle[i]))
+                    abp_cycle.append(signal.resample(abp_info.cycle[i], 100))
+                    dbp_total.append(dsh(abp_info.dbp_idx[i], abp_info.dbp_value[i]).stack_sigs('vertical', resize_n=15))
+                    sbp_total.append(dsh(abp_info.sbp_idx[i], abp_info.sbp_value[i]).stack_sigs('vertical', resize_n=15))
 
                     info_total.append(patient_info_df[patient_id][:-1])
-                    p_status_total.append(ple_info.status)
-                    a_status_total.append(abp_info.status + abp_info.detail_status)
+                    p_status_total.append(p_status)
+                    a_status_total.append(a_status)
                 else:  # 분석에 사용할 데이터셋
-                    p_status_total.append(ple_info.status)
-                    a_status_total.append(abp_info.status + abp_info.detail_status)
+                    p_status_total.append(p_status)
+                    a_status_total.append(a_status)
         else:
             continue
 
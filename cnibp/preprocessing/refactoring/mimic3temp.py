@@ -3,7 +3,6 @@ import wfdb
 import random
 
 from tqdm import tqdm
-import multiprocessing as mp
 # from multiprocessing import Process, shared_memory, Semaphore
 import numpy as np
 # import cnibp.preprocessing.utils.multi_processing as multi
@@ -13,10 +12,13 @@ import h5py
 import datetime as dt
 # import cnibp.preprocessing.utils.sutemp as sutemp
 import cnibp.preprocessing.utils.math_functions as mm
+import cnibp.preprocessing.utils.mp_functions as mf
+import cnibp.preprocessing.utils.wfdb_functions as wf
+import cnibp.preprocessing.utils.signal_utils as su
 
 import heartpy.peakdetection as hp_peak
 from heartpy.datautils import rolling_mean
-from heartpy.filtering import filter_signal
+from scipy.signal import butter, filtfilt
 import cnibp.unused.preprocessing.signal_cleaner as sc
 # from scipy.ndimage import gaussian_filter1d
 import cnibp.preprocessing.mimiciii_matched as match
@@ -412,6 +414,85 @@ def bottom_detector(target_signal, rol_sec, fs=125):
     return peak_heartpy['peaklist']
 
 
+def nan_interpolator_batch(target_signals):
+    """
+    linear interpolation of the nan samples of every row (N, L), in place
+    nan at the edges of a row take the nearest valid value
+    """
+    nan_rows = np.isnan(target_signals).any(axis=1)
+    if not nan_rows.any():
+        return target_signals
+    signals = target_signals[nan_rows]
+    nan_mask = np.isnan(signals)
+    length = signals.shape[1]
+    idx = np.arange(length)
+    prev_idx = np.maximum.accumulate(np.where(nan_mask, -1, idx), axis=1)
+    next_idx = np.minimum.accumulate(np.where(nan_mask, length, idx)[:, ::-1], axis=1)[:, ::-1]
+    prev_idx, next_idx = np.where(prev_idx < 0, next_idx, prev_idx), np.where(next_idx >= length, prev_idx, next_idx)
+    prev_idx, next_idx = np.clip(prev_idx, 0, length - 1), np.clip(next_idx, 0, length - 1)
+    rows = np.arange(len(signals))[:, None]
+    prev_val, next_val = signals[rows, prev_idx], signals[rows, next_idx]
+    weight = (idx - prev_idx) / np.maximum(next_idx - prev_idx, 1)
+    signals[nan_mask] = (prev_val + (next_val - prev_val) * weight)[nan_mask]
+    target_signals[nan_rows] = signals
+    return target_signals
+
+
+def flat_signal_checker_batch(target_signals, t=2, threshold=0.1, fs=125):
+    # flat_signal_checker of every row (N, L): True if any t seconds slice has std < threshold
+    slice_num = target_signals.shape[1] // (t * fs)
+    sliced = target_signals[:, :slice_num * t * fs].reshape(len(target_signals), slice_num, t * fs)
+    return (np.std(sliced, axis=-1) < threshold).any(axis=1)
+
+
+def peak_bottom_detector_batch(target_signals, rol_sec, fs=125, ma_perc=20):
+    """
+    peak_detector and bottom_detector of every row (N, L)
+    the threshold of the bottoms of -x is minus the threshold of the peaks of x, so the rolling mean is computed once
+    return: peaks, bottoms: lists of N arrays of positions
+    """
+    roll_mean = su.rolling_mean_batch(target_signals, rol_sec, fs)
+    return su.detect_peaks_batch(target_signals, roll_mean, ma_perc, fs), \
+        su.detect_peaks_batch(target_signals, roll_mean, ma_perc, fs, invert=True)
+
+
+def signal_QC_batch(sliced_abp, sliced_ple, eliminated_total, fs=125, hf=8, rolling_sec=1.5):
+    """
+    QC of all windows of a segment at once
+    param: sliced_abp, sliced_ple: (N, L) windows of signal_slicer
+    return: normal_abp, normal_ple: windows without too many nan (interpolated) and not flat
+            denoised_abp, denoised_ple: low-pass filtered windows
+            peak_abp, peak_ple, bottom_abp, bottom_ple: lists of peak / bottom positions of every window
+    """
+    length = sliced_abp.shape[1]
+    num_nan_abp = np.isnan(sliced_abp).sum(axis=1)
+    num_nan_ple = np.isnan(sliced_ple).sum(axis=1)
+    nan_flag = (num_nan_abp > 0) | (num_nan_ple > 0)
+    interpolated = nan_flag & (num_nan_abp < 0.1 * length) & (num_nan_ple < 0.1 * length)
+    # eliminated_total[5] : total number of signals after nan interpolation
+    eliminated_total[5] += np.sum(interpolated)
+    # eliminated_total[0] : total number of signals with nan
+    eliminated_total[0] += np.sum(nan_flag & ~interpolated)
+    valid = ~nan_flag | interpolated
+    normal_abp = nan_interpolator_batch(sliced_abp[valid])
+    normal_ple = nan_interpolator_batch(sliced_ple[valid])
+
+    flat = flat_signal_checker_batch(normal_abp, fs=fs) | flat_signal_checker_batch(normal_ple, fs=fs)
+    # eliminated_total[1] : total number of signals with flat signal
+    eliminated_total[1] += np.sum(flat)
+    normal_abp, normal_ple = normal_abp[~flat], normal_ple[~flat]
+    if len(normal_abp) == 0:
+        return normal_abp, normal_ple, normal_abp, normal_ple, [], [], [], []
+
+    # denoise signal, heartpy filter_signal(cutoff=hf, order=2, filtertype='lowpass') of every window
+    b, a = butter(2, hf / (0.5 * fs), btype='low')
+    denoised_abp = filtfilt(b, a, normal_abp, axis=1)
+    denoised_ple = filtfilt(b, a, normal_ple, axis=1)
+    peak_abp, bottom_abp = peak_bottom_detector_batch(denoised_abp, rolling_sec, fs)
+    peak_ple, bottom_ple = peak_bottom_detector_batch(denoised_ple, rolling_sec, fs)
+    return normal_abp, normal_ple, denoised_abp, denoised_ple, peak_abp, peak_ple, bottom_abp, bottom_ple
+
+
 def read_total_data(id: int, segment_list: list, total_patient_info, patient_info_total: list,
                     ple_total: list, abp_total: list, size_total: list, ohe_total: list, chunk_size: int,
                     sampling_rate: int, eliminated_total: list, threshold: float, ple_scale: bool):
@@ -426,33 +507,27 @@ def read_total_data(id: int, segment_list: list, total_patient_info, patient_inf
 
 
     param:
-        path: path of a patient (e.g. /hdd/hdd0/dataset/bpnet/adults/physionet.org/files/mimic3wdb/1.0/30/3001937_11)
-        sampfrom: start index of the segment
-        sampto: end index of the segment
+        segment_list: rows of wfdb_functions.scan_segments manifest (segment, ple_idx, abp_idx, length, fs)
     return:
         record: wfdb record object containing PLETH and ABP signals
         patient_records: list of wfdb record
     """
 
-    for segment in tqdm(segment_list, desc='process-' + str(id), leave=False):
+    for segment, ple_idx, abp_idx, sig_len, sig_fs in tqdm(segment_list, desc='process-' + str(id), leave=False):
         chunk_per_segment = 0
-        segment = segment.strip('.hea')
+        segment = str(segment)
         # patient_id = segment.split('/')[-2].split('_')[0]
         patient_id = segment.split('/')[-2].split('_')[0][-5:]
-        ple_idx, abp_idx = find_channel_idx(segment)
-        ple, abp = np.squeeze(np.split(wfdb.rdrecord(segment, channels=[ple_idx, abp_idx]).p_signal, 2, axis=1))
+        # physical and digital values of PLETH, ABP from a single read of the .dat file
+        p_signal, d_signal, adc_gain, baseline = wf.read_segment(segment, [ple_idx, abp_idx])
+        ple, abp = p_signal[:, 0], p_signal[:, 1]
         if len(ple) < 1000 or len(abp) < 1000:
             continue
         else:
             nan_mask = ~(np.isnan(ple) | np.isnan(abp))
-            ple_record = wfdb.rdrecord(segment, channels=[ple_idx])
-            # ple_sig_len = ple_record.sig_len
-            # ple_analogue_sig = np.squeeze(ple_record.p_signal)
-            ple_gain = ple_record.adc_gain[0]
-            # ple_init_value = ple_record.init_value[0]
-            ple_baseline = ple_record.baseline[0]
-            # ple_adc_zero = ple_record.adc_zero[0]
-            ple_digital_sig = np.squeeze(ple_record.adc())
+            ple_gain = adc_gain[0]
+            ple_baseline = baseline[0]
+            ple_digital_sig = d_signal[:, 0]
             ''' ************************************************** revert gain controller '''
             ple = (((ple_digital_sig - ple_baseline) / ple_gain) * (1023. / ple_gain))[nan_mask]
             ''' ************************************************************************* '''
@@ -478,52 +553,17 @@ def read_total_data(id: int, segment_list: list, total_patient_info, patient_inf
         sliced_ple = signal_slicer(ple, fs=fs, t=t, overlap=overlap)
 
         # eliminated_total[6] : total number of sliced signals
-        if len(sliced_abp) > 0:
-            eliminated_total[6] += len(sliced_abp)
-
-        # check if sliced signal is valid
-        # if not, remove the signal
-        normal_abp = []
-        normal_ple = []
-        for target_abp, target_ple in zip(sliced_abp, sliced_ple):
-            nan_flag_abp, num_nan_abp = nan_checker(target_abp)
-            nan_flag_ple, num_nan_ple = nan_checker(target_ple)
-            if nan_flag_abp or nan_flag_ple:
-                if num_nan_abp < 0.1 * len(target_abp) and num_nan_ple < 0.1 * len(target_ple):
-                    target_abp = nan_interpolator(target_abp)
-                    target_ple = nan_interpolator(target_ple)
-                    # eliminated_total[5] : total number of signals after nan interpolation
-                    eliminated_total[5] += 1
-                else:
-                    # eliminated_total[0] : total number of signals with nan
-                    eliminated_total[0] += 1
-                    continue
-            if flat_signal_checker(target_abp) or flat_signal_checker(target_ple):
-                # eliminated_total[1] : total number of signals with flat signal
-                eliminated_total[1] += 1
-                continue
-            else:
-                normal_abp.append(target_abp)
-                normal_ple.append(target_ple)
+        if len(sliced_abp) == 0:
+            continue
+        eliminated_total[6] += len(sliced_abp)
 
-        # delete no more needed variables
-        # del sliced_abp, sliced_ple
+        # nan interpolation, flat signal check, denoising and peak candidates of all windows at once
+        rolling_sec = 1.5
+        normal_abp, normal_ple, denoised_abp, denoised_ple, peak_abp, peak_ple, bottom_abp, bottom_ple = \
+            signal_QC_batch(sliced_abp, sliced_ple, eliminated_total, fs=fs, hf=8, rolling_sec=rolling_sec)
 
         if len(normal_abp) == 0 or len(normal_ple) == 0:
             continue
-        # denoise signal
-        # lf = 0.5
-        hf = 8
-        denoised_abp = [filter_signal(target_abp, cutoff=hf, sample_rate=fs, order=2, filtertype='lowpass') for
-                        target_abp in normal_abp]
-        denoised_ple = [filter_signal(target_ple, cutoff=hf, sample_rate=fs, order=2, filtertype='lowpass') for
-                        target_ple in normal_ple]
-        # find peak index
-        rolling_sec = 1.5
-        peak_abp = [peak_detector(target_abp, rolling_sec, fs) for target_abp in denoised_abp]
-        peak_ple = [peak_detector(target_ple, rolling_sec, fs) for target_ple in denoised_ple]
-        bottom_abp = [bottom_detector(target_abp, rolling_sec, fs) for target_abp in denoised_abp]
-        bottom_ple = [bottom_detector(target_ple, rolling_sec, fs) for target_ple in denoised_ple]
 
         # arrange peak index
         arranged_peak_abp = []
@@ -719,69 +759,60 @@ def multi_processing(model_name, dset_path: str, dataset: str, total_segments, g
     100 : 470
 
     '''
-    sorted_by_fsize = sorted(total_segments, key=lambda s: os.stat(s.replace('.hea', '.dat')).st_size)
-
-    # light0 = sorted_by_fsize[:int(len(sorted_by_fsize) * 0.25)]  # not used having no valid data
-    light1 = sorted_by_fsize[int(len(sorted_by_fsize) * 0.25):int(len(sorted_by_fsize) * 0.4)]
-    light2 = sorted_by_fsize[int(len(sorted_by_fsize) * 0.4):int(len(sorted_by_fsize) * 0.55)]
-    light3 = sorted_by_fsize[int(len(sorted_by_fsize) * 0.55):int(len(sorted_by_fsize) * 0.7)]  # htop best
-    heavy1 = sorted_by_fsize[int(len(sorted_by_fsize) * 0.70):int(len(sorted_by_fsize) * 0.85)]
-    heavy2 = sorted_by_fsize[int(len(sorted_by_fsize) * 0.80):int(len(sorted_by_fsize) * 0.95)]
-    # heavy3 = sorted_by_fsize[int(len(sorted_by_fsize) * 0.95):] # eliminated due to long time consumption
+    # header pre-scan: segments without PLETH and ABP or shorter than 1000 samples are dropped before any signal I/O
+    manifest = wf.scan_segments(total_segments, min_length=1000)
+    print(f'number of segments with PLETH and ABP: {len(manifest)}')
+    # the size groups are cut over all segments as before, then only the segments of the manifest are kept
+    total_sorted = sorted(total_segments, key=lambda s: os.stat(s.replace('.hea', '.dat')).st_size)
+    total_num = len(total_sorted)
+    size_rank = {s.replace('.hea', ''): i for i, s in enumerate(total_sorted)}
+    manifest_rank = np.array([size_rank[s] for s in manifest['segment']], dtype=int)
+    sorted_by_fsize = manifest[np.argsort(manifest_rank, kind='stable')]
+    manifest_rank = np.sort(manifest_rank)
+
+    def size_group(low, high):
+        return sorted_by_fsize[(manifest_rank >= int(total_num * low)) & (manifest_rank < int(total_num * high))]
+
+    # light0 = size_group(0, 0.25)  # not used having no valid data
+    light1 = size_group(0.25, 0.4)
+    light2 = size_group(0.4, 0.55)
+    light3 = size_group(0.55, 0.7)  # htop best
+    heavy1 = size_group(0.70, 0.85)
+    heavy2 = size_group(0.80, 0.95)
+    # heavy3 = size_group(0.95, 1) # eliminated due to long time consumption
     # split_by_size = [heavy1]  # for real data inspection
     # split_by_size = [light2] # for debugging
     # split_by_size = [light2, light3] # for fast test
     split_by_size = [light1, light2, light3, heavy1, heavy2]  # for total data
     print('reading_total_data...')
-    info_tot = np.zeros((1, 5))
-    ple_tot = np.zeros((1, 3, 360))
-    abp_tot = np.zeros((1, 360))
-    size_tot = np.zeros((1, 2))
-    ohe_tot = np.zeros((1, 7))
-    eliminated_tot = np.zeros(7)
+    # every worker fills its own buffers and shard, the datasets are virtual concatenations of the shards
+    shard_dir = dset_path + str(dataset) + '_' + g_str + '_' + str(threshold) + '_shards/'
+    if not os.path.isdir(shard_dir):
+        os.mkdir(shard_dir)
+    shard_paths = []
     '''get patient info'''
 
-    for s in split_by_size:
+    for group_i, s in enumerate(split_by_size):
         segments_per_process = np.array_split(s, process_num)
         print(f'number of segments per process: {len(segments_per_process[0])}')
-        with mp.Manager() as manager:
-            start_time = time.time()
-
-            info_total = manager.list()
-            ple_total = manager.list()
-            abp_total = manager.list()
-            size_total = manager.list()
-            ohe_total = manager.list()
-            eliminated_total = manager.list()
-            eliminated_total.extend([0, 0, 0, 0, 0, 0, 0])
-            workers = [mp.Process(target=read_total_data,
-                                  args=(i, segments_per_process[i], total_patient_info,
-                                        info_total, ple_total, abp_total, size_total, ohe_total,
-                                        sig_len, samp_rate, eliminated_total, threshold, ple_scale)) for i in
-                       range(process_num)]
-            for worker in workers:
-                worker.start()
-            for worker in workers:
-                worker.join()
-
-            print('--- %s seconds ---' % (time.time() - start_time))
-            # ple_total = np.array(ple_total)
-            # abp_total = np.array(abp_total)
-            # size_total = np.array(size_total)
-            try:
-                info_tot = np.concatenate((info_tot, np.array(info_total, dtype=float)), axis=0)
-                ple_tot = np.concatenate((ple_tot, np.array(ple_total)), axis=0)
-                abp_tot = np.concatenate((abp_tot, np.array(abp_total)), axis=0)
-                size_tot = np.concatenate((size_tot, np.array(size_total)), axis=0)
-                ohe_tot = np.concatenate((ohe_tot, np.array(ohe_total)), axis=0)
-                eliminated_tot = np.array(eliminated_total)
-                manager.shutdown()
-
-            except:
-                print('no data added')
-                manager.shutdown()
-                continue
-
+        start_time = time.time()
+
+        group_shards = [shard_dir + str(group_i) + '_' + str(i) + '.hdf5' for i in range(process_num)]
+        group_shards = mf.run_sharded(read_total_data, group_shards,
+                                      [(i, segments_per_process[i], total_patient_info,
+                                        mf.ShardField('info', (5,)), mf.ShardField('ple', (3, 360)),
+                                        mf.ShardField('abp', (360,)), mf.ShardField('size', (2,)),
+                                        mf.ShardField('ohe', (7,)), sig_len, samp_rate,
+                                        mf.ShardField('eliminated', (7,), counter=True), threshold, ple_scale)
+                                       for i in range(process_num)])
+        shard_paths.extend(group_shards)
+
+        print('--- %s seconds ---' % (time.time() - start_time))
+        if sum(mf.shard_lengths(group_shards, 'ple')) == 0:
+            print('no data added')
+
+    eliminated_tot = mf.shard_sum(shard_paths, 'eliminated')
+    ple_len = sum(mf.shard_lengths(shard_paths, 'ple'))
     eliminated_percent = np.zeros(7)
     for i in range(7):
         eliminated_percent[i] = eliminated_tot[i] / eliminated_tot[6] * 100
@@ -797,10 +828,7 @@ def multi_processing(model_name, dset_path: str, dataset: str, total_segments, g
     print('Total Eliminated signals: {} ({})%'.format(sum(eliminated_tot[:5]),
                                                       sum(eliminated_tot[:5]) / eliminated_tot[6] * 100))
     print('----------------------------------------------')
-    print('Survived total length: {} ({}%)'.format(len(ple_tot), len(ple_tot) / eliminated_tot[6] * 100))
-    print(np.shape(ple_tot))
-    print(np.shape(abp_tot))
-    print(np.shape(size_tot))
+    print('Survived total length: {} ({}%)'.format(ple_len, ple_len / eliminated_tot[6] * 100))
 
     eliminated_tot = np.hstack((eliminated_tot, eliminated_percent))
     dset = h5py.File(dset_path + str(dataset) + '_' + g_str + '_' + str(threshold) + '.hdf5', 'w')
@@ -825,11 +853,11 @@ def multi_processing(model_name, dset_path: str, dataset: str, total_segments, g
     # dset['info'][0].astype(str)
 
     # dset['info'] = np.array(info_tot[1:], dtype='str')
-    dset['info'] = info_tot[1:]
-    dset['ple'] = ple_tot[1:]
-    dset['abp'] = abp_tot[1:]
-    dset['size'] = size_tot[1:]
-    dset['ohe'] = ohe_tot[1:]
+    for name in ['info', 'ple', 'abp', 'size', 'ohe']:
+        mf.virtual_concat(dset, name, shard_paths)
+    print(dset['ple'].shape)
+    print(dset['abp'].shape)
+    print(dset['size'].shape)
     dset['eliminated'] = eliminated_tot
     dset.close()
 
@@ -43,6 +43,153 @@ def get_process_num(target_num: int):
     return os.cpu_count() if np.max(available_divisor) < os.cpu_count() // 2 else np.max(available_divisor)
 
 
+class ShardField:
+    """
+    placeholder of a worker argument, replaced in the worker by a RecordBuffer of its own HDF5 shard
+    :param name: dataset name in the shard
+    :param shape: shape of one record
+    :param counter: if True, the worker gets a local np.zeros(shape) counter array instead, saved when it ends
+    """
+
+    def __init__(self, name: str, shape=(), counter: bool = False):
+        self.name = name
+        self.shape = tuple(shape)
+        self.counter = counter
+
+
+class RecordBuffer:
+    """
+    list-like append target of a worker: records are copied into a preallocated array
+    and flushed to a resizable dataset of the worker's shard every batch_size records
+    """
+
+    def __init__(self, shard, name: str, shape: tuple, batch_size: int = 256, dtype=float):
+        self.dataset = shard.create_dataset(name, shape=(0,) + shape, maxshape=(None,) + shape,
+                                            chunks=(batch_size,) + shape, dtype=dtype)
+        self.buffer = np.empty((batch_size,) + shape, dtype=dtype)
+        self.size = 0
+        self.count = 0
+
+    def append(self, record):
+        self.buffer[self.size] = record
+        self.size += 1
+        self.count += 1
+        if self.size == len(self.buffer):
+            self.flush()
+
+    def flush(self):
+        if self.size > 0:
+            offset = len(self.dataset)
+            self.dataset.resize(offset + self.size, axis=0)
+            self.dataset[offset:] = self.buffer[:self.size]
+            self.size = 0
+
+    def __len__(self):
+        return self.count
+
+
+def shard_worker(target_function, shard_path: str, args: tuple):
+    """
+    runs target_function(*args) with every ShardField of args replaced by a worker-local buffer
+    the buffered records and the counters are saved even if target_function raises
+    :param target_function: worker function appending its records to list arguments
+    :param shard_path: HDF5 file written only by this worker
+    :param args: arguments of target_function
+    """
+    with h5py.File(shard_path, 'w') as shard:
+        local_args = []
+        for arg in args:
+            if isinstance(arg, ShardField):
+                local_args.append(np.zeros(arg.shape) if arg.counter else RecordBuffer(shard, arg.name, arg.shape))
+            else:
+                local_args.append(arg)
+        try:
+            target_function(*local_args)
+        finally:
+            for field, arg in zip(args, local_args):
+                if isinstance(field, ShardField):
+                    if field.counter:
+                        shard[field.name] = arg
+                    else:
+                        arg.flush()
+
+
+def shard_complete(shard_path: str, names: list):
+    # a worker killed before its shard was closed leaves no file, or one without some of the datasets
+    try:
+        with h5py.File(shard_path, 'r') as shard:
+            return all(name in shard for name in names)
+    except OSError:
+        return False
+
+
+def run_sharded(target_function, shard_paths: list, args_list: list):
+    """
+    starts one process per shard and waits for all of them
+    :param shard_paths: shard file of each process
+    :param args_list: target_function arguments of each process, with ShardField placeholders
+    :return: shard paths that can be read, the shards of killed workers are reported and skipped
+             (a worker that raised keeps its records saved before the exception)
+    """
+    workers = [mp.Process(target=shard_worker, args=(target_function, shard_path, args))
+               for shard_path, args in zip(shard_paths, args_list)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    valid_shards = []
+    for worker, shard_path, args in zip(workers, shard_paths, args_list):
+        names = [arg.name for arg in args if isinstance(arg, ShardField)]
+        complete = shard_complete(shard_path, names)
+        if worker.exitcode != 0:
+            print('worker of {} exited with code {}, {}'.format(
+                shard_path, worker.exitcode, 'keeping its saved records' if complete else 'skipping its shard'))
+        if complete:
+            valid_shards.append(shard_path)
+    return valid_shards
+
+
+def shard_lengths(shard_paths: list, name: str):
+    lengths = []
+    for shard_path in shard_paths:
+        with h5py.File(shard_path, 'r') as shard:
+            lengths.append(len(shard[name]))
+    return lengths
+
+
+def shard_sum(shard_paths: list, name: str):
+    total = 0
+    for shard_path in shard_paths:
+        with h5py.File(shard_path, 'r') as shard:
+            total = total + shard[name][:]
+    return total
+
+
+def virtual_concat(dset, name: str, shard_paths: list, dataset_name: str = None):
+    """
+    concatenates dataset_name of every shard along axis 0 as the virtual dataset dset[name], without copying
+    the shards have to stay next to dset, their path is stored relative to it
+    """
+    dataset_name = dataset_name or name
+    sources = []
+    for shard_path in shard_paths:
+        with h5py.File(shard_path, 'r') as shard:
+            shape, dtype = shard[dataset_name].shape, shard[dataset_name].dtype
+        if shape[0] > 0:
+            sources.append((shard_path, shape))
+    total = sum(shape[0] for _, shape in sources)
+    if total == 0:
+        return dset.create_dataset(name, shape=shape, dtype=dtype)
+    layout = h5py.VirtualLayout(shape=(total,) + shape[1:], dtype=dtype)
+    offset = 0
+    for shard_path, shape in sources:
+        source_path = os.path.relpath(shard_path, os.path.dirname(os.path.abspath(dset.filename)))
+        layout[offset:offset + shape[0]] = h5py.VirtualSource(source_path, dataset_name, shape=shape)
+        offset += shape[0]
+    return dset.create_virtual_dataset(name, layout)
+
+
 def multi_processing_sort_by_file_size(model_name, target_function, mode: str,
                                        parameters, dset_path: str, splitted_segments_by_f_size, patient_info_df):
     print(f'[{model_name} {mode} dataset]')
@@ -69,122 +216,68 @@ def multi_processing_sort_by_file_size(model_name, target_function, mode: str,
     print('Sorting data by file size...')
 
     print('reading_total_data...')
-    ple_tot = np.zeros((1, 750))
-    ple_cyc_len = np.zeros(1)
-    ple_cyc = np.zeros((1, 100))
-    abp_tot = np.zeros((1, 750))
-    abp_cyc_len = np.zeros(1)
-    abp_cyc = np.zeros((1, 100))
-    dbp_tot = np.zeros((1, 2, 15))
-    sbp_tot = np.zeros((1, 2, 15))
-    info_tot = np.zeros((1, 6))
     if parameters['mode'] == 'total':
-        p_status_tot = np.zeros((1, 4))
-        a_status_tot = np.zeros((1, 8))
+        p_status_shape, a_status_shape = (4,), (8,)
     elif parameters['mode'] == 'none':
-        p_status_tot = np.zeros((1, 3))
-        a_status_tot = np.zeros((1, 5))
+        p_status_shape, a_status_shape = (3,), (5,)
     elif parameters['mode'] in ['underdamp', 'overdamp', 'flip']:
-        p_status_tot = np.zeros((1, 3))
-        a_status_tot = np.zeros((1, 6))
+        p_status_shape, a_status_shape = (3,), (6,)
     else:  # for flat
-        p_status_tot = np.zeros((1, 4))
-        a_status_tot = np.zeros((1, 6))
+        p_status_shape, a_status_shape = (4,), (6,)
+
+    # every worker fills its own buffers and shard, the datasets are virtual concatenations of the shards
+    dset_name = dset_path + str(mode) + '_' + parameters['gender'] + '_' + str(parameters['corr_threshold'])
+    shard_dir = dset_name + '_shards/'
+    if not os.path.isdir(shard_dir):
+        os.makedirs(shard_dir)
+    shard_paths = []
 
     '''get patient info'''
 
-    for s in splitted_segments_by_f_size:
+    for group_i, s in enumerate(splitted_segments_by_f_size):
         segments_per_process = np.array_split(s, process_num)
         # print(f'number of segments per process: {len(segments_per_process[0])}')
-        with mp.Manager() as manager:
-            start_time = time.time()
-
-            info_total = manager.list()
-            ple_total = manager.list()
-            ple_cycle_len = manager.list()
-            ple_cycle = manager.list()
-            abp_total = manager.list()
-            abp_cycle_len = manager.list()
-            abp_cycle = manager.list()
-            dbp_total = manager.list()
-            sbp_total = manager.list()
-            p_status_total = manager.list()
-            a_status_total = manager.list()
-
-            workers = [mp.Process(target=target_function,
-                                  args=(process_i, segments_per_process[process_i],
-                                        su.select_mode(parameters['mode']), parameters['chunk_size'],
-                                        parameters['sampling_rate'],
-                                        parameters['corr_threshold'], parameters['ple_scale'], parameters['hdf_flag'],
-                                        patient_info_df, ple_cycle, ple_cycle_len, abp_cycle, abp_cycle_len,
-                                        info_total, ple_total, abp_total, dbp_total, sbp_total,
-                                        p_status_total, a_status_total,
-                                        )) for process_i in range(process_num)]
-            for worker in workers:
-                worker.start()
-            for worker in workers:
-                worker.join()
-
-            print('--- %s seconds ---' % (time.time() - start_time))
-            if len(info_total) != 0:
-                info_tot = np.concatenate((info_tot, np.array(info_total, dtype=float)), axis=0)
-                ple_tot = np.concatenate((ple_tot, np.array(ple_total)), axis=0)
-                ple_cyc_len = np.concatenate((ple_cyc_len, np.array(ple_cycle_len)), axis=0)
-                ple_cyc = np.concatenate((ple_cyc, np.array(ple_cycle)), axis=0)
-                abp_tot = np.concatenate((abp_tot, np.array(abp_total)), axis=0)
-                abp_cyc_len = np.concatenate((abp_cyc_len, np.array(abp_cycle_len)), axis=0)
-                abp_cyc = np.concatenate((abp_cyc, np.array(abp_cycle)), axis=0)
-                dbp_tot = np.concatenate((dbp_tot, np.array(dbp_total)), axis=0)
-                sbp_tot = np.concatenate((sbp_tot, np.array(sbp_total)), axis=0)
-                p_status_tot = np.concatenate((p_status_tot, np.array(p_status_total)), axis=0)
-                a_status_tot = np.concatenate((a_status_tot, np.array(a_status_total)), axis=0)
-                # print('total inspected data: {}'.format(len(p_status_total) - 1))
-                print('data added : {} / {}'.format(len(info_total), len(p_status_total)))
-                # print('ple:', np.round(np.array(p_status_total).sum(axis=0) / len(p_status_total), 3))
-                # print('abp:', np.round(np.array(a_status_total).sum(axis=0) / len(a_status_total), 3))
-                data_len_list.append(len(info_total))
-                # survived_ratio_list.append()
+        start_time = time.time()
 
-            else:
-                print('no data added')
-                # print('ple:', np.round(np.array(p_status_total).sum(axis=0) / len(p_status_total), 3))
-                # print('abp:', np.round(np.array(a_status_total).sum(axis=0) / len(a_status_total), 3))
-                data_len_list.append(len(info_total))
+        group_shards = [shard_dir + str(group_i) + '_' + str(process_i) + '.hdf5' for process_i in range(process_num)]
+        group_shards = run_sharded(target_function, group_shards,
+                                   [(process_i, segments_per_process[process_i],
+                                     su.select_mode(parameters['mode']), parameters['chunk_size'],
+                                     parameters['sampling_rate'],
+                                     parameters['corr_threshold'], parameters['ple_scale'], parameters['hdf_flag'],
+                                     patient_info_df,
+                                     ShardField('ple_cycle', (100,)), ShardField('ple_cycle_len'),
+                                     ShardField('abp_cycle', (100,)), ShardField('abp_cycle_len'),
+                                     ShardField('info', (6,)), ShardField('ple', (750,)), ShardField('abp', (750,)),
+                                     ShardField('dbp', (2, 15)), ShardField('sbp', (2, 15)),
+                                     ShardField('p_status', p_status_shape), ShardField('a_status', a_status_shape),
+                                     ) for process_i in range(process_num)])
+        shard_paths.extend(group_shards)
 
-            manager.shutdown()
+        print('--- %s seconds ---' % (time.time() - start_time))
+        info_len = sum(shard_lengths(group_shards, 'info'))
+        if info_len != 0:
+            print('data added : {} / {}'.format(info_len, sum(shard_lengths(group_shards, 'p_status'))))
+        else:
+            print('no data added')
+        data_len_list.append(info_len)
 
-    data_len_list.append(len(info_tot) - 1)
-    dset = h5py.File(
-        dset_path + str(mode) + '_' + parameters['gender'] + '_' + str(parameters['corr_threshold']) + '.hdf5', 'w')
+    data_len_list.append(sum(shard_lengths(shard_paths, 'info')))
+    dset = h5py.File(dset_name + '.hdf5', 'w')
+    analysis_dset = h5py.File(dset_name + '_status.hdf5', 'w')
 
-    analysis_dset = h5py.File(
-        dset_path + str(mode) + '_' + parameters['gender'] + '_' + str(parameters['corr_threshold']) + '_status.hdf5',
-        'w')
+    for name in ['ple', 'abp', 'dbp', 'sbp']:
+        virtual_concat(dset, name, shard_paths)
+    for name in ['info', 'ple_cycle', 'ple_cycle_len', 'abp_cycle', 'abp_cycle_len', 'p_status', 'a_status']:
+        virtual_concat(analysis_dset, name, shard_paths)
 
-    # if gender == 0:
-    #     dset = h5py.File(dset_path + str(dataset) + '_total_' + str(threshold) + '.hdf5', 'w')
-    # elif gender == 1:
-    #     dset = h5py.File(dset_path + str(dataset) + '_male_' + str(threshold) + '.hdf5', 'w')
-    # else:
-    #     dset = h5py.File(dset_path + str(dataset) + '_female_' + str(threshold) + '.hdf5', 'w')
-
-    # dset['info'] = np.array(info_tot[1:], dtype='str')
-    dset['ple'] = ple_tot[1:]
-    dset['abp'] = abp_tot[1:]
-    dset['dbp'] = dbp_tot[1:]
-    dset['sbp'] = sbp_tot[1:]
-
-    analysis_dset['info'] = info_tot[1:]
-    analysis_dset['ple_cycle'] = ple_cyc[1:]
-    analysis_dset['ple_cycle_len'] = ple_cyc_len[1:]
-    analysis_dset['abp_cycle'] = abp_cyc[1:]
-    analysis_dset['abp_cycle_len'] = abp_cyc_len[1:]
-    analysis_dset['p_status'] = p_status_tot[1:]
-    analysis_dset['a_status'] = a_status_tot[1:]
-    survived_ple_ratio_list.append(np.round(np.append(np.array(p_status_tot).sum(axis=0) / len(p_status_tot),(len(p_status_tot))), 3))
-    survived_abp_ratio_list.append(np.round(np.append(np.array(a_status_tot).sum(axis=0) / len(a_status_tot),(len(a_status_tot))), 3))
+    p_status_tot = analysis_dset['p_status'][:]
+    a_status_tot = analysis_dset['a_status'][:]
+    survived_ple_ratio_list.append(np.round(np.append(p_status_tot.sum(axis=0) / max(len(p_status_tot), 1),
+                                                      len(p_status_tot)), 3))
+    survived_abp_ratio_list.append(np.round(np.append(a_status_tot.sum(axis=0) / max(len(a_status_tot), 1),
+                                                      len(a_status_tot)), 3))
     dset.close()
     analysis_dset.close()
-    manager.shutdown()
 
     return data_len_list, survived_ple_ratio_list, survived_abp_ratio_list
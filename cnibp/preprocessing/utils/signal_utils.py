@@ -9,6 +9,7 @@ import heartpy.peakdetection as hp_peak
 from heartpy.datautils import rolling_mean
 from cnibp.preprocessing.utils.signal_utils_base import SignalBase
 import random
+import warnings
 
 random.seed(125)
 
@@ -518,3 +519,313 @@ def signal_comparator(ple, abp, ple_normalize, preprocessing_mode, threshold=0.9
             return False, ple_info, abp_info
     else:
         return False, ple_info, abp_info
+
+
+def rolling_mean_batch(target_signals, windowsize, fs=125):
+    '''
+    heartpy rolling_mean of every row (N, L), from one cumulative sum
+    windowsize : in seconds, a scalar or one per row
+    '''
+    n, length = target_signals.shape
+    window = np.broadcast_to((np.asarray(windowsize, dtype=float) * fs).astype(int), (n,))[:, None]
+    cumsum = np.cumsum(np.pad(target_signals, ((0, 0), (1, 0))), axis=1)
+    # heartpy pads (window - 1) // 2 copies of the first and last means on each side
+    start = np.clip(np.arange(length) - (window - 1) // 2, 0, length - window)
+    rows = np.arange(n)[:, None]
+    roll_mean = (cumsum[rows, start + window] - cumsum[rows, start]) / window
+    # and appends a 0 when the padded means are one short (even windows)
+    roll_mean[window[:, 0] % 2 == 0, -1] = 0
+    return roll_mean
+
+
+def run_argmax(target_signals, mask, margin=-1):
+    """
+    heartpy detect_peaks on the samples where mask is True, for every row (N, L)
+    as in heartpy, the samples are grouped at the last sample of every run of consecutive samples,
+    the first maximum of every group is kept and the first one of a row is dropped if it is within margin samples
+    return: list of N arrays of positions
+    """
+    rows, cols = np.nonzero(mask)
+    group_start = np.ones(len(cols), dtype=bool)
+    group_start[1:] = (rows[1:] != rows[:-1])
+    group_start[:-1] |= (rows[1:] == rows[:-1]) & (cols[1:] - cols[:-1] > 1)
+    group_start = np.flatnonzero(group_start)
+    values = target_signals[rows, cols]
+    first = np.zeros(0, dtype=int)
+    if len(values) > 0:
+        group_max = np.maximum.reduceat(values, group_start)
+        group_max = np.repeat(group_max, np.diff(np.append(group_start, len(values))))
+        at_max = np.flatnonzero(values == group_max)
+        group_id = np.searchsorted(group_start, at_max, side='right')
+        first = at_max[np.append(True, group_id[1:] != group_id[:-1])]
+        row_first = np.append(True, rows[first][1:] != rows[first][:-1])
+        first = first[~(row_first & (cols[first] <= margin))]
+    counts = np.bincount(rows[first], minlength=len(mask))
+    return np.split(cols[first], np.cumsum(counts)[:-1])
+
+
+def detect_peaks_batch(target_signals, roll_mean, ma_perc=20, fs=125, invert=False):
+    '''
+    heartpy detect_peaks(x, roll_mean)['peaklist'] of every row (N, L)
+    invert : peaks of -x with the rolling mean -roll_mean, the threshold of -x is minus the threshold of x
+    '''
+    threshold = roll_mean + np.mean(roll_mean / 100, axis=1, keepdims=True) * ma_perc
+    # heartpy drops a first peak within 150 ms, the signal may start mid-beat
+    if invert:
+        return run_argmax(-target_signals, target_signals < threshold, fs * 0.15)
+    return run_argmax(target_signals, target_signals > threshold, fs * 0.15)
+
+
+def pad_rows(arrays, fill=np.nan, min_width=1):
+    '''
+    stacks N arrays of different lengths into a (N, max length) float array padded with fill
+    '''
+    counts = np.array([len(a) for a in arrays], dtype=int)
+    padded = np.full((len(arrays), max(counts.max(initial=0), min_width)), fill, dtype=float)
+    padded[np.arange(padded.shape[1]) < counts[:, None]] = np.concatenate([np.ravel(a) for a in arrays] + [[]])
+    return padded, counts
+
+
+def mahalanobis_flag_batch(padded):
+    '''
+    get_mahalanobis_dis of every row of a nan padded (N, P) array
+    '''
+    x = np.diff(padded, axis=1)
+    with warnings.catch_warnings(), np.errstate(invalid='ignore', divide='ignore'):
+        warnings.simplefilter('ignore', RuntimeWarning)
+        maha_dis = np.abs(x - np.nanmean(x, axis=1, keepdims=True)) / np.nanstd(x, axis=1, keepdims=True)
+    return ~np.any(maha_dis > 2, axis=1)
+
+
+class BatchSignalInfoExtractor(SignalBase):
+    '''
+    * SignalInfoExtractor of N windows (N, L) at once, with the same flags
+    * rfft, rolling means, peak selection, cycle lengths and mahalanobis checks run on all windows together
+
+    per window results are (N,) arrays, the ragged ones (sbp_idx, sbp_value, dbp_idx, dbp_value, cycle)
+    are lists of N arrays, status is a (N, S) int array
+    '''
+
+    def __init__(self, input_sig, normalize, preprocessing_mode='total'):
+        input_sig = np.asarray(input_sig, dtype=float)
+        if normalize:
+            sig_min = np.min(input_sig, axis=1, keepdims=True)
+            sig_max = np.max(input_sig, axis=1, keepdims=True)
+            input_sig = (input_sig - sig_min) / (sig_max - sig_min)
+        super().__init__(input_sig)
+        self.mode = preprocessing_mode
+        self.fs = 125
+        self.freq_flag, self.cycle_len, self.fft_bpm = self.get_cycle_len()
+        self.rolling_sec = self.cycle_len / self.fs
+
+        # rolling means of -x are minus the ones of x, systolic and diastolic detection share them
+        self.roll_mean = rolling_mean_batch(self.input_sig, self.rolling_sec, self.fs)
+        self.roll_mean2 = rolling_mean_batch(self.input_sig, self.rolling_sec * 0.8, self.fs)
+        self.sbp_flag, self.sbp_idx, self.sbp_value = self.get_systolic()
+        self.dbp_flag, self.dbp_idx, self.dbp_value = self.get_diastolic()
+        self.cycle_flag, self.cycle = self.get_cycle()
+
+        if 'flat' in self.mode:
+            self.flat_flag = self.flat_detection()
+        self.status = self.return_sig_status()
+        self.valid_flag = self.signal_validation()
+
+    def __len__(self):
+        return len(self.input_sig)
+
+    def get_cycle_len(self):
+        length = self.input_sig.shape[1]
+        # |fft| bins 1 .. (L - 1) // 2, as amplitude[1:][:int(len(amplitude) / 2)] of SignalInfoExtractor
+        amplitude = (np.abs(np.fft.rfft(self.input_sig, axis=1)) * (2 / length))[:, 1:(length - 1) // 2 + 1]
+        frequency = np.fft.fftfreq(length, 1 / self.fs)
+
+        peak_index = amplitude.argsort(axis=1)[:, ::-1][:, :2]
+        peak_freq = frequency[peak_index[:, 0]]
+        peak_freq = np.where(peak_freq <= 0, frequency[peak_index[:, 1]], peak_freq)
+
+        cycle_len = np.round(self.fs / peak_freq).astype(int)
+        bpm = peak_freq * 60
+        return (bpm > 140) | (bpm < 35), cycle_len, bpm
+
+    def select_peaks(self, invert):
+        peaks = pad_rows(detect_peaks_batch(self.input_sig, self.roll_mean, 20, self.fs, invert))[0]
+        peaks2 = pad_rows(detect_peaks_batch(self.input_sig, self.roll_mean2, 20, self.fs, invert))[0]
+        width = max(peaks.shape[1], peaks2.shape[1])
+        peaks = np.pad(peaks, ((0, 0), (0, width - peaks.shape[1])), constant_values=np.nan)
+        peaks2 = np.pad(peaks2, ((0, 0), (0, width - peaks2.shape[1])), constant_values=np.nan)
+
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            use_second = np.nanstd(np.diff(peaks, axis=1), axis=1) > np.nanstd(np.diff(peaks2, axis=1), axis=1)
+            peaks = np.where(use_second[:, None], peaks2, peaks)
+            diff = np.diff(peaks, axis=1)
+            limit = np.where(self.cycle_len < 200, self.cycle_len * 0.5, np.nanmean(diff, axis=1) * 0.5)
+
+        # drop the peaks too close to the previous one, then move the kept ones to the front of the rows
+        keep = ~np.isnan(peaks)
+        keep[:, 1:] &= ~(diff <= limit[:, None])
+        order = np.argsort(~keep, axis=1, kind='stable')
+        peaks = np.where(np.take_along_axis(keep, order, axis=1), np.take_along_axis(peaks, order, axis=1), np.nan)
+        counts = keep.sum(axis=1)
+        rows = np.arange(len(peaks))[:, None]
+        values = np.where(np.isnan(peaks), np.nan, self.input_sig[rows, np.nan_to_num(peaks).astype(int)])
+
+        flag = (counts >= self.input_sig.shape[1] // self.cycle_len - 1) & \
+               mahalanobis_flag_batch(peaks) & mahalanobis_flag_batch(values)
+        idx = np.split(peaks[~np.isnan(peaks)].astype(int), np.cumsum(counts)[:-1])
+        return flag, idx, [self.input_sig[i, p] for i, p in enumerate(idx)]
+
+    def get_systolic(self):
+        return self.select_peaks(invert=False)
+
+    def get_diastolic(self):
+        return self.select_peaks(invert=True)
+
+    def get_cycle(self):
+        dbp, counts = pad_rows(self.dbp_idx, min_width=2)
+        rows = np.arange(len(dbp))
+        n_cycle = np.maximum(counts - 1, 0)
+        valid = np.arange(dbp.shape[1] - 1) < n_cycle[:, None]
+        start = np.where(valid, dbp[:, :-1], 0).astype(int)
+        end = np.where(valid, dbp[:, 1:], 1).astype(int)
+        cycle_len = np.where(valid, end - start, np.nan)
+        lr_check = np.where(valid, np.abs(self.input_sig[rows[:, None], start] -
+                                          self.input_sig[rows[:, None], end - 1]), np.inf)
+
+        # np.mean(cycle_len_list, dtype=int) truncates the mean
+        avg_cycle_len = (np.nansum(cycle_len, axis=1) // np.maximum(n_cycle, 1)).astype(int)
+        with np.errstate(divide='ignore'):
+            peak_bpm = (self.fs / avg_cycle_len) * 60
+
+        # the default argsort does not keep the order of equal cycle lengths,
+        # the few cycles of every window are sorted row by row to pick the same cycle as SignalInfoExtractor
+        best = np.zeros(len(dbp), dtype=int)
+        for i in np.flatnonzero(n_cycle > 0):
+            length_order = np.argsort(np.abs(end[i, :n_cycle[i]] - start[i, :n_cycle[i]] - avg_cycle_len[i]))
+            diff_order = np.argsort(lr_check[i, :n_cycle[i]])
+            total_order = length_order[diff_order == length_order]
+            best[i] = total_order[0] if len(total_order) > 0 else length_order[0]
+
+        self.cycle_start, self.cycle_end = start[rows, best], end[rows, best]
+        cycle = [self.input_sig[i, s:e] if c >= 2 else np.zeros(1)
+                 for i, (s, e, c) in enumerate(zip(self.cycle_start, self.cycle_end, counts))]
+        flag = (counts >= 2) & mahalanobis_flag_batch(cycle_len)
+        flag &= ((35 < peak_bpm) & (peak_bpm < 140)) | ((35 < self.fft_bpm) & (self.fft_bpm < 140))
+        return flag, cycle
+
+    def flat_detection(self):
+        # max of every cycle, 0 for the np.zeros(1) of windows without one
+        in_cycle = (np.arange(self.input_sig.shape[1]) >= self.cycle_start[:, None]) & \
+                   (np.arange(self.input_sig.shape[1]) < self.cycle_end[:, None]) & \
+                   (np.array([len(c) for c in self.dbp_idx]) >= 2)[:, None]
+        cycle_max = np.where(np.any(in_cycle, axis=1), np.max(np.where(in_cycle, self.input_sig, -np.inf), axis=1), 0)
+        flat_range = np.sum(self.input_sig == cycle_max[:, None], axis=1)
+        return ~(flat_range < self.input_sig.shape[1] * 0.05)
+
+    def return_sig_status(self):
+        sig_status = [self.dbp_flag, self.sbp_flag, self.cycle_flag]
+        if 'flat' in self.mode:
+            sig_status.append(self.flat_flag)
+        return np.stack(sig_status, axis=1).astype(int)
+
+    def signal_validation(self):
+        return (np.sum(self.status[:, 3:], axis=1) == 0) & (np.sum(self.status[:, :3], axis=1) == 3)
+
+    def plot(self, i=0):
+        plt.title('Valid Signal' if self.valid_flag[i] else str(self.status[i]))
+        plt.plot(self.input_sig[i])
+        plt.plot(self.sbp_idx[i], self.sbp_value[i], 'rx')
+        plt.plot(self.dbp_idx[i], self.dbp_value[i], 'bx')
+        plt.show()
+        plt.close()
+
+
+class BatchABPSignalInfoExtractor(BatchSignalInfoExtractor):
+    '''
+    * ABPSignalInfoExtractor of N windows (N, L) at once
+    '''
+
+    def __init__(self, input_sig, normalize, preprocessing_mode):
+        super().__init__(input_sig, normalize, preprocessing_mode)
+        self.amp_flag = self.amp_checker()
+        self.pulse_pressure_flag, self.pulse_pressure = self.pulse_pressure_checker()
+        if 'flip' in self.mode:
+            self.flip_flag = self.flip_detection()
+        if 'underdamp' in self.mode:
+            self.under_damped_flag = self.under_damped_detection()
+        self.detail_status = self.return_abp_sig_status()
+        self.abp_valid_flag = self.valid_flag & self.abp_signal_validation()
+
+    def amp_checker(self):
+        return (np.min(self.input_sig, axis=1) < 30) | (np.max(self.input_sig, axis=1) > 240)
+
+    def pulse_pressure_checker(self):
+        sbp_value, sbp_counts = pad_rows(self.sbp_value)
+        dbp_value, dbp_counts = pad_rows(self.dbp_value)
+        width = min(sbp_value.shape[1], dbp_value.shape[1])
+        pp_len = np.minimum(sbp_counts, dbp_counts)
+        pp = np.where(np.arange(width) < pp_len[:, None], sbp_value[:, :width] - dbp_value[:, :width], np.nan)
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            mean_pp = np.nanmean(pp, axis=1)
+            checked = self.sbp_flag & self.dbp_flag
+            flag = checked & ((mean_pp < np.nanmean(sbp_value, axis=1) * 0.25) | (mean_pp > 100))
+        return flag, [p[:n] if c else None for p, n, c in zip(pp, pp_len, checked)]
+
+    def flip_detection(self):
+        temp = [0.01685, 0.01962, 0.03278, 0.05362, 0.08079, 0.11172, 0.14417, 0.17636, 0.20703, 0.23538,
+                0.26207, 0.28734, 0.31153, 0.33443, 0.35658, 0.37757, 0.39718, 0.41555, 0.43271, 0.44814,
+                0.46215, 0.47478, 0.48593, 0.49568, 0.50381, 0.51039, 0.51598, 0.52047, 0.52438, 0.52879,
+                0.53501, 0.54361, 0.55540, 0.57188, 0.59444, 0.62379, 0.65954, 0.70015, 0.74289, 0.78456,
+                0.82302, 0.85675, 0.88570, 0.91032, 0.93015, 0.94444, 0.95311, 0.95700, 0.95653, 0.95122,
+                0.94072, 0.92486, 0.90624, 0.88620, 0.86563, 0.84454, 0.82384, 0.80356, 0.78373, 0.76398,
+                0.74435, 0.72489, 0.70608, 0.68725, 0.66885, 0.65076, 0.63322, 0.61627, 0.59990, 0.58373,
+                0.56793, 0.55251, 0.53729, 0.52231, 0.50754, 0.49274, 0.47823, 0.46318, 0.44747, 0.43052,
+                0.41254, 0.39341, 0.37326, 0.35163, 0.32875, 0.30373, 0.27742, 0.25016, 0.22357, 0.19834,
+                0.17506, 0.15335, 0.13353, 0.11505, 0.09776, 0.08095, 0.06493, 0.04957, 0.03603, 0.02339]
+        # the template is resampled once per cycle length
+        resampled = {}
+        flip_flag = np.zeros(len(self.cycle), dtype=bool)
+        for i, cycle in enumerate(self.cycle):
+            if np.argmax(cycle) > len(cycle) / 2:
+                flip_flag[i] = True
+            else:
+                if len(cycle) not in resampled:
+                    resampled[len(cycle)] = signal.resample(temp, len(cycle))
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    flip_flag[i] = np.corrcoef(cycle, resampled[len(cycle)])[0, 1] > 0.95
+        return flip_flag
+
+    def under_damped_detection(self):
+        under_damped_flag = np.zeros(len(self.cycle), dtype=bool)
+        for i in np.flatnonzero(self.cycle_flag):
+            start_point = np.argmax(self.cycle[i])
+            end_point = start_point + int(len(self.cycle[i]) * 0.03)
+            diff = np.diff(self.cycle[i][start_point:end_point])
+            under_damped_flag[i] = len(diff) > 0 and np.mean(diff) < -5
+        return under_damped_flag
+
+    def return_abp_sig_status(self):
+        sig_status = [self.amp_flag, self.pulse_pressure_flag]
+        if 'flip' in self.mode:
+            sig_status.append(self.flip_flag)
+        if 'underdamp' in self.mode:
+            sig_status.append(self.under_damped_flag)
+        return np.stack(sig_status, axis=1).astype(int)
+
+    def abp_signal_validation(self):
+        return (np.sum(self.detail_status, axis=1) == 0) & self.valid_flag
+
+
+def signal_comparator_batch(ple, abp, ple_normalize, preprocessing_mode, threshold=0.9, sampling_rate=125):
+    '''
+    signal_comparator of N window pairs (N, L)
+    return: confirm_flag (N,), ple_info, abp_info (Batch extractors)
+    '''
+    ple_info = BatchSignalInfoExtractor(ple, ple_normalize, preprocessing_mode)
+    abp_info = BatchABPSignalInfoExtractor(abp, not ple_normalize, preprocessing_mode)
+    confirm_flag = ple_info.valid_flag & abp_info.abp_valid_flag
+    for i in np.flatnonzero(confirm_flag):
+        corr = np.corrcoef(signal.resample(ple_info.cycle[i], 100), signal.resample(abp_info.cycle[i], 100))[0, 1]
+        confirm_flag[i] = corr > threshold
+    return confirm_flag, ple_info, abp_info
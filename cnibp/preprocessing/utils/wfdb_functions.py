@@ -1,32 +1,71 @@
 import wfdb
 import numpy as np
+from tqdm import tqdm
 from sklearn.preprocessing import MinMaxScaler
 import matplotlib.pyplot as plt
 
+# (segment, ple_idx, abp_idx, length, fs) rows of scan_segments
+MANIFEST_DTYPE = [('segment', 'U256'), ('ple_idx', 'i4'), ('abp_idx', 'i4'), ('length', 'i8'), ('fs', 'f8')]
+
+# channel layout (tuple of signal names) -> (ple_idx, abp_idx)
+_layout_channel_idx = {}
+
+
+def layout_channel_idx(sig_name):
+    """
+    param: sig_name: signal names of a segment header
+    return: idx: index of the ple, abp channel, -1 if missing. cached per channel layout
+    """
+    layout = tuple(sig_name or ())
+    if layout not in _layout_channel_idx:
+        _layout_channel_idx[layout] = (layout.index('PLETH') if 'PLETH' in layout else -1,
+                                       layout.index('ABP') if 'ABP' in layout else -1)
+    return _layout_channel_idx[layout]
+
 
 def find_channel_idx(path):
     """
     param: path: path of a segment (e.g. /hdd/hdd0/dataset/bpnet/adults/physionet.org/files/mimic3wdb/1.0/30/3001937_11)
     return: idx: index of the ple, abp channel
     """
-    # target_channel = ['PLETH', 'ABP']
-    # channel_idx = []
-    record = wfdb.rdrecord(path)
-    channel_names = record.sig_name
-    # for tc in target_channel:
-    #     if tc in channel_names:
-    #         channel_idx.append([i for i in range(len(channel_names)) if channel_names[i] == tc][0])
-
-    ple_idx = [p for p in range(len(channel_names)) if channel_names[p] == 'PLETH'][0]
-    abp_idx = [a for a in range(len(channel_names)) if channel_names[a] == 'ABP'][0]
-    # try:
-    #     ecg_idx = [e for e in range(len(channel_names)) if channel_names[e] == 'II'][0]
-    # except:
-    #     ecg_idx = -1
+    # only the header is parsed, the signals are not read
+    ple_idx, abp_idx = layout_channel_idx(wfdb.rdheader(path).sig_name)
+    if ple_idx < 0 or abp_idx < 0:
+        raise IndexError('PLETH or ABP channel not found in ' + path)
 
     return [ple_idx, abp_idx]
 
 
+def read_segment(path: str, channel_idx: list):
+    """
+    reads the channels of a segment with a single read of its .dat file
+    param: path: path of a segment without extension
+    param: channel_idx: channels to read
+    return: p_signal: physical values (nan where invalid), d_signal: digital values, adc_gain, baseline
+    """
+    record = wfdb.rdrecord(path, channels=[int(c) for c in channel_idx], physical=False)
+    return record.dac(), record.d_signal, record.adc_gain, record.baseline
+
+
+def scan_segments(segment_paths: list, min_length: int = 1000):
+    """
+    pre-scan of the segment headers, before any signal is read
+    param: segment_paths: .hea paths of the segments
+    param: min_length: minimum number of samples
+    return: manifest: structured array of (segment, ple_idx, abp_idx, length, fs) of the segments
+            having both PLETH and ABP channels and at least min_length samples
+    """
+    manifest = []
+    for path in tqdm(segment_paths, desc='scanning headers', leave=False):
+        segment = path.replace('.hea', '')
+        header = wfdb.rdheader(segment)
+        ple_idx, abp_idx = layout_channel_idx(header.sig_name)
+        if ple_idx < 0 or abp_idx < 0 or (header.sig_len or 0) < min_length:
+            continue
+        manifest.append((segment, ple_idx, abp_idx, header.sig_len, header.fs))
+    return np.array(manifest, dtype=MANIFEST_DTYPE)
+
+
 def get_channel_segments(path: str, chunk_size):
     channel_idx = find_channel_idx(path)
 
@@ -0,0 +1,404 @@
+import sys
+import time
+
+import numpy as np
+import torch
+from scipy import signal
+from scipy.sparse import spdiags
+
+from rppg.log import log_info
+from rppg.nets.CHROM import CHROM
+from rppg.nets.ICA import ICA
+from rppg.nets.LGI import LGI
+from rppg.nets.PCA import PCA
+from rppg.nets.POS import POS
+from rppg.nets.SSR import SSR
+from rppg.utils.funcs import calc_hr_torch, detrend, detrend_torch
+
+SEED = 0
+
+
+def best_time(func, repeat=3, **kwargs):
+    """Best wall time of `repeat` runs, in seconds."""
+    best = float('inf')
+    for _ in range(repeat):
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        func(**kwargs)
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def dense_detrend(signal, Lambda):
+    # reference: detrend by inverting the dense (N x N) smoothing matrix
+    signal_length = len(signal)
+    H = np.identity(signal_length)
+    ones = np.ones(signal_length)
+    diags_data = np.array([ones, -2 * ones, ones])
+    D = spdiags(diags_data, np.array([0, 1, 2]), (signal_length - 2), signal_length).toarray()
+    return np.dot((H - np.linalg.inv(H + (Lambda ** 2) * np.dot(D.T, D))), signal)
+
+
+def benchmark_detrend(lengths=(300, 900, 1800, 3600, 7200), test_n=32, Lambda=100, dense_limit=3600):
+    log_info("detrend : dense inverse vs banded cholesky")
+    print("{:>8} {:>12} {:>12} {:>10} {:>12} {:>10}".format(
+        'length', 'dense(s)', 'banded(s)', 'speedup', 'torch(s)', 'max_err'))
+    rng = np.random.default_rng(SEED)
+    for length in lengths:
+        sig = np.cumsum(rng.standard_normal(length))
+        sigs = torch.from_numpy(np.cumsum(rng.standard_normal((test_n, length)), axis=-1))
+
+        banded_time = best_time(detrend, signal=sig, Lambda=Lambda)
+        torch_time = best_time(detrend_torch, signals=sigs, Lambda=Lambda)
+        if length <= dense_limit:
+            dense_time = best_time(dense_detrend, signal=sig, Lambda=Lambda)
+            max_err = np.max(np.abs(dense_detrend(sig, Lambda) - detrend(sig, Lambda)))
+            print("{:>8} {:>12.5f} {:>12.5f} {:>9.1f}x {:>12.5f} {:>10.2e}".format(
+                length, dense_time, banded_time, dense_time / banded_time, torch_time, max_err))
+        else:
+            print("{:>8} {:>12} {:>12.5f} {:>10} {:>12.5f} {:>10}".format(
+                length, '-', banded_time, '-', torch_time, '-'))
+
+
+def loop_peak_hr(ppg_signals, fs=30.):
+    # reference: per chunk peak detection of calc_hr_torch(calc_type="Peak")
+    test_n, sig_length = ppg_signals.shape
+    hr_list = torch.empty(test_n)
+    hrv_list = -torch.ones((test_n, int(sig_length // fs * 10)))
+    index_list = -torch.ones((test_n, int(sig_length // fs * 10)))
+    width = 11
+    window_maxima = torch.nn.functional.max_pool1d(ppg_signals, width, 1, padding=width // 2, return_indices=True)[
+        1].squeeze()
+
+    for i in range(test_n):
+        candidate = window_maxima[i].unique()
+        nice_peaks = candidate[window_maxima[i][candidate] == candidate]
+        nice_peaks = nice_peaks[ppg_signals[i][nice_peaks] > torch.mean(ppg_signals[i][nice_peaks] / 2)]
+        hrv = torch.diff(nice_peaks) / fs
+        hr_list[i] = torch.mean(60 / hrv)
+        hrv_list[i, :len(hrv)] = hrv * 1000
+        index_list[i, :len(nice_peaks)] = nice_peaks
+
+    hrv_list = hrv_list[:, :torch.max(torch.sum(hrv_list > 0, dim=-1))]
+    index_list = index_list[:, :torch.max(torch.sum(index_list > 0, dim=-1))]
+    return hr_list, hrv_list, index_list
+
+
+def benchmark_peak(test_ns=(16, 64, 256, 1024), length=900, fs=30.):
+    log_info("calc_hr_torch(Peak) : per chunk loop vs batched")
+    print("{:>8} {:>12} {:>12} {:>10} {:>8}".format('chunks', 'loop(s)', 'batched(s)', 'speedup', 'equal'))
+    rng = np.random.default_rng(SEED)
+    t = np.arange(length) / fs
+    for test_n in test_ns:
+        hr = rng.uniform(0.8, 2.5, (test_n, 1))
+        sigs = np.sin(2 * np.pi * hr * t) + 0.3 * rng.standard_normal((test_n, length))
+        sigs = torch.from_numpy(sigs.astype(np.float32))
+
+        loop_time = best_time(loop_peak_hr, ppg_signals=sigs, fs=fs)
+        batched_time = best_time(calc_hr_torch, calc_type="Peak", ppg_signals=sigs, fs=fs)
+        equal = all(torch.allclose(a, b, equal_nan=True)
+                    for a, b in zip(loop_peak_hr(sigs, fs), calc_hr_torch("Peak", sigs, fs)))
+        print("{:>8} {:>12.5f} {:>12.5f} {:>9.1f}x {:>8}".format(
+            test_n, loop_time, batched_time, loop_time / batched_time, str(equal)))
+
+
+def loop_pos(x, fs=30, WinSec=1.6):
+    # reference: per batch, per frame POS projection with per row detrend and filtfilt
+    x = torch.mean(torch.permute(x, (0, 2, 1, 3, 4)), dim=(3, 4))
+    batch_size, N, num_features = x.shape
+    H = torch.zeros(batch_size, 1, N)
+    P = torch.tensor([[0, 1, -1], [-2, 1, 1]], dtype=torch.float)
+    l = int(fs * WinSec)
+    for b in range(batch_size):
+        RGB = x[b]
+        for n in range(N):
+            m = n - l
+            if m >= 0:
+                Cn = torch.transpose(RGB[m:n, :] / torch.mean(RGB[m:n, :], dim=0), 0, 1)
+                S = torch.matmul(P, Cn)
+                h = S[0, :] + (torch.std(S[0, :]) / torch.std(S[1, :])) * S[1, :]
+                H[b, 0, m:n] = H[b, 0, m:n] + h - torch.mean(h)
+
+    BVP = H.numpy().reshape(batch_size, -1)
+    b, a = signal.butter(1, [0.75 / fs * 2, 3 / fs * 2], btype='bandpass')
+    for i in range(len(BVP)):
+        BVP[i] = detrend(BVP[i], 100)
+        BVP[i] = signal.filtfilt(b, a, BVP[i].astype(np.double))
+    return torch.from_numpy(BVP.copy())
+
+
+def benchmark_pos(batch_sizes=(1, 8, 32), length=300, img_size=8):
+    log_info("POS : per frame loop vs unfold")
+    print("{:>8} {:>14} {:>14} {:>10} {:>10}".format('batch', 'loop(fps)', 'unfold(fps)', 'speedup', 'max_err'))
+    rng = np.random.default_rng(SEED)
+    model = POS()
+    t = np.arange(length) / model.fs
+    for batch_size in batch_sizes:
+        pulse = np.sin(2 * np.pi * rng.uniform(0.8, 2.5, (batch_size, 1, 1, 1, 1)) * t[:, None, None])
+        x = 0.5 + 0.01 * pulse * np.array([0.3, 0.8, 0.5])[:, None, None, None] + \
+            0.002 * rng.standard_normal((batch_size, 3, length, img_size, img_size))
+        x = torch.from_numpy(x.astype(np.float32))
+
+        with torch.no_grad():
+            loop_time = best_time(loop_pos, x=x, fs=model.fs, WinSec=model.WinSec)
+            unfold_time = best_time(model, x=x)
+            max_err = torch.max(torch.abs(loop_pos(x, model.fs, model.WinSec) - model(x))).item()
+        frames = batch_size * length
+        print("{:>8} {:>14.1f} {:>14.1f} {:>9.1f}x {:>10.2e}".format(
+            batch_size, frames / loop_time, frames / unfold_time, loop_time / unfold_time, max_err))
+
+
+def loop_chrom(batch_x, fs=30, WinSec=1.6, overlap=0.5):
+    # reference: python loop windowing, per window filtfilt and overlap-add of CHROM
+    batch_x = torch.mean(torch.permute(batch_x, (0, 2, 1, 3, 4)), dim=[3, 4])
+    batch_size_org, window, _ = batch_x.shape
+    B, A = signal.butter(3, [0.7 / (1.2 * fs), 2.5 / (1.2 * fs)], 'bandpass')
+    interval = int((fs * WinSec) * overlap)
+
+    data = batch_x.reshape(-1, 3)
+    step = int(window * overlap)
+    windows = torch.stack([data[i * step:i * step + window]
+                           for i in range(int((batch_size_org * window) // (window * overlap) - 1))])
+    RGBNorm = windows / torch.mean(windows, dim=1, keepdim=True)
+
+    bvp = torch.zeros(batch_size_org * window)
+    m = torch.from_numpy(signal.windows.hann(window))
+    for b in range(len(windows)):
+        X = RGBNorm[b]
+        Xcomp = torch.from_numpy(signal.filtfilt(B, A, (3 * X[:, 0] - 2 * X[:, 1]).numpy()).copy())
+        Ycomp = torch.from_numpy(signal.filtfilt(B, A, ((1.5 * X[:, 0]) + X[:, 1] - (1.5 * X[:, 1])).numpy()).copy())
+        Swin = (Xcomp - Ycomp * torch.std(Xcomp) / torch.std(Ycomp)) * m
+        bvp[b * interval:(b + 1) * interval] = bvp[b * interval:(b + 1) * interval] + Swin[:interval]
+        bvp[(b + 1) * interval:(b + 2) * interval] = Swin[interval:]
+    return bvp.view(batch_size_org, -1)
+
+
+def benchmark_chrom(batch_sizes=(8, 64, 512), length=48, img_size=8):
+    # the reference loop overlap-adds with a fixed hop of WinSec * fs / 2 frames, so length must be 48
+    log_info("CHROM : per window loop vs batched")
+    print("{:>8} {:>14} {:>14} {:>10} {:>10}".format('batch', 'loop(fps)', 'batched(fps)', 'speedup', 'max_err'))
+    rng = np.random.default_rng(SEED)
+    model = CHROM()
+    for batch_size in batch_sizes:
+        x = torch.from_numpy((0.5 + 0.01 * rng.standard_normal((batch_size, 3, length, img_size, img_size)))
+                             .astype(np.float32))
+
+        with torch.no_grad():
+            loop_time = best_time(loop_chrom, batch_x=x)
+            batched_time = best_time(model, batch_x=x)
+            max_err = torch.max(torch.abs(loop_chrom(x) - model(x))).item()
+        frames = batch_size * length
+        print("{:>8} {:>14.1f} {:>14.1f} {:>9.1f}x {:>10.2e}".format(
+            batch_size, frames / loop_time, frames / batched_time, loop_time / batched_time, max_err))
+
+
+def loop_ssr(images, fps=30):
+    # reference: per frame correlation matrix and eigh, per window rotation loop of SSR
+    raw_sig = torch.permute(images, (0, 2, 3, 4, 1))
+    B, K, h, w, c = raw_sig.size()
+    l = int(fps)
+    P = torch.zeros(B, K, dtype=raw_sig.dtype)
+    L = torch.zeros(B, 3, K)
+    U = torch.zeros(B, 3, 3, K)
+    for b in range(B):
+        for k in range(K):
+            V = raw_sig[b, k].float()
+            V = (V * torch.all(V != 0, dim=-1, keepdim=True)).view(-1, 3)
+            eig_val, eig_vec = torch.linalg.eigh(torch.matmul(V.T, V) / V.size(0))
+            idx = torch.argsort(eig_val).flip(0)
+            L[b, :, k], U[b, :, :, k] = eig_val[idx], eig_vec[:, idx]
+
+            if k >= l:
+                tau = k - l
+                SR = torch.zeros(3, l)
+                for z, t in enumerate(range(tau, k)):
+                    d = U[b, :, 0, t]
+                    e = U[b, :, 1, tau]
+                    f = U[b, :, 2, tau]
+                    SR[:, z] = torch.sqrt(L[b, 0, t] / L[b, 1, tau]) * e * torch.dot(e, d) + \
+                               torch.sqrt(L[b, 0, t] / L[b, 2, tau]) * f * torch.dot(f, d)
+                p = SR[0] - (torch.std(SR[0]) / torch.std(SR[1])) * SR[1]
+                P[b, tau:k] += p - torch.mean(p)
+    return P
+
+
+def benchmark_ssr(batch_sizes=(1, 4, 16), length=150, img_size=8):
+    log_info("SSR : per frame loop vs batched eigh")
+    print("{:>8} {:>14} {:>14} {:>10} {:>10}".format('batch', 'loop(fps)', 'batched(fps)', 'speedup', 'max_err'))
+    rng = np.random.default_rng(SEED)
+    model = SSR()
+    for batch_size in batch_sizes:
+        # skin pixels with a distinct spread per channel, so the eigenvectors are well separated
+        x = np.array([0.6, 0.4, 0.3])[:, None, None, None] + \
+            np.array([0.1, 0.05, 0.02])[:, None, None, None] * rng.standard_normal((batch_size, 3, length, img_size, img_size))
+        x[:, :, :, :2, :2] = 0  # non-skin pixels
+        x = torch.from_numpy(x.astype(np.float32))
+
+        with torch.no_grad():
+            loop_time = best_time(loop_ssr, repeat=1, images=x)
+            batched_time = best_time(model, images=x)
+            max_err = torch.max(torch.abs(loop_ssr(x) - model(x))).item()
+        frames = batch_size * length
+        print("{:>8} {:>14.1f} {:>14.1f} {:>9.1f}x {:>10.2e}".format(
+            batch_size, frames / loop_time, frames / batched_time, loop_time / batched_time, max_err))
+
+
+def benchmark_ica(batch_sizes=(1, 16, 128), length=300, img_size=8):
+    # no loop reference, the previous ICA returned its input; reports throughput and separation quality
+    log_info("ICA : batched JADE")
+    print("{:>8} {:>14} {:>12}".format('batch', 'batched(fps)', 'mean|corr|'))
+    rng = np.random.default_rng(SEED)
+    model = ICA()
+    t = np.arange(length) / model.fs
+    for batch_size in batch_sizes:
+        pulse = np.sin(2 * np.pi * rng.uniform(0.8, 2.3, (batch_size, 1)) * t)
+        sources = np.stack([pulse, rng.laplace(size=(batch_size, length)),
+                            np.sign(np.sin(2 * np.pi * 0.1 * t + rng.uniform(0, 6, (batch_size, 1))))], axis=1)
+        mixed = 0.5 + np.einsum('bij,bjt->bit', rng.uniform(0.2, 1, (batch_size, 3, 3)), sources)
+        x = torch.from_numpy(np.repeat(np.repeat(mixed[..., None, None], img_size, -2), img_size, -1)
+                             .astype(np.float32))
+
+        with torch.no_grad():
+            batched_time = best_time(model, x=x)
+            bvp = model(x).numpy()
+        corr = np.mean([abs(np.corrcoef(bvp[b], pulse[b])[0, 1]) for b in range(batch_size)])
+        print("{:>8} {:>14.1f} {:>12.3f}".format(batch_size, batch_size * length / batched_time, corr))
+
+
+def loop_pca(x):
+    # reference: one scikit-learn PCA per batch element
+    from sklearn.decomposition import PCA as skpca
+    x = torch.mean(x, dim=(3, 4))
+    bvp = []
+    for X in x:
+        pca = skpca(n_components=3).fit(X.numpy())
+        bvp.append(torch.from_numpy(pca.components_[1] * pca.explained_variance_[1]))
+    return torch.stack(bvp)
+
+
+def loop_lgi(batch_x):
+    # reference: one svd and projection per batch element
+    batch_x = torch.mean(batch_x, dim=(3, 4))
+    bvp = []
+    for X in batch_x:
+        U, _, _ = torch.svd(X.unsqueeze(0))
+        S = U[:, :, :1]
+        Y = torch.matmul(torch.eye(3) - torch.matmul(S, S.transpose(1, 2)), X)
+        bvp.append(Y[:, 1, :])
+    return torch.cat(bvp)
+
+
+def benchmark_pca_lgi(batch_sizes=(8, 64, 512), length=300, img_size=4):
+    log_info("PCA / LGI : per sample loop vs batched gram eigh")
+    print("{:>6} {:>8} {:>14} {:>14} {:>10} {:>10}".format(
+        'model', 'batch', 'loop(fps)', 'batched(fps)', 'speedup', 'max_err'))
+    rng = np.random.default_rng(SEED)
+    for name, loop, model in [('PCA', loop_pca, PCA()), ('LGI', loop_lgi, LGI())]:
+        for batch_size in batch_sizes:
+            x = torch.from_numpy((0.4 + 0.3 * rng.random((batch_size, 3, length, img_size, img_size)))
+                                 .astype(np.float32))
+            with torch.no_grad():
+                loop_time = best_time(lambda: loop(x))
+                batched_time = best_time(lambda: model(x))
+                max_err = torch.max(torch.abs(loop(x) - model(x))).item()
+            frames = batch_size * length
+            print("{:>6} {:>8} {:>14.1f} {:>14.1f} {:>9.1f}x {:>10.2e}".format(
+                name, batch_size, frames / loop_time, frames / batched_time, loop_time / batched_time, max_err))
+
+
+def crop_boxes(xy_points, large_box_coef=1.5):
+    # smoothed (cnt_y, cnt_x, half size) crop boxes of data_preprocess, indexed by frame
+    from rppg.preprocessing.dataset_preprocess import get_CntYX_Width
+    valid_fr_idx = xy_points[xy_points['top'].notnull()].index.tolist()
+    front_idx, rear_idx = valid_fr_idx[0], valid_fr_idx[-1]
+    y_x_w = get_CntYX_Width(xy_points=xy_points[front_idx:rear_idx + 1].copy(), large_box_coef=large_box_coef)
+    return {front_idx + i: box for i, box in enumerate(y_x_w)}
+
+
+def box_iou(a, b):
+    # square boxes (cnt_y, cnt_x, half size)
+    overlap_y = max(0, min(a[0] + a[2], b[0] + b[2]) - max(a[0] - a[2], b[0] - b[2]))
+    overlap_x = max(0, min(a[1] + a[2], b[1] + b[2]) - max(a[1] - a[2], b[1] - b[2]))
+    inter = overlap_y * overlap_x
+    return inter / (4 * a[2] ** 2 + 4 * b[2] ** 2 - inter)
+
+
+def synthetic_face_track(frame_total=600, fs=30., seed=SEED):
+    # (frames, 4) (bottom, right, top, left) boxes of detect_boxes for a face of ~180 px swaying in a 640x480 video:
+    # 0.2 Hz sway of 25 px, 1 Hz nodding of 6 px, 1 px detector jitter
+    rng = np.random.default_rng(seed)
+    t = np.arange(frame_total) / fs
+    cnt_y = 240 + 6 * np.sin(2 * np.pi * 1. * t) + rng.normal(0, 1, frame_total)
+    cnt_x = 320 + 25 * np.sin(2 * np.pi * 0.2 * t) + rng.normal(0, 1, frame_total)
+    half = 90 + 5 * np.sin(2 * np.pi * 0.05 * t) + rng.normal(0, 1, frame_total)
+    return np.stack([cnt_y - half, cnt_x + half, cnt_y + half, cnt_x - half], axis=1)
+
+
+def benchmark_detect_interval(video_path=None, settings=((1, 1.), (5, 1.), (10, 1.), (5, 0.5), (10, 0.5))):
+    # python -m rppg.benchmark detect_interval:/path/to/video.avi
+    # without a video, the face detector is replaced by a synthetic face track (synthetic_face_track) so only
+    # the interval / scale interpolation error is measured, against detection on every full size frame
+    import cv2
+    import rppg.preprocessing.dataset_preprocess as dp
+    if video_path is None:
+        track = synthetic_face_track()
+        log_info("face detection : every frame vs every N frames on downscaled frames, synthetic face track")
+
+        def detect_face(frame, detection_model='hog', scale=1.):
+            # face_recognition returns integer boxes of the downscaled frame
+            return tuple(np.round(track[frame] * scale) / scale)
+
+        def frames():
+            return iter(range(len(track))), len(track)
+    else:
+        log_info("face detection : every frame vs every N frames on downscaled frames, " + video_path)
+        detect_face = dp.detect_face
+
+        def frames():
+            cap = cv2.VideoCapture(video_path)
+            return dp.read_frames(cap), int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    print("{:>9} {:>6} {:>10} {:>10} {:>14} {:>10}".format(
+        'interval', 'scale', 'time(s)', 'frames', 'center_err(px)', 'mean_iou'))
+
+    def run(interval, scale):
+        frame_iter, frame_total = frames()
+        start = time.perf_counter()
+        xy_points = dp.detect_boxes(frame_iter, frame_total, interval=interval, scale=scale)
+        elapsed = time.perf_counter() - start
+        return crop_boxes(xy_points), elapsed
+
+    original_detect_face = dp.detect_face
+    dp.detect_face = detect_face
+    try:
+        baseline, baseline_time = run(1, 1.)
+        for interval, scale in settings:
+            boxes, elapsed = (baseline, baseline_time) if (interval, scale) == (1, 1.) else run(interval, scale)
+            common = sorted(set(baseline) & set(boxes))
+            center_err = np.mean([np.hypot(*(boxes[i][:2] - baseline[i][:2])) for i in common])
+            iou = np.mean([box_iou(boxes[i], baseline[i]) for i in common])
+            print("{:>9} {:>6} {:>10.2f} {:>10} {:>14.2f} {:>10.3f}".format(
+                interval, scale, elapsed, len(boxes), center_err, iou))
+    finally:
+        dp.detect_face = original_detect_face
+
+
+BENCHMARKS = {
+    'detrend': benchmark_detrend,
+    'peak': benchmark_peak,
+    'pos': benchmark_pos,
+    'chrom': benchmark_chrom,
+    'ssr': benchmark_ssr,
+    'ica': benchmark_ica,
+    'pca_lgi': benchmark_pca_lgi,
+    'detect_interval': benchmark_detect_interval,
+}
+
+if __name__ == "__main__":
+    # python -m rppg.benchmark [name[:arg] ...]
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        name, *args = name.split(':', 1)
+        BENCHMARKS[name](*args)
@@ -16,9 +16,15 @@ from rppg.datasets.PhysFormerDataset import PhysFormerDataset
 from rppg.datasets.RhythmNetDataset import RhythmNetDataset
 from rppg.datasets.VitamonDataset import VitamonDataset
 from rppg.datasets.EfficientPhysDataset import EfficientPhysDataset
-from rppg.utils.funcs import detrend
+from rppg.datasets.LazyDataset import (LazyDeepPhysDataset, LazyPhysNetDataset, LazyPhysFormerDataset)
+from rppg.log import log_warning
+from rppg.utils.funcs import detrend, get_device
+from rppg.utils.h5_storage import read_video
 import torch
 
+INDEX_FILE_NAME = ".index.npz"
+INDEX_VERSION = 1
+
 
 def dataset_split(
         dataset,
@@ -48,13 +54,20 @@ g = torch.Generator()
 g.manual_seed(0)
 
 
-def data_loader(datasets, fit_cfg):
+def data_loader(datasets, fit_cfg, device=None):
     model_type = fit_cfg.type
     train_batch_size = fit_cfg.train.batch_size
     test_batch_size = fit_cfg.test.batch_size
     time_length = fit_cfg.time_length
     shuffle = fit_cfg.train.shuffle
     meta = fit_cfg.train.meta.flag
+    if device is None:
+        device = get_device(fit_cfg.device)
+    loader_kwargs = {'num_workers': fit_cfg.num_workers,
+                     'pin_memory': fit_cfg.pin_memory and torch.device(device).type == 'cuda',
+                     'persistent_workers': fit_cfg.num_workers > 0,
+                     'worker_init_fn': seed_worker,
+                     'generator': g}
 
     if meta:
         data_loader = []
@@ -63,9 +76,9 @@ def data_loader(datasets, fit_cfg):
             support_len = int(np.floor(dataset_len * 0.8))
             query_len = dataset_len - support_len
             support_dataset, query_dataset = random_split(dataset, [support_len, query_len])
-            support_loader = DataLoader(support_dataset, batch_size=train_batch_size, shuffle=False)
-            query_loader = DataLoader(query_dataset, batch_size=train_batch_size, shuffle=False)
-            data_loader.append([support_loader, query_loader])
+            support_loader = DataLoader(support_dataset, batch_size=train_batch_size, shuffle=False, **loader_kwargs)
+            query_loader = DataLoader(query_dataset, batch_size=train_batch_size, shuffle=False, **loader_kwargs)
+            data_loader.append([DevicePrefetcher(support_loader, device), DevicePrefetcher(query_loader, device)])
         return data_loader
 
     test_loader = []
@@ -87,37 +100,35 @@ def data_loader(datasets, fit_cfg):
             sampler_validation = ClipSampler(idx_validation)
 
             train_loader = DataLoader(datasets[0], batch_size=(train_batch_size * time_length),
-                                      sampler=sampler_train, shuffle=shuffle,
-                                      worker_init_fn=seed_worker, generator=g)
+                                      sampler=sampler_train, shuffle=shuffle, **loader_kwargs)
             validation_loader = DataLoader(datasets[1], batch_size=(train_batch_size * time_length),
-                                           sampler=sampler_validation, shuffle=shuffle,
-                                           worker_init_fn=seed_worker, generator=g)
+                                           sampler=sampler_validation, shuffle=shuffle, **loader_kwargs)
             if datasets.__len__() == 2:  # for training and validation
-                return [train_loader, validation_loader]
+                return [DevicePrefetcher(train_loader, device), DevicePrefetcher(validation_loader, device)]
             elif datasets.__len__() == 3:  # for training, validation and test
                 test_loader = DataLoader(datasets[2], batch_size=(test_batch_size * time_length),
-                                         shuffle=shuffle, worker_init_fn=seed_worker, generator=g)
-                return [train_loader, validation_loader, test_loader]
+                                         shuffle=shuffle, **loader_kwargs)
+                return [DevicePrefetcher(train_loader, device), DevicePrefetcher(validation_loader, device),
+                        DevicePrefetcher(test_loader, device)]
         else:  # model_type == 'CONT'
-            train_loader = DataLoader(datasets[0], batch_size=train_batch_size, shuffle=shuffle,
-                                      worker_init_fn=seed_worker, generator=g)
-            validation_loader = DataLoader(datasets[1], batch_size=train_batch_size,
-                                           shuffle=shuffle, worker_init_fn=seed_worker, generator=g)
+            train_loader = DataLoader(datasets[0], batch_size=train_batch_size, shuffle=shuffle, **loader_kwargs)
+            validation_loader = DataLoader(datasets[1], batch_size=train_batch_size, shuffle=shuffle,
+                                           **loader_kwargs)
             if datasets.__len__() == 2:  # for training and validation
-                return [train_loader, validation_loader]
+                return [DevicePrefetcher(train_loader, device), DevicePrefetcher(validation_loader, device)]
             elif datasets.__len__() == 3:  # for training, validation and test
                 test_loader = DataLoader(datasets[2], batch_size=(test_batch_size * time_length),
-                                         shuffle=shuffle, worker_init_fn=seed_worker, generator=g)
-                return [train_loader, validation_loader, test_loader]
+                                         shuffle=shuffle, **loader_kwargs)
+                return [DevicePrefetcher(train_loader, device), DevicePrefetcher(validation_loader, device),
+                        DevicePrefetcher(test_loader, device)]
 
     elif datasets.__len__() == 1:
         if model_type == 'DIFF':
             test_loader = DataLoader(datasets[0], batch_size=(test_batch_size * time_length), shuffle=False,
-                                     worker_init_fn=seed_worker, generator=g)
+                                     **loader_kwargs)
         else:  # model_type == 'CONT'
-            test_loader = DataLoader(datasets[0], batch_size=test_batch_size, shuffle=False,
-                                     worker_init_fn=seed_worker, generator=g)
-        return [test_loader]
+            test_loader = DataLoader(datasets[0], batch_size=test_batch_size, shuffle=False, **loader_kwargs)
+        return [DevicePrefetcher(test_loader, device)]
 
 
 def dataset_loader(fit_cfg, dataset_path):
@@ -130,7 +141,9 @@ def dataset_loader(fit_cfg, dataset_path):
     train_flag = fit_cfg.train_flag
     eval_flag = fit_cfg.eval_flag
     debug_flag = fit_cfg.debug_flag
+    lazy_load = fit_cfg.lazy_load
     # meta = fit_cfg.train.meta.flag
+    file_index = {}
 
     save_root_path = dataset_path
     # preprocessed_img_size = str(pre_cfg.dataset.image_size)
@@ -147,6 +160,8 @@ def dataset_loader(fit_cfg, dataset_path):
         path = get_all_files_in_path(root_file_path)
         if debug_flag:
             path = path[:10]
+        if lazy_load:
+            file_index.update(load_file_index(root_file_path, path))
         path_len = len(path)
         # for test
 
@@ -173,6 +188,8 @@ def dataset_loader(fit_cfg, dataset_path):
         path = get_all_files_in_path(root_file_path)
         if debug_flag:
             path = path[:3]
+        if lazy_load:
+            file_index.update(load_file_index(root_file_path, path))
         path_len = len(path)
 
         if train_flag:
@@ -187,6 +204,8 @@ def dataset_loader(fit_cfg, dataset_path):
             path = get_all_files_in_path(root_file_path)[:]
             if debug_flag:
                 path = path[:3]
+            if lazy_load:
+                file_index.update(load_file_index(root_file_path, path))
             eval_path = path
 
     idx = 0
@@ -265,12 +284,14 @@ def dataset_loader(fit_cfg, dataset_path):
     dataset = []
     if train_flag:
         train_dataset = get_dataset(train_path, model_type, model_name, time_length, batch_size,
-                                    overlap_interval, img_size, False)
+                                    overlap_interval, img_size, False, lazy_load, file_index)
         dataset.append(train_dataset)
-        val_dataset = get_dataset(val_path, model_type, model_name, time_length, batch_size, 0, img_size, False)
+        val_dataset = get_dataset(val_path, model_type, model_name, time_length, batch_size, 0, img_size, False,
+                                  lazy_load, file_index)
         dataset.append(val_dataset)
     if eval_flag:
-        eval_dataset = get_dataset(eval_path, model_type, model_name, time_length, batch_size, 0, img_size, True)
+        eval_dataset = get_dataset(eval_path, model_type, model_name, time_length, batch_size, 0, img_size, True,
+                                   lazy_load, file_index)
         dataset.append(eval_dataset)
 
     return dataset
@@ -318,6 +339,8 @@ def get_all_files_in_path(path):
     files = []
     for dirpath, dirnames, filenames in os.walk(path):
         for filename in filenames:
+            if filename.startswith(INDEX_FILE_NAME):
+                continue
             files.append(os.path.join(dirpath, filename))
     condition = []  # 조건 별로 사람 가지고 오고 싶으면 여기 추가
     '''
@@ -328,7 +351,99 @@ def get_all_files_in_path(path):
     return files
 
 
-def get_dataset(path, model_type, model_name, time_length, batch_size, overlap_interval, img_size, eval_flag):
+def load_file_index(root_file_path, path):
+    """Load the cached per-file metadata of a preprocessed dataset root.
+
+    The index is kept in a sidecar file (INDEX_FILE_NAME) in the dataset root. An entry is reused while the
+    mtime and size of its file are unchanged, otherwise the file is opened again and the index is rewritten.
+    Only the files in path are checked, entries of the other files are kept as they are, so a debug subset
+    does not scan the whole root nor drop the rest of the index.
+    Chunk offsets are derived from the frame counts, so one index serves every time_length/overlap_interval.
+
+    Args:
+      root_file_path: The preprocessed dataset root, e.g. dataset_path + "UBFC/CONT".
+      path: The files of the root to index, e.g. get_all_files_in_path after the debug truncation.
+
+    Returns:
+      A dict of file path -> {'num_frame', 'label_len'}.
+    """
+    index_path = os.path.join(root_file_path, INDEX_FILE_NAME)
+    cached = {}
+    if os.path.isfile(index_path):
+        try:
+            with np.load(index_path) as index:
+                if int(index['version']) == INDEX_VERSION:
+                    for row in zip(index['path'], index['mtime'], index['size'], index['num_frame'],
+                                   index['label_len']):
+                        cached[str(row[0])] = row[1:]
+        except (OSError, KeyError, ValueError):
+            log_warning("broken dataset index, rebuilding : " + index_path)
+
+    file_index = {}
+    rows = dict(cached)
+    updated = False
+    for file_name in path:
+        stat = os.stat(file_name)
+        rel_path = os.path.relpath(file_name, root_file_path)
+        row = cached.get(rel_path)
+        if row is None or row[0] != stat.st_mtime or row[1] != stat.st_size:
+            with h5py.File(file_name, 'r') as file:
+                row = (stat.st_mtime, stat.st_size, len(file['raw_video']), len(file['preprocessed_label']))
+            updated = True
+        rows[rel_path] = tuple(row)
+        file_index[file_name] = {'num_frame': int(row[2]), 'label_len': int(row[3])}
+
+    if updated:
+        rel_path = list(rows)
+        mtime, size, num_frame, label_len = zip(*rows.values())
+        tmp_path = index_path + ".tmp"
+        try:
+            with open(tmp_path, 'wb') as f:
+                np.savez(f, version=INDEX_VERSION, path=np.asarray(rel_path, dtype=str),
+                         mtime=np.asarray(mtime, dtype=np.float64), size=np.asarray(size, dtype=np.int64),
+                         num_frame=np.asarray(num_frame, dtype=np.int64),
+                         label_len=np.asarray(label_len, dtype=np.int64))
+            os.replace(tmp_path, index_path)
+        except OSError:
+            log_warning("cannot write dataset index : " + index_path)
+
+    return file_index
+
+
+def get_lazy_dataset(path, model_type, model_name, time_length, batch_size, overlap_interval, img_size,
+                     file_index=None):
+    """Build a dataset that indexes clips once and reads each window from the .hdf5 file on demand.
+
+    Args:
+      path: list of preprocessed .hdf5 files.
+      file_index: optional result of load_file_index, used instead of opening every file for its length.
+
+    Returns:
+      A drop-in equivalent of the in-memory dataset, or None if the model has no lazy dataset.
+    """
+    path = [file_name for file_name in path if os.path.isfile(file_name)]
+    num_frames = None
+    if file_index is not None and all(file_name in file_index for file_name in path):
+        num_frames = [file_index[file_name]['num_frame'] for file_name in path]
+
+    if model_type == 'DIFF':
+        return LazyDeepPhysDataset(path, model_name, time_length, batch_size, img_size, num_frames)
+    elif model_name in ["PhysFormer"]:
+        return LazyPhysFormerDataset(path, model_type, time_length, overlap_interval, img_size, num_frames)
+    elif model_type.__contains__('CONT') and model_name not in ["APNETv2", "EfficientPhys"]:
+        return LazyPhysNetDataset(path, model_type, time_length, overlap_interval, img_size, num_frames)
+    return None
+
+
+def get_dataset(path, model_type, model_name, time_length, batch_size, overlap_interval, img_size, eval_flag,
+                lazy_load=False, file_index=None):
+    if lazy_load:
+        dataset = get_lazy_dataset(path, model_type, model_name, time_length, batch_size, overlap_interval,
+                                   img_size, file_index)
+        if dataset is not None:
+            return dataset
+        log_warning("lazy_load is not supported for %s, loading the whole dataset into memory" % model_name)
+
     idx = 0
     round_flag = 0
     rst_dataset = None
@@ -358,11 +473,12 @@ def get_dataset(path, model_type, model_name, time_length, batch_size, overlap_i
             idx += 1
             file = h5py.File(file_name)
             # h5_tree(file)
+            raw_video = read_video(file)
             if model_type == 'DIFF':
-                num_frame, w, h, c = file['raw_video'][:].shape
+                num_frame, w, h, c = raw_video.shape
                 if model_name == "BigSmall":
                     for i in range(num_frame):
-                        img = file['raw_video'][i]
+                        img = raw_video[i]
                         appearance_data.append(cv2.resize(img[:, :, 3:], (144, 144), interpolation=cv2.INTER_AREA))
                         motion_data.append(cv2.resize(img[:, :, :3], (9, 9), interpolation=cv2.INTER_AREA))
 
@@ -370,13 +486,14 @@ def get_dataset(path, model_type, model_name, time_length, batch_size, overlap_i
                     new_shape = (num_frame, img_size, img_size, c)
                     resized_img = np.zeros(new_shape)
                     for i in range(num_frame):
-                        img = file['raw_video'][i]
+                        img = raw_video[i]
                         resized_img[i] = cv2.resize(img, (img_size, img_size))
                     appearance_data.extend(resized_img[:, :, :, -3:])
                     motion_data.extend(resized_img[:, :, :, :3])
                 else:
-                    appearance_data.extend(file['raw_video'][:, :, :, -3:])
-                    motion_data.extend(file['raw_video'][:, :, :, :3])
+                    video = raw_video[:]
+                    appearance_data.extend(video[:, :, :, -3:])
+                    motion_data.extend(video[:, :, :, :3])
 
                 temp_label = file['preprocessed_label']
                 # resample label data
@@ -398,8 +515,8 @@ def get_dataset(path, model_type, model_name, time_length, batch_size, overlap_i
                 end = time_length
                 label = detrend(file['preprocessed_label'], 100)
 
-                while end <= len(file['raw_video']):
-                    video_chunk = file['raw_video'][start:end]
+                while end <= len(raw_video):
+                    video_chunk = raw_video[start:end]
                     video_data.append(video_chunk)
                     keypoint_data.append(file['keypoint'][start:end])
                     tmp_label = label[start:end]
@@ -417,16 +534,16 @@ def get_dataset(path, model_type, model_name, time_length, batch_size, overlap_i
                 diff_norm_label = np.array(diff_norm_label)
                 diff_norm_label[np.isnan(diff_norm_label)] = 0
 
-                num_frame, w, h, c = file['raw_video'][:].shape
+                num_frame, w, h, c = raw_video.shape
                 if w != img_size and h != img_size:
                     new_shape = (num_frame, img_size, img_size, c)
                     resized_img = np.zeros(new_shape, dtype=np.float32)
                     for i in range(num_frame):
-                        img = file['raw_video'][i]  # / 255.
+                        img = raw_video[i]  # / 255.
                         resized_img[i] = cv2.resize(img, (img_size, img_size), interpolation=cv2.INTER_AREA)
                     diff_video = np.diff(resized_img, axis=0)
                 else:
-                    diff_video = np.diff(file['raw_video'][:], axis=0)
+                    diff_video = np.diff(raw_video[:], axis=0)
 
                 num_frame = ((num_frame - 1) // time_length) * time_length
                 label_data.extend(diff_norm_label[:num_frame])
@@ -438,7 +555,7 @@ def get_dataset(path, model_type, model_name, time_length, batch_size, overlap_i
                 # label = detrend(file['preprocessed_label'], 100)
                 label = file['preprocessed_label']
                 hr_label = file['hrv']
-                num_frame, w, h, c = file['raw_video'][:].shape
+                num_frame, w, h, c = raw_video.shape
 
                 if len(label) != num_frame:
                     label = np.interp(
@@ -451,7 +568,7 @@ def get_dataset(path, model_type, model_name, time_length, batch_size, overlap_i
                     if model_type.__contains__('RAW'):
                         resized_img = np.zeros(new_shape, dtype=np.uint8)
                         for i in range(num_frame):
-                            img = file['raw_video'][i] * 255
+                            img = raw_video[i] * 255
                             w, h, c = img.shape
                             w_m, h_m = w - round(w * 2/3), h - round(h * 2/3)
                             img = cv2.cvtColor(img.astype(np.uint8),cv2.COLOR_BGR2RGB)
@@ -459,14 +576,14 @@ def get_dataset(path, model_type, model_name, time_length, batch_size, overlap_i
                     else:
                         resized_img = np.zeros(new_shape, dtype=np.float32)
                         for i in range(num_frame):
-                            img = file['raw_video'][i]
+                            img = raw_video[i]
                             resized_img[i] = cv2.resize(img, (img_size, img_size), interpolation=cv2.INTER_AREA)
 
-                while end <= len(file['raw_video']):
+                while end <= len(raw_video):
                     if w != img_size:
                         video_chunk = resized_img[start:end]
                     else:
-                        video_chunk = file['raw_video'][start:end]
+                        video_chunk = raw_video[start:end]
                     if not model_type.__contains__('RAW'):
                         video_chunk = (video_chunk - np.mean(video_chunk)) / np.std(video_chunk)
                     # video_chunk = int(video_chunk*)
@@ -531,3 +648,62 @@ class ClipSampler(Sampler):
 
     def __len__(self):
         return len(self.data_source.tolist())
+
+
+class DevicePrefetcher:
+    """
+        Wraps a DataLoader and moves its batches to the target device.
+
+        Datasets return CPU tensors; on CUDA the next batch is copied from pinned memory on a side stream while
+        the current batch is being consumed. On CPU the batches are passed through unchanged.
+    """
+
+    def __init__(self, loader, device):
+        self.loader = loader
+        self.device = torch.device(device)
+        self.stream = torch.cuda.Stream(device=self.device) if self.device.type == 'cuda' else None
+
+    @property
+    def dataset(self):
+        return self.loader.dataset
+
+    def to_device(self, batch):
+        if torch.is_tensor(batch):
+            return batch.to(self.device, non_blocking=True)
+        elif isinstance(batch, (list, tuple)):
+            return type(batch)(self.to_device(b) for b in batch)
+        return batch
+
+    def record_stream(self, batch):
+        # tensors created on the side stream must not be freed while the main stream still uses them
+        if torch.is_tensor(batch):
+            batch.record_stream(torch.cuda.current_stream(self.device))
+        elif isinstance(batch, (list, tuple)):
+            for b in batch:
+                self.record_stream(b)
+
+    def preload(self, loader_iter):
+        try:
+            batch = next(loader_iter)
+        except StopIteration:
+            return None
+        with torch.cuda.stream(self.stream):
+            return self.to_device(batch)
+
+    def __iter__(self):
+        if self.stream is None:
+            for batch in self.loader:
+                yield self.to_device(batch)
+            return
+
+        loader_iter = iter(self.loader)
+        next_batch = self.preload(loader_iter)
+        while next_batch is not None:
+            torch.cuda.current_stream(self.device).wait_stream(self.stream)
+            batch = next_batch
+            self.record_stream(batch)
+            next_batch = self.preload(loader_iter)
+            yield batch
+
+    def __len__(self):
+        return len(self.loader)
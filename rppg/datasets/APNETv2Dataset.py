@@ -82,11 +82,9 @@ class APNETv2Dataset(Dataset):
 
         label_data = torch.tensor(label_data, dtype=torch.float32)
 
-        if torch.cuda.is_available():
-            forehead_data = forehead_data.to('cuda',dtype=torch.float32)
-            lcheek_data = lcheek_data.to('cuda',dtype=torch.float32)
-            rcheek_data = rcheek_data.to('cuda',dtype=torch.float32)
-            label_data = label_data.to('cuda',dtype=torch.float32)
+        forehead_data = forehead_data.to(dtype=torch.float32)
+        lcheek_data = lcheek_data.to(dtype=torch.float32)
+        rcheek_data = rcheek_data.to(dtype=torch.float32)
 
         return (forehead_data, lcheek_data, rcheek_data), label_data
 
@@ -17,10 +17,6 @@ class ETArPPGNetDataset(Dataset):
         video_data = torch.tensor(np.transpose(self.video_data[index], (0, 4, 1, 2, 3)), dtype=torch.float32)
         label_data = torch.tensor(self.label[index], dtype=torch.float32)
 
-        if torch.cuda.is_available():
-            video_data = video_data.to('cuda')
-            label_data = label_data.to('cuda')
-
         return video_data, label_data
 
     def __len__(self):
@@ -17,10 +17,6 @@ class EfficientPhysDataset(Dataset):
         video_data = torch.tensor(np.transpose(self.video_data[index], (2, 0, 1)), dtype=torch.float32)
         label_data = torch.tensor(self.label_data[index], dtype=torch.float32)
 
-        if torch.cuda.is_available():
-            video_data = video_data.to('cuda')
-            label_data = label_data.to('cuda')
-
         return video_data, label_data
 
     def __len__(self):
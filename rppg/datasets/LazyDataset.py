@@ -0,0 +1,210 @@
+import os
+
+import cv2
+import h5py
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+
+from rppg.utils.h5_storage import read_video
+
+# per-file chunk cache, large enough to keep a compressed time_length chunk decoded between frame reads
+CHUNK_CACHE_BYTES = 64 * 1024 ** 2
+
+class LazyH5Dataset(Dataset):
+    """
+        Base class for datasets that read preprocessed .hdf5 files on demand.
+
+        Only a (file, start) index is kept in memory; the video window of a sample is read from an h5py
+        handle that is opened lazily in each DataLoader worker, so memory does not grow with the corpus.
+    """
+
+    def __init__(self, path, clip_length, clip_step, img_size, num_frames=None):
+        self.path = list(path)
+        self.clip_length = clip_length
+        self.clip_step = clip_step
+        self.img_size = img_size
+
+        if num_frames is None:
+            num_frames = [self.count_frames(file_name) for file_name in self.path]
+        num_clips = np.asarray([self.clips_in(num_frame) for num_frame in num_frames], dtype=np.int64)
+        self.offsets = np.cumsum(num_clips)
+
+        self._pid = None
+        self._files = {}
+        self._videos = {}
+        self._labels = {}
+
+    @staticmethod
+    def count_frames(file_name):
+        with h5py.File(file_name, 'r') as file:
+            return len(file['raw_video'])
+
+    def clips_in(self, num_frame):
+        raise NotImplementedError
+
+    def locate(self, index):
+        # global sample index -> (file index, first frame of the sample)
+        file_idx = int(np.searchsorted(self.offsets, index, side='right'))
+        local_idx = index - (self.offsets[file_idx - 1] if file_idx > 0 else 0)
+        return file_idx, int(local_idx) * self.clip_step
+
+    def get_file(self, file_idx):
+        # h5py handles must not be shared across processes, reopen them in every worker
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._files = {}
+            self._videos = {}
+            self._labels = {}
+        if file_idx not in self._files:
+            self._files[file_idx] = h5py.File(self.path[file_idx], 'r', rdcc_nbytes=CHUNK_CACHE_BYTES)
+        return self._files[file_idx]
+
+    def get_video(self, file_idx):
+        # raw_video of the file, decoded from its storage dtype on read
+        file = self.get_file(file_idx)
+        if file_idx not in self._videos:
+            self._videos[file_idx] = read_video(file)
+        return self._videos[file_idx]
+
+    def get_label(self, file_idx):
+        if file_idx not in self._labels:
+            file = self.get_file(file_idx)
+            num_frame = len(file['raw_video'])
+            label = file['preprocessed_label'][:]
+            # resample label data
+            if len(label) != num_frame:
+                label = np.interp(
+                    np.linspace(
+                        1, len(label), num_frame), np.linspace(
+                        1, len(label), len(label)), label)
+            self._labels[file_idx] = label
+        return self._labels[file_idx]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['_pid'] = None
+        state['_files'] = {}
+        state['_videos'] = {}
+        state['_labels'] = {}
+        return state
+
+    def __del__(self):
+        for file in self.__dict__.get('_files', {}).values():
+            try:
+                file.close()
+            except Exception:
+                pass
+
+    def __len__(self):
+        return int(self.offsets[-1]) if len(self.offsets) else 0
+
+
+class LazyDeepPhysDataset(LazyH5Dataset):
+    """
+        Drop-in equivalent of DeepPhysDataset. One sample is one frame of a DIFF preprocessed video.
+    """
+
+    def __init__(self, path, model_name, time_length, batch_size, img_size, num_frames=None):
+        self.model_name = model_name
+        self.frame_unit = time_length * batch_size
+        super(LazyDeepPhysDataset, self).__init__(path, clip_length=1, clip_step=1, img_size=img_size,
+                                                  num_frames=num_frames)
+
+    def clips_in(self, num_frame):
+        return (num_frame // self.frame_unit) * self.frame_unit
+
+    def __getitem__(self, index):
+        if torch.is_tensor(index):
+            index = index.tolist()
+
+        file_idx, frame_idx = self.locate(index)
+        img = self.get_video(file_idx)[frame_idx]
+        w = img.shape[0]
+
+        if self.model_name == "BigSmall":
+            appearance = cv2.resize(img[:, :, 3:], (144, 144), interpolation=cv2.INTER_AREA)
+            motion = cv2.resize(img[:, :, :3], (9, 9), interpolation=cv2.INTER_AREA)
+        else:
+            if w != self.img_size:
+                img = cv2.resize(img, (self.img_size, self.img_size))
+            appearance = img[:, :, -3:]
+            motion = img[:, :, :3]
+
+        appearance_data = torch.tensor(np.transpose(appearance, (2, 0, 1)), dtype=torch.float32)
+        motion_data = torch.tensor(np.transpose(motion, (2, 0, 1)), dtype=torch.float32)
+        target = torch.tensor(self.get_label(file_idx)[frame_idx:frame_idx + 1], dtype=torch.float32)
+
+        return (appearance_data, motion_data), target
+
+
+class LazyPhysNetDataset(LazyH5Dataset):
+    """
+        Drop-in equivalent of PhysNetDataset. One sample is a window of time_length frames of a CONT video.
+    """
+
+    def __init__(self, path, model_type, time_length, overlap_interval, img_size, num_frames=None):
+        self.raw = model_type.__contains__('RAW')
+        super(LazyPhysNetDataset, self).__init__(path, clip_length=time_length,
+                                                 clip_step=time_length - overlap_interval, img_size=img_size,
+                                                 num_frames=num_frames)
+
+    def clips_in(self, num_frame):
+        if num_frame < self.clip_length:
+            return 0
+        return (num_frame - self.clip_length) // self.clip_step + 1
+
+    def read_clip(self, file_idx, start):
+        video_chunk = self.get_video(file_idx)[start:start + self.clip_length]
+        num_frame, w, h, c = video_chunk.shape
+
+        if w != self.img_size and h != self.img_size:
+            if self.raw:
+                resized_img = np.zeros((num_frame, self.img_size, self.img_size, c), dtype=np.uint8)
+                w_m, h_m = w - round(w * 2 / 3), h - round(h * 2 / 3)
+                for i in range(num_frame):
+                    img = cv2.cvtColor((video_chunk[i] * 255).astype(np.uint8), cv2.COLOR_BGR2RGB)
+                    resized_img[i] = cv2.resize(img[w_m // 2:-w_m // 2, h_m // 2:-h_m // 2],
+                                                (self.img_size, self.img_size), interpolation=cv2.INTER_AREA)
+            else:
+                resized_img = np.zeros((num_frame, self.img_size, self.img_size, c), dtype=np.float32)
+                for i in range(num_frame):
+                    resized_img[i] = cv2.resize(video_chunk[i], (self.img_size, self.img_size),
+                                                interpolation=cv2.INTER_AREA)
+            video_chunk = resized_img
+
+        if not self.raw:
+            video_chunk = (video_chunk - np.mean(video_chunk)) / np.std(video_chunk)
+        return video_chunk
+
+    def __getitem__(self, index):
+        if torch.is_tensor(index):
+            index = index.tolist()
+
+        file_idx, start = self.locate(index)
+        video_chunk = (self.read_clip(file_idx, start) - 0.5) * 2
+
+        video_data = torch.tensor(np.transpose(video_chunk, (3, 0, 1, 2)), dtype=torch.float32)
+        label_data = torch.tensor(self.get_label(file_idx)[start:start + self.clip_length], dtype=torch.float32)
+
+        return video_data, label_data
+
+
+class LazyPhysFormerDataset(LazyPhysNetDataset):
+    """
+        Drop-in equivalent of PhysFormerDataset, additionally returns the clipped average HR of the window.
+    """
+
+    def __getitem__(self, index):
+        if torch.is_tensor(index):
+            index = index.tolist()
+
+        file_idx, start = self.locate(index)
+        video_chunk = (self.read_clip(file_idx, start) - 0.5) * 2
+        average_hr = np.clip(self.get_file(file_idx)['hrv'][start:start + self.clip_length].mean(), 40., 180.) - 40.
+
+        video_data = torch.tensor(np.transpose(video_chunk, (3, 0, 1, 2)), dtype=torch.float32)
+        label_data = torch.tensor(self.get_label(file_idx)[start:start + self.clip_length], dtype=torch.float32)
+        average_hr = torch.tensor(average_hr, dtype=torch.float32)
+
+        return video_data, label_data, average_hr
@@ -28,11 +28,6 @@ class PhysFormerDataset(Dataset):
         label_data = torch.tensor(self.label_data[idx], dtype=torch.float32)
         average_hr = torch.tensor(self.average_hr[idx], dtype=torch.float32)
 
-        if torch.cuda.is_available():
-            video_data = video_data.to('cuda')
-            label_data = label_data.to('cuda')
-            average_hr = average_hr.to('cuda')
-
         return video_data, label_data, average_hr
 
     def __len__(self):
@@ -18,10 +18,6 @@ class PhysNetDataset(Dataset):
         video_data = torch.tensor(np.transpose(self.video_data[index], (3, 0, 1, 2)), dtype=torch.float32)
         label_data = torch.tensor(self.label_data[index], dtype=torch.float32)
 
-        if torch.cuda.is_available():
-            video_data = video_data.to('cuda')
-            label_data = label_data.to('cuda')
-
         # label_data = (label_data - torch.mean(label_data)) / torch.std(label_data)
 
         return video_data, label_data
@@ -26,8 +26,4 @@ class RhythmNetDataset(Dataset):
         # maps = torch.tensor(self.st_map_data[index], dtype=torch.float32)
         target_data = torch.tensor(self.target_data[index], dtype=torch.float32)
 
-        if torch.cuda.is_available():
-            st_map_data = maps.to('cuda')
-            target_data = target_data.to('cuda')
-
-        return st_map_data, target_data
+        return maps, target_data
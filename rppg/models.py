@@ -1,6 +1,7 @@
 import torchinfo
 
 from rppg.log import log_warning, log_info
+from rppg.utils.funcs import get_device
 # DNN Method
 # from nets.models.AxisNet import AxisNet, PhysiologicalGenerator
 from rppg.nets.DeepPhys import DeepPhys
@@ -95,7 +96,7 @@ def get_model(fit_cfg):
         log_warning("pls implemented model")
         raise NotImplementedError("implement a custom model(%s)" % model_name)
 
-    return model.cuda()
+    return model.to(get_device(fit_cfg.device))
 
 
 def summary(model_name, model):
@@ -1,23 +1,11 @@
 import torch
-import numpy as np
-from scipy import signal
+from rppg.utils.funcs import BPF_torch
 
 def overlap_frames(data, window_size, overlap_ratio):
+    # (B, seq_len, C) -> every window of window_size frames of the flattened sequence, hop of seq_len * overlap_ratio
     batch_size, seq_len, channels = data.size()
-    new_seq_len = int((batch_size*seq_len)//(seq_len*overlap_ratio) -1)
-
-    overlapped_data = torch.zeros(new_seq_len, window_size, channels, dtype=data.dtype, device=data.device)
-
-    data = data.view(-1,3)
-
-    start_idx = 0
     overlapped_window = int(seq_len*overlap_ratio)
-    for i in range(new_seq_len):
-        end_idx = start_idx + seq_len
-        overlapped_data[i] = data[start_idx:end_idx]
-        start_idx += overlapped_window
-
-    return overlapped_data
+    return data.reshape(-1, channels).unfold(0, window_size, overlapped_window).transpose(1, 2)
 
 class CHROM(torch.nn.Module):
     def __init__(self):
@@ -29,8 +17,8 @@ class CHROM(torch.nn.Module):
         FS = 30
         niq = 1.2* FS
 
-        self.B,self.A = signal.butter(3, [self.LPF/niq,self.HPF/niq], 'bandpass')
-        self.interval = int((FS*self.WinSec) *self.overlap)
+        # butter(3, [LPF / niq, HPF / niq]), BPF_torch normalizes the band edges by fs / 2
+        self.filter_fs = 2 * niq
     def forward(self, batch_x):
 
         batch_x = torch.permute(batch_x,(0,2,1,3,4))
@@ -40,35 +28,27 @@ class CHROM(torch.nn.Module):
         batch_x = torch.mean(batch_x, dim=[3,4])
 
         batch_size_org, window,_ = batch_x.shape
-        bvp = torch.zeros(batch_size_org*window)
+        hop = int(window*self.overlap)
         batch_x = overlap_frames(batch_x,window,self.overlap)
 
         RGBBase = torch.mean(batch_x, axis=1, keepdim=True)
-        RGBNorm = torch.true_divide(batch_x,RGBBase)
+        RGBNorm = torch.true_divide(batch_x,RGBBase).double()
 
         #BGR
 
         batch_size_overlapped, N, num_features = batch_x.shape
-        self.m = signal.windows.hann(N)
-        for b in range(batch_size_overlapped):
-            X = RGBNorm[b]
-            Xcomp = 3*X[:, 0] - 2*X[:, 1]
-            Ycomp = (1.5*X[:, 0])+X[:, 1]-(1.5*X[:, 1])
-            Xcomp = Xcomp.cpu().detach().numpy()
-            Xcomp = torch.from_numpy(
-                signal.filtfilt(self.B, self.A, Xcomp, axis=0).copy())
-
-            Ycomp = Ycomp.cpu().detach().numpy()
-            Ycomp = torch.from_numpy(signal.filtfilt(self.B, self.A, Ycomp).copy())
-
-            sX = torch.std(Xcomp)
-            sY = torch.std(Ycomp)
-            alpha = sX/sY
-            Swin = Xcomp - Ycomp * alpha
-            Swin = Swin * self.m
-            # bvp.append(Swin)
-            bvp[b*self.interval:(b+1)*self.interval] = bvp[b*self.interval:(b+1)*self.interval] + Swin[:self.interval]
-            bvp[(b+1) * self.interval:(b + 2) * self.interval] = Swin[self.interval:]
-        # bvp = torch.cat(bvp)
+        Xcomp = 3*RGBNorm[:, :, 0] - 2*RGBNorm[:, :, 1]
+        Ycomp = (1.5*RGBNorm[:, :, 0])+RGBNorm[:, :, 1]-(1.5*RGBNorm[:, :, 1])
+        XYcomp = BPF_torch(torch.cat((Xcomp, Ycomp), dim=0), self.filter_fs, self.LPF, self.HPF, order=3)
+        Xcomp, Ycomp = XYcomp[:batch_size_overlapped], XYcomp[batch_size_overlapped:]
+
+        alpha = torch.std(Xcomp, dim=-1, keepdim=True)/torch.std(Ycomp, dim=-1, keepdim=True)
+        Swin = Xcomp - Ycomp * alpha
+        Swin = Swin * torch.hann_window(N, periodic=False, dtype=Swin.dtype, device=Swin.device)
+
+        # overlap-add of the windows
+        bvp = torch.nn.functional.fold(Swin.T.unsqueeze(0), output_size=(1, (batch_size_overlapped - 1) * hop + N),
+                                       kernel_size=(1, N), stride=(1, hop)).view(-1)
+        bvp = torch.nn.functional.pad(bvp, (0, batch_size_org * window - len(bvp))).float()
         bvp = bvp.view(batch_size_org,-1)
         return bvp
@@ -1,34 +1,39 @@
 import torch
-from rppg.utils.funcs import detrend
-from scipy import linalg
-from scipy import signal
+from rppg.utils.funcs import detrend_torch, BPF_torch
 import math
-#TODO : need to modify
+
 class ICA(torch.nn.Module):
     def __init__(self):
         super(ICA, self).__init__()
 
         self.LPF = 0.7
         self.HPF = 2.5
-        fs = 30
-        self.nf = 1/2 * fs
+        self.fs = 30
+        self.nf = 1/2 * self.fs
 
 
     def forward(self,x):
-        x = torch.permute(x, (0,2,3,4,1)).cpu()
-        batch, _, _, _, _ = x.shape
-        x = torch.mean(x,dim=(2,3))
-
-        BGRNorm = torch.zeros_like(x)
-
-        for b in range(batch):
-            for c in range(3):
-                BGRDetrend = torch.Tensor(detrend(x[b,:,c],100))
-                BGRNorm[b,:,c] = (BGRDetrend - torch.mean(BGRDetrend))/ torch.std(BGRDetrend)
-        self.ica(BGRNorm.permute(0,2,1),3)
-
-
-        return x
+        x = torch.permute(x, (0,2,3,4,1))
+        batch, T, _, _, _ = x.shape
+        x = torch.mean(x,dim=(2,3))  # (B, T, C)
+
+        # detrend and standardize every (batch, channel) trace at once
+        BGRDetrend = detrend_torch(x.permute(0,2,1).reshape(batch * 3, T).double(), 100).view(batch, 3, T)
+        BGRNorm = (BGRDetrend - torch.mean(BGRDetrend, dim=-1, keepdim=True)) / \
+                  torch.std(BGRDetrend, dim=-1, keepdim=True)
+        _, S = self.ica(BGRNorm, 3)  # S : (B, 3, T)
+
+        # select the component with the largest normalized power peak in the cardiac band
+        Px = torch.abs(torch.fft.rfft(S, dim=-1)[:, :, 1:]) ** 2
+        Px = Px / torch.sum(Px, dim=-1, keepdim=True)
+        Fx = torch.fft.rfftfreq(T, d=1 / self.fs, device=x.device)[1:]
+        band = (Fx >= self.LPF) & (Fx <= self.HPF)
+        MaxPx = torch.max(torch.where(band, Px, 0.), dim=-1)[0]
+        MaxComp = torch.argmax(MaxPx, dim=-1)
+        BVP_I = S[torch.arange(batch, device=x.device), MaxComp]
+
+        BVP_F = BPF_torch(BVP_I, self.fs, self.LPF, self.HPF, order=3)
+        return BVP_F.to(x.dtype)
 
     def ica(self, X, Nsources, Wprev=0):
         nRows = X.shape[1]
@@ -51,107 +56,82 @@ class ICA(torch.nn.Module):
 
 
     def jade(self, X, m, Wprev):
-        def givens_rotation(a, b):
-            r = torch.sqrt(a * a + b * b)
-            c = a / r
-            s = b / r
-            return c, s
-
-        batch_size = X.shape[0]
-        T = X.shape[2]
+        """
+        Batched real JADE (Cardoso), X : (B, n, T) observations -> mixing matrices A (B, n, m) and sources S (B, m, T).
+        Every batch element is rotated by its own Givens angles; converged elements get the identity rotation.
+        """
+        batch_size, n, T = X.shape
         nem = m
         seuil = 1 / math.sqrt(T) / 100
-        if m < X.shape[1]:
-            D, U = torch.linalg.eigh(torch.matmul(X, X.transpose(1, 2)) / T)
-            Diag = D[:, -1]
-            k = torch.argsort(Diag)
-            pu = Diag[k]
-            ibl = torch.sqrt(
-                pu[:, X.shape[1] - m:X.shape[1]] - torch.mean(pu[:, 0:X.shape[1] - m], dim=1, keepdim=True))
-            bl = torch.reciprocal(ibl)
-            W = torch.matmul(torch.diag_embed(bl), U[:, :, k[X.shape[1] - m:X.shape[1]]].transpose(1, 2))
-            IW = torch.matmul(U[:, :, k[X.shape[1] - m:X.shape[1]]], torch.diag_embed(ibl))
+
+        # whitening
+        D, U = torch.linalg.eigh(torch.matmul(X, X.transpose(1, 2)) / T)
+        if m < n:
+            # keep the m principal directions, the noise level is the mean of the discarded eigenvalues
+            pu = D[:, n - m:]
+            ibl = torch.sqrt(pu - torch.mean(D[:, :n - m], dim=1, keepdim=True))
+            W = torch.matmul(torch.diag_embed(1 / ibl), U[:, :, n - m:].transpose(1, 2))
+            IW = torch.matmul(U[:, :, n - m:], torch.diag_embed(ibl))
         else:
-            IW = torch.sqrt(torch.matmul(X, torch.transpose(X, 1, 2)) / T)
+            # IW = sqrtm(X X^T / T)
+            IW = torch.matmul(U * torch.sqrt(D).unsqueeze(1), U.transpose(1, 2))
             W = torch.linalg.inv(IW)
 
         Y = torch.matmul(W, X)
         R = torch.matmul(Y, Y.transpose(1, 2)) / T
-        C = torch.matmul(Y, Y.transpose(1, 2)) / T
-        Q = torch.zeros((batch_size, m * m * m * m), device=X.device, dtype=X.dtype)
-        index = 0
-
-        for lx in range(m):
-            Y1 = Y[:, lx, :]
-            for kx in range(m):
-                Yk1 = Y1 * torch.conj(Y[:, kx, :])
-                for jx in range(m):
-                    Yjk1 = Yk1 * torch.conj(Y[:, jx, :])
-                    for ix in range(m):
-                        Q[:, index] = torch.sum(Yjk1 / math.sqrt(T) * Y[:, ix, :].transpose(0, 1) / math.sqrt(T),
-                                                dim=1) - R[:, ix, jx] * R[:, lx, kx] - R[:, ix, kx] * R[:, lx, jx] - C[
-                                                                                                                     :,
-                                                                                                                     ix,
-                                                                                                                     lx] * torch.conj(
-                            C[:, jx, kx])
-                        index += 1
+
+        # fourth order cumulants Q[i, j, k, l] = E[yi yj yk yl] - Rij Rkl - Rik Rjl - Ril Rjk
+        Q = torch.einsum('bit,bjt,bkt,blt->bijkl', Y, Y, Y, Y) / T \
+            - torch.einsum('bij,bkl->bijkl', R, R) \
+            - torch.einsum('bik,bjl->bijkl', R, R) \
+            - torch.einsum('bil,bjk->bijkl', R, R)
 
         # Compute and Reshape the significant Eigen
-        D, U = torch.linalg.eigh(Q.view(batch_size, m * m, m * m))
-        Diag = torch.abs(D[:, :, -1])
-        K = torch.argsort(Diag, dim=-1)
+        D, U = torch.linalg.eigh(Q.reshape(batch_size, m * m, m * m))
+        K = torch.argsort(torch.abs(D), dim=-1, descending=True)[:, :nem]
         la = D.gather(dim=-1, index=K)
-        M = torch.zeros((batch_size, m, nem * m), dtype=X.dtype, device=X.device)
-        Z = torch.zeros((batch_size, m), dtype=X.dtype, device=X.device)
-        h = m * m - 1
-        for u in range(0, nem * m, m):
-            Z = U[:, :, K[:, :, h]].view(batch_size, m, m)
-            M[:, :, u:u + m] = la[:, :, h].unsqueeze(-1) * Z
-            h = h - 1
+        Z = U.gather(dim=-1, index=K.unsqueeze(1).expand(-1, m * m, -1))  # (B, m*m, nem)
+        M = (la.unsqueeze(1) * Z).view(batch_size, m, m, nem).permute(0, 1, 3, 2).reshape(batch_size, m, nem * m)
 
         # Approximate the Diagonalization of the Eigen Matrices:
-        B = torch.tensor([[1, 0, 0], [0, 1, 1], [0, 0, -1j, 0, 1j]], dtype=X.dtype, device=X.device)
-        Bt = B.transpose(0, 1)
-
-        encore = torch.ones(batch_size, dtype=torch.bool, device=X.device)
-        if Wprev == 0:
-            V = torch.eye(m, dtype=X.dtype, device=X.device).unsqueeze(0).repeat(batch_size, 1, 1)
+        if isinstance(Wprev, torch.Tensor):
+            V = torch.linalg.inv(Wprev).to(X.dtype)
         else:
-            V = torch.linalg.inv(Wprev)
+            V = torch.eye(m, dtype=X.dtype, device=X.device).unsqueeze(0).repeat(batch_size, 1, 1)
 
         # Main Loop:
-        while encore.any():
-            encore = torch.zeros(batch_size, dtype=torch.bool, device=X.device)
+        encore = True
+        while encore:
+            encore = False
             for p in range(m - 1):
                 for q in range(p + 1, m):
-                    Ip = torch.arange(p, nem * m, m)
-                    Iq = torch.arange(q, nem * m, m)
-                    g = torch.stack([M[:, p, Ip] - M[:, q, Iq], M[:, p, Iq], M[:, q, Ip]], dim=-1)
-                    temp1 = torch.sum(g.unsqueeze(2) * g.unsqueeze(3), dim=-1)
-                    temp2 = torch.matmul(B, temp1)
-                    temp = torch.matmul(temp2, Bt)
-                    D, vcp = torch.linalg.eigh(torch.real(temp))
-                    K = torch.argsort(D, dim=-1)
-                    la = D.gather(dim=-1, index=K)
-                    angles = vcp.gather(dim=-1, index=K)[:, :, :, -1]
-                    angles = torch.where(angles[:, 0, 0] < 0, -angles, angles)
-                    c, s = givens_rotation(angles[:, 0, 0], angles[:, 1, 0])
-
-                    mask = torch.abs(s) > seuil
-                    if mask.any():
-                        encore = encore | mask
-                        pair = [p, q]
-                        G = torch.stack([[c, -torch.conj(s)], [s, c]], dim=-1).unsqueeze(0)  # Givens Rotation
-                        V[:, :, pair] = torch.matmul(V[:, :, pair], G)
-                        M[:, pair, :] = torch.matmul(torch.conj(G.transpose(2, 3)), M[:, pair, :])
-                        temp1 = c.unsqueeze(-1) * M[:, :, Ip] + s.unsqueeze(-1) * M[:, :, Iq]
-                        temp2 = -torch.conj(s).unsqueeze(-1) * M[:, :, Ip] + c.unsqueeze(-1) * M[:, :, Iq]
-                        temp = torch.cat((temp1, temp2), dim=-1)
-                        M[:, :, Ip] = temp1
-                        M[:, :, Iq] = temp2
+                    Ip = torch.arange(p, nem * m, m, device=X.device)
+                    Iq = torch.arange(q, nem * m, m, device=X.device)
+
+                    # computation of Givens angle
+                    g = torch.stack([M[:, p, Ip] - M[:, q, Iq], M[:, p, Iq] + M[:, q, Ip]], dim=1)
+                    gg = torch.matmul(g, g.transpose(1, 2))
+                    ton = gg[:, 0, 0] - gg[:, 1, 1]
+                    toff = gg[:, 0, 1] + gg[:, 1, 0]
+                    theta = 0.5 * torch.atan2(toff, ton + torch.sqrt(ton * ton + toff * toff))
+                    theta = torch.where(torch.abs(theta) > seuil, theta, torch.zeros_like(theta))
+                    if not torch.any(theta != 0):
+                        continue
+                    encore = True
+
+                    # Givens update
+                    c = torch.cos(theta).view(-1, 1, 1)
+                    s = torch.sin(theta).view(-1, 1, 1)
+                    G = torch.cat([torch.cat([c, -s], dim=-1), torch.cat([s, c], dim=-1)], dim=1)  # Givens Rotation
+                    pair = [p, q]
+                    V[:, :, pair] = torch.matmul(V[:, :, pair], G)
+                    M[:, pair, :] = torch.matmul(G.transpose(1, 2), M[:, pair, :])
+                    Mp, Mq = M[:, :, Ip], M[:, :, Iq]
+                    M[:, :, Ip] = c * Mp + s * Mq
+                    M[:, :, Iq] = -s * Mp + c * Mq
 
         # Whiten the Matrix
         # Estimation of the Mixing Matrix and Signal Separation
         A = torch.matmul(IW, V)
-        S = torch.matmul(torch.conj(V.transpose(1, 2)), Y)
+        S = torch.matmul(V.transpose(1, 2), Y)
         return A, S
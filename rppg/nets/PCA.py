@@ -1,5 +1,4 @@
 import torch
-from sklearn.decomposition import PCA as skpca
 
 class PCA(torch.nn.Module):
     def __init__(self):
@@ -7,13 +6,17 @@ class PCA(torch.nn.Module):
 
 
     def forward(self,x):
-        batch, _, _, _, _ = x.shape
-        x = torch.mean(x,dim=(3,4))
-        bvp = []
-        for i in range(batch):
-            X = x[i]
-            pca = skpca(n_components=3)
-            pca.fit(X.cpu().numpy())
-            bvp.append(torch.from_numpy(pca.components_[1] * pca.explained_variance_[1]).to(x.device))
-        bvp = torch.stack(bvp)
-        return bvp
\ No newline at end of file
+        x = torch.mean(x,dim=(3,4))  # (B, C, T), the C channels are the samples of the PCA
+        n_samples = x.shape[1]
+        X = x - torch.mean(x, dim=1, keepdim=True)
+
+        # principal axes from the (B, C, C) gram matrices, ascending eigenvalues
+        L, U = torch.linalg.eigh(torch.matmul(X, X.transpose(1, 2)))
+        L, u = L[:, -2], U[:, :, -2]  # second component
+
+        component = torch.matmul(u.unsqueeze(1), X).squeeze(1) / torch.sqrt(L).unsqueeze(-1)
+        explained_variance = L / (n_samples - 1)
+        # sign convention of sklearn's svd_flip: the largest absolute entry of a component is positive
+        sign = torch.sign(component.gather(-1, torch.argmax(torch.abs(component), dim=-1, keepdim=True)))
+        bvp = sign * component * explained_variance.unsqueeze(-1)
+        return bvp
@@ -1,7 +1,5 @@
 import torch
-from rppg.utils.funcs import detrend
-from scipy import signal
-import numpy as np
+from rppg.utils.funcs import detrend_torch, BPF_torch
 
 class POS(torch.nn.Module):
     def __init__(self):
@@ -16,29 +14,23 @@ class POS(torch.nn.Module):
         x = torch.mean(x, dim=(3, 4))
 
         batch_size, N, num_features = x.shape
-        H = torch.zeros(batch_size, 1, N).to("cuda")
-
-        for b in range(batch_size):
-            RGB = x[b]  # Assume RGB preprocessing already done
-            N = RGB.shape[0]
-            l = int(self.fs * self.WinSec)#math.ceil(WinSec * fs)
-
-            for n in range(N):
-                m = n - l
-                if m >= 0:
-                    Cn = RGB[m:n, :] / torch.mean(RGB[m:n, :], dim=0)
-                    Cn = torch.transpose(Cn, 0, 1)
-                    S = torch.matmul(torch.tensor([[0, 1, -1], [-2, 1, 1]], dtype=torch.float).to("cuda"), Cn)
-                    h = S[0, :] + (torch.std(S[0, :]) / torch.std(S[1, :])) * S[1, :]
-                    mean_h = torch.mean(h)
-                    h = h - mean_h
-                    H[b, 0, m:n] = H[b, 0, m:n] + h
-
-        BVP = H.cpu().numpy()
-        BVP = BVP.squeeze()
-        b, a = signal.butter(1, [0.75 / self.fs * 2, 3 / self.fs * 2], btype='bandpass')
-        for i in range(len(BVP)):
-            BVP[i] = detrend(BVP[i], 100)
-            BVP[i] = signal.filtfilt(b, a, BVP[i].astype(np.double))
-        BVP = torch.from_numpy(BVP.copy()).view(batch_size, -1)
-        return BVP
\ No newline at end of file
+        l = int(self.fs * self.WinSec)#math.ceil(WinSec * fs)
+        if N <= l:
+            # no complete window, the pulse stays zero
+            return torch.zeros(batch_size, N, dtype=x.dtype, device=x.device)
+        P = torch.tensor([[0, 1, -1], [-2, 1, 1]], dtype=x.dtype, device=x.device)
+
+        # every window RGB[m:m + l] for m in [0, N - l), as (B, N - l, C, l)
+        Cn = x.unfold(1, l, 1)[:, :-1]
+        Cn = Cn / torch.mean(Cn, dim=-1, keepdim=True)
+        S = torch.matmul(P, Cn)  # (B, N - l, 2, l)
+        h = S[:, :, 0] + (torch.std(S[:, :, 0], dim=-1, keepdim=True) /
+                          torch.std(S[:, :, 1], dim=-1, keepdim=True)) * S[:, :, 1]
+        h = h - torch.mean(h, dim=-1, keepdim=True)
+
+        # overlap-add of the windows, the last frame is never covered
+        H = torch.nn.functional.fold(h.transpose(1, 2), output_size=(1, N - 1), kernel_size=(1, l))
+        H = torch.nn.functional.pad(H.view(batch_size, N - 1), (0, 1))
+
+        BVP = BPF_torch(detrend_torch(H, 100), self.fs, 0.75, 3, order=1)
+        return BVP
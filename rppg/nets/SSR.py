@@ -13,65 +13,46 @@ class SSR(nn.Module):
     def __init__(self):
         super(SSR, self).__init__()
 
-    def __build_p(self,τ, k, l, U, Λ):
+    def __build_p(self, l, U, Λ):
         """
-        builds P
+        builds P for every window [τ, τ + l) of every batch element at once
         Parameters
         ----------
-        k: int
-            The frame index
         l: int
             The temporal stride to use
-        U: torch.Tensor
-            The eigenvectors of the c matrix (for all frames up to counter).
-        Λ: torch.Tensor
-            The eigenvalues of the c matrix (for all frames up to counter).
+        U: torch.Tensor | dim: Bx3x3xK
+            The eigenvectors of the c matrix (for all frames).
+        Λ: torch.Tensor | dim: Bx3xK
+            The eigenvalues of the c matrix (for all frames).
         Returns
         -------
-        p: torch.Tensor
-            The p signal to add to the pulse.
+        p: torch.Tensor | dim: Bx(K-l)xl
+            The p signals to add to the pulse, one per window start τ.
         """
-        # SR'
-        SR = torch.zeros((U.size(0), l), dtype=U.dtype, device=U.device)  # dim: 3xl
-        z = 0
-
-        for t in range(τ, k, 1):  # 6, 7
-            a = Λ[0, t]
-            b = Λ[1, τ]
-            c = Λ[2, τ]
-            d = U[:, 0, t]
-            e = U[:, 1, τ]
-            f = U[:, 2, τ]
-            g = U[:, 1, τ]
-            h = U[:, 2, τ]
-            x1 = a / b
-            x2 = a / c
-            x3 = e.unsqueeze(1) * g.unsqueeze(0)
-            x4 = torch.matmul(d, x3.unsqueeze(-1)).squeeze(-1)
-            x5 = f.unsqueeze(1) * h.unsqueeze(0)
-            x6 = torch.matmul(d, x5.unsqueeze(-1)).squeeze(-1)
-            x7 = torch.sqrt(x1)
-            x8 = torch.sqrt(x2)
-            x9 = x7 * x4
-            x10 = x8 * x6
-            x11 = x9 + x10
-            SR[:, z] = x11  # 8 | dim: 3
-            z += 1
+        # windows over t = τ .. τ + l - 1, for τ = 0 .. K - l - 1
+        a = Λ[:, 0].unfold(-1, l, 1)[:, :-1]  # dim: Bx(K-l)xl
+        d = U[:, :, 0].unfold(-1, l, 1)[:, :, :-1]  # dim: Bx3x(K-l)xl
+        b = Λ[:, 1, :-l].unsqueeze(-1)  # dim: Bx(K-l)x1
+        c = Λ[:, 2, :-l].unsqueeze(-1)
+        e = U[:, :, 1, :-l].unsqueeze(-1)  # dim: Bx3x(K-l)x1
+        f = U[:, :, 2, :-l].unsqueeze(-1)
+
+        # SR' = sqrt(a / b) * u1 u1^T d + sqrt(a / c) * u2 u2^T d
+        SR = torch.sqrt(a / b).unsqueeze(1) * e * torch.sum(e * d, dim=1, keepdim=True) + \
+             torch.sqrt(a / c).unsqueeze(1) * f * torch.sum(f * d, dim=1, keepdim=True)  # 8 | dim: Bx3x(K-l)xl
 
         # build p and add it to the final pulse signal
-        s0 = SR[0, :]  # dim: l
-        s1 = SR[1, :]  # dim: l
-        p = s0 - ((torch.std(s0) / torch.std(s1)) * s1)  # 10 | dim: l
-        p = p - torch.mean(p)  # 11
-        return p  # dim: l
-
-    def __build_correlation_matrix(self,V):
-        # V dim: (W×H)x3
-        V = V.view(-1,3)
-        V_T = V.transpose(0, 1)  # dim: (W×H)x3
-        N = V.size(0)
-        # build the correlation matrix
-        C = torch.matmul(V_T, V)  # dim: 3x3
+        s0 = SR[:, 0]  # dim: Bx(K-l)xl
+        s1 = SR[:, 1]  # dim: Bx(K-l)xl
+        p = s0 - ((torch.std(s0, dim=-1, keepdim=True) / torch.std(s1, dim=-1, keepdim=True)) * s1)  # 10
+        p = p - torch.mean(p, dim=-1, keepdim=True)  # 11
+        return p  # dim: Bx(K-l)xl
+
+    def __build_correlation_matrix(self, V):
+        # V dim: BxKxHxWx3
+        N = V.size(2) * V.size(3)
+        # build the correlation matrices of all frames
+        C = torch.einsum('bkhwi,bkhwj->bkij', V, V)  # dim: BxKx3x3
         C = C / N
 
         return C
@@ -81,23 +62,20 @@ class SSR(nn.Module):
         get eigenvalues and eigenvectors, sort them.
         Parameters
         ----------
-        C: torch.Tensor
-            The RGB values of skin-colored pixels.
+        C: torch.Tensor | dim: BxKx3x3
+            The correlation matrices of the skin-colored pixels.
         Returns
         -------
-        Λ: torch.Tensor
-            The eigenvalues of the correlation matrix
-        U: torch.Tensor
-            The (sorted) eigenvectors of the correlation matrix
+        Λ: torch.Tensor | dim: BxKx3
+            The eigenvalues of the correlation matrices
+        U: torch.Tensor | dim: BxKx3x3
+            The (sorted) eigenvectors of the correlation matrices
         """
-        # get eigenvectors and sort them according to eigenvalues (largest first)
-        L, U = torch.linalg.eigh(C)  # dim Λ: 3 | dim U: 3x3
-        idx = torch.argsort(L)  # dim: 3x1
-        idx = idx.flip(0)  # dim: 1x3
-        L_ = L[idx]  # dim: 3
-        U_ = U[:, idx]  # dim: 3x3
-
-        return L_, U_
+        # eigh returns the eigenvalues in ascending order, sort them largest first.
+        # the batched float32 eigh rounds differently from one eigh per frame, the pulse agrees with the
+        # per frame loop to ~1e-5 relative (max abs error ~2e-4 for a pulse of magnitude ~15-20, see benchmark ssr)
+        L, U = torch.linalg.eigh(C)
+        return L.flip(-1), U.flip(-1)
 
     def forward(self, images, fps = 30):
         """
@@ -123,43 +101,27 @@ class SSR(nn.Module):
         raw_sig = torch.permute(raw_sig,(0,2,3,4,1))
         B, K, h, w, c = raw_sig.size()
         l = int(fps)
+        if K <= l:
+            return torch.zeros(B, K, dtype=raw_sig.dtype, device=raw_sig.device)
+
+        # keep the pixels that are non-zero in every channel
+        V = raw_sig.float()
+        V_skin_only = V * torch.all(V != 0, dim=-1, keepdim=True)
+
+        C = self.__build_correlation_matrix(V_skin_only)  # dim: BxKx3x3
+
+        # get: eigenvalues Λ, eigenvectors U
+        L, U = self.__eigs(C)
+        L = L.permute(0, 2, 1)  # dim: Bx3xK
+        U = U.permute(0, 2, 3, 1)  # dim: Bx3x3xK
+
+        # build p of every window and overlap-add it to the pulse signal P, the last frame is never covered
+        p = self.__build_p(l, U, L)  # dim: Bx(K-l)xl
+        P = torch.nn.functional.fold(p.transpose(1, 2), output_size=(1, K - 1), kernel_size=(1, l))
+        P = torch.nn.functional.pad(P.view(B, K - 1), (0, 1)).to(raw_sig.dtype)  # 1 | dim: BxK
 
-        P = torch.zeros(B, K, dtype=raw_sig.dtype, device=raw_sig.device)  # 1 | dim: BxK
-        # store the eigenvalues Λ and the eigenvectors U at each frame
-        L = torch.zeros(B, 3, K, dtype=torch.float32, device=raw_sig.device)  # dim: Bx3xK
-        U = torch.zeros(B, 3, 3, K, dtype=torch.float32, device=raw_sig.device)  # dim: Bx3x3xK
-
-        for b in range(B):
-            for k in range(K):
-                n_roi = len(raw_sig[b, k])
-                VV = []
-                V = raw_sig[b, k].float()
-                idx = V != 0
-                idx2 = torch.logical_and(torch.logical_and(idx[:, :, 0], idx[:, :, 1]), idx[:, :, 2])
-                # V_skin_only = torch.masked_select(V,idx2)
-                idx2_expanded = idx2.unsqueeze(-1).expand(-1, -1, 3)
-                # unique_values = torch.unique(idx2_expanded) /
-                mask = torch.where(idx2_expanded != 0, torch.tensor(1), torch.tensor(0))
-                # V_skin_only = torch.masked_select(V, mask).view(h,w,c)
-                V_skin_only = V * mask
-                VV.append(V_skin_only)
-
-                VV = torch.vstack(VV)
-
-                C = self.__build_correlation_matrix(VV)  # dim: 3x3
-
-                # get: eigenvalues Λ, eigenvectors U
-                L[b, :, k], U[b, :, :, k] = self.__eigs(C)  # dim Λ: 3 | dim U: 3x3
-
-                # build p and add it to the pulse signal P
-                if k >= l:  # 5
-                    tau = k - l  # 5
-                    p = self.__build_p(tau, k, l, U[b], L[b])  # 6, 7, 8, 9, 10, 11 | dim: l
-                    P[b, tau:k] += p  # 11
-
-                if torch.isnan(torch.sum(P[b])):
-                    print('NAN')
-                    print(raw_sig[b, k])
+        if torch.isnan(torch.sum(P)):
+            print('NAN')
 
         # bvp = P.unsqueeze(2)
 
@@ -2,10 +2,6 @@ import torch
 import torch.nn as nn
 from rppg.nets.DeepPhys import AppearanceModel, MotionModel, LinearModel
 
-device = torch.device(
-    "cuda:0" if torch.cuda.is_available() else "cpu"
-)
-
 class TSM(nn.Module):
     def __init__(self, time_length=180, fold_div=3):
         super().__init__()
@@ -21,8 +17,11 @@ class TSM(nn.Module):
 
         out1, out2, out3 = torch.split(input, [fold, fold, last_fold], dim=2)
 
-        up_out1 = torch.cat((torch.zeros((B//self.time_length, 1, fold, H, W)).to(device), out1[:, 1:, :, :, :]), dim=1)
-        down_out2 = torch.cat((out2[:, :-1, :, :, :], torch.zeros((B//self.time_length, 1, fold, H, W)).to(device)), dim=1)
+        up_out1 = torch.cat((torch.zeros((B//self.time_length, 1, fold, H, W), device=input.device, dtype=input.dtype),
+                             out1[:, 1:, :, :, :]), dim=1)
+        down_out2 = torch.cat((out2[:, :-1, :, :, :],
+                               torch.zeros((B//self.time_length, 1, fold, H, W), device=input.device, dtype=input.dtype)),
+                              dim=1)
         bidirection_out = torch.cat((up_out1, down_out2, out3), dim=2).view(B, C, H, W)
 
         return bidirection_out
@@ -1,21 +1,28 @@
-import multiprocessing
 import os
 import dlib
 import csv
+import hashlib
 import json
 import h5py
 import scipy.io as sio
 
 import cv2
 import face_recognition
-import math
 import numpy as np
 import pandas as pd
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
 from scipy.interpolate import interp1d
+from rppg.log import log_warning
 from rppg.utils.funcs import detrend, BPF, get_hrv
+from rppg.utils.h5_storage import write_video
 from tqdm import tqdm
 from rppg.utils.data_path import *
 
+FACE_BOX_DIR = ".face_boxes"
+FACE_BOX_VERSION = 1
+
 
 def check_preprocessed_data(cfg):
     print("model: ", cfg.fit.model)
@@ -92,8 +99,7 @@ def preprocessing(cfg, dataset):
     :return:
     """
 
-    chunk_size = cfg.preprocess.common.process_num
-    manager = multiprocessing.Manager()
+    process_num = cfg.preprocess.common.process_num
 
     if cfg.preprocess.common.type.upper() == 'CONT':
         preprocess_type = 'CONT'
@@ -108,7 +114,6 @@ def preprocessing(cfg, dataset):
     if not os.path.isdir(cfg.data_root_path + dataset.name):
         # os.makedirs(dataset_root_path)
         raise ValueError("dataset path does not exist, check data_root_path in config.yaml")
-    return_dict = manager.dict()
 
     RawDataPathLoader = None
     if dataset.name == "V4V":
@@ -163,19 +168,18 @@ def preprocessing(cfg, dataset):
         ground_truth_name = RawDataPathLoader.ppg_name
 
     # multiprocessing
-    chunk_num = math.ceil(len(data_list) / chunk_size)
-    if chunk_num == 1:
-        chunk_size = len(data_list)
-    for i in range(chunk_num):
-        if i == chunk_num - 1:
-            chunk_data_list = data_list[i * chunk_size:]
-        else:
-            chunk_data_list = data_list[i * chunk_size:(i + 1) * chunk_size]
-
-        print("chunk_data_list : ", chunk_data_list)
-
-        chunk_preprocessing(preprocess_type, chunk_data_list, dataset_root_path, vid_name, ground_truth_name,
-                            dataset.name, cfg.dataset_path, img_size=img_size, large_box_coef=large_box_coef)
+    pool_preprocessing(preprocess_type, data_list, dataset_root_path, vid_name, ground_truth_name, dataset.name,
+                       cfg.dataset_path, img_size=img_size, large_box_coef=large_box_coef, process_num=process_num,
+                       memory_limit=cfg.preprocess.common.memory_limit,
+                       max_retries=cfg.preprocess.common.max_retries,
+                       stream_decode=cfg.preprocess.common.stream_decode,
+                       detect_interval=cfg.preprocess.common.detect_interval,
+                       detect_scale=cfg.preprocess.common.detect_scale,
+                       cache_boxes=cfg.preprocess.common.cache_boxes,
+                       storage=cfg.preprocess.common.storage,
+                       compression=cfg.preprocess.common.compression,
+                       chunk_length=cfg.fit.time_length if cfg.preprocess.common.chunk_by_time_length else 0,
+                       diff_chunk_length=cfg.preprocess.common.diff_chunk_length)
 
 
 def mkdir_p(directory):
@@ -204,13 +208,9 @@ def preprocess_Dataset(preprocess_type, dataset_root_path, data_path, vid_name,
     dataset_name = kwargs['dataset_name']
     img_size = kwargs['img_size']
 
+    video_path, label_path = get_data_path(dataset_root_path, data_path, vid_name, ground_truth_name, dataset_name)
     if dataset_name == "UBFC_Phys":
         data_path = data_path.split('/')
-        video_path = dataset_root_path + '/' + data_path[-2] + '/' + 'vid_' + data_path[-1] + vid_name
-        label_path = dataset_root_path + '/' + data_path[-2] + '/' + 'bvp_' + data_path[-1] + ground_truth_name
-    else:
-        video_path = dataset_root_path + data_path + vid_name
-        label_path = dataset_root_path + data_path + ground_truth_name
 
     raw_video, preprocessed_label, hrv = data_preprocess(preprocess_type, video_path, label_path, **kwargs)
     # raw_video, preprocessed_label, hrv = [1], 2, 3  # For Debug
@@ -240,43 +240,192 @@ def preprocess_Dataset(preprocess_type, dataset_root_path, data_path, vid_name,
         mkdir_p(dir_path)
 
     data = h5py.File(dir_path + data_path + ".hdf5", "w")
-    data.create_dataset('raw_video', data=raw_video)
+    write_video(data, raw_video, preprocess_type, storage=kwargs.get('storage', 'float32'),
+                chunk_length=kwargs.get('chunk_length', 0), compression=kwargs.get('compression', 'none'))
     data.create_dataset('preprocessed_label', data=preprocessed_label)
     data.create_dataset('hrv', data=hrv)
     data.close()
 
 
-def chunk_preprocessing(preprocess_type, data_list, dataset_root_path, vid_name, ground_truth_name, dataset_name,
-                        dataset_path, img_size, large_box_coef):
-    process = []
-    save_root_path = dataset_path
+def get_data_path(dataset_root_path, data_path, vid_name, ground_truth_name, dataset_name):
+    if dataset_name == "UBFC_Phys":
+        data_path = data_path.split('/')
+        video_path = dataset_root_path + '/' + data_path[-2] + '/' + 'vid_' + data_path[-1] + vid_name
+        label_path = dataset_root_path + '/' + data_path[-2] + '/' + 'bvp_' + data_path[-1] + ground_truth_name
+    else:
+        video_path = dataset_root_path + data_path + vid_name
+        label_path = dataset_root_path + data_path + ground_truth_name
+    return video_path, label_path
 
-    manager = multiprocessing.Manager()
-    return_dict = manager.dict()
 
-    for index, data_path in enumerate(data_list):
-        proc = multiprocessing.Process(target=preprocess_Dataset,
-                                       args=(preprocess_type, dataset_root_path, data_path, vid_name,
-                                             ground_truth_name, return_dict)
-                                       , kwargs={"save_root_path": save_root_path,
-                                                 "dataset_name": dataset_name,
-                                                 "img_size": img_size,
-                                                 "large_box_coef": large_box_coef})
+def estimate_job(preprocess_type, video_path, img_size, stream_decode=False):
+    """
+    :return: size of the raw video on disk and a rough peak memory of its preprocessing, in bytes
+    """
+    size, frame_total, frame_bytes = 0, 0, 0
+    held_frames = 2  # full resolution frames decoded at once: the current frame and its float copy
+    try:
+        if video_path.__contains__("png"):
+            path = video_path[:-4]
+            data = sorted(os.listdir(path))
+            size = sum(os.path.getsize(path + "/" + file) for file in data)
+            frame_total = len(data)
+            frame = cv2.imread(path + "/" + data[-1]) if data else None
+            frame_bytes = frame.nbytes if frame is not None else 0
+        elif video_path.__contains__(".mat"):
+            size = os.path.getsize(video_path)
+            # the whole float64 .mat video is loaded, its shape is read from the header only
+            for name, shape, _ in sio.whosmat(video_path):
+                if name == 'video':
+                    frame_total = shape[0]
+                    frame_bytes = int(np.prod(shape[1:])) * 8
+            held_frames = frame_total
+        else:
+            size = os.path.getsize(video_path)
+            cap = cv2.VideoCapture(video_path)
+            frame_total = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+            frame_bytes = int(cap.get(cv2.CAP_PROP_FRAME_WIDTH)) * int(cap.get(cv2.CAP_PROP_FRAME_HEIGHT)) * 3
+            cap.release()
+            if stream_decode:
+                # stream_crop_video holds up to 2 * lookahead decoded frames
+                held_frames = min(frame_total, 180)
+    except (OSError, ValueError, NotImplementedError):
+        pass
+
+    # cropped float32 face video (float64 for png frames) and one temporary of its size at write / normalization,
+    # DIFF adds the 6 channel float32 output of diff_normalize_video
+    video_bytes = frame_total * img_size * img_size * 3 * (8 if video_path.__contains__("png") else 4)
+    memory = video_bytes * 2 + held_frames * frame_bytes
+    if preprocess_type == 'DIFF':
+        memory += frame_total * img_size * img_size * 6 * 4
+    return size, memory
 
-        process.append(proc)
-        proc.start()
-    for proc in process:
-        proc.join()
 
-    manager.shutdown()
+def available_memory():
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_AVPHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return float('inf')
+
+
+def pool_preprocessing(preprocess_type, data_list, dataset_root_path, vid_name, ground_truth_name, dataset_name,
+                       dataset_path, img_size, large_box_coef, process_num, memory_limit=0, max_retries=2,
+                       **kwargs):
+    """
+    Preprocess the videos of data_list on a pool of process_num workers.
+
+    Videos are submitted longest first so the largest ones do not straggle at the end. A video is admitted only
+    while the estimated memory of the videos in flight fits in memory_limit (GB, 0: 70% of the available memory),
+    a smaller pending video may take a free worker instead. Failed videos are resubmitted up to max_retries times.
+    When a worker dies and breaks the pool, the videos in flight are rerun one at a time and only the video that
+    breaks the pool alone is charged a retry.
+    Remaining kwargs (stream_decode, detect_interval, detect_scale, cache_boxes, diff_chunk_length) are passed to
+    data_preprocess, storage, compression and chunk_length to write_video.
+    """
+    kwargs.update({"save_root_path": dataset_path,
+                   "dataset_name": dataset_name,
+                   "img_size": img_size,
+                   "large_box_coef": large_box_coef})
+    process_num = max(1, min(process_num, os.cpu_count() or 1))
+    budget = memory_limit * 1024 ** 3 if memory_limit else available_memory() * 0.7
+
+    pending = []  # [size, memory, data_path]
+    for data_path in data_list:
+        video_path, _ = get_data_path(dataset_root_path, data_path, vid_name, ground_truth_name, dataset_name)
+        pending.append([*estimate_job(preprocess_type, video_path, img_size, kwargs.get('stream_decode', False)),
+                        data_path])
+    pending.sort(key=lambda job: job[0], reverse=True)
+
+    attempts = {}
+    failed = []
+    running = {}
+    suspects = set()  # videos lost with a broken pool, rerun alone until the one breaking it is found
+    in_flight = 0
+    executor = ProcessPoolExecutor(max_workers=process_num)
+    with tqdm(total=len(pending), position=0, leave=True, desc=dataset_name) as pbar:
+        while pending or running:
+            candidates = [job for job in pending if job[2] in suspects] if suspects else pending
+            for job in list(candidates):
+                if len(running) >= (1 if suspects else process_num):
+                    break
+                if running and in_flight + job[1] > budget:
+                    continue
+                pending.remove(job)
+                future = executor.submit(preprocess_Dataset, preprocess_type, dataset_root_path, job[2], vid_name,
+                                         ground_truth_name, None, **kwargs)
+                running[future] = job
+                in_flight += job[1]
+
+            alone = len(running) == 1
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            broken = False
+            lost = []
+            for future in done:
+                job = running.pop(future)
+                in_flight -= job[1]
+                try:
+                    future.result()
+                    suspects.discard(job[2])
+                    pbar.update(1)
+                    continue
+                except BrokenProcessPool as e:
+                    # a worker died (e.g. killed out of memory), every job in flight is lost with the pool.
+                    # only a job that ran alone is known to have broken it and is charged a retry
+                    broken = True
+                    error = e
+                    if not alone:
+                        lost.append(job)
+                        continue
+                except Exception as e:
+                    error = e
+
+                attempts[job[2]] = attempts.get(job[2], 0) + 1
+                if attempts[job[2]] <= max_retries:
+                    log_warning("retry {} ({}/{}): {!r}".format(job[2], attempts[job[2]], max_retries, error))
+                    pending.append(job)
+                else:
+                    log_warning("failed {}: {!r}".format(job[2], error))
+                    failed.append(job[2])
+                    suspects.discard(job[2])
+                    pbar.update(1)
+
+            if broken:
+                executor.shutdown(wait=False)
+                lost.extend(running.values())
+                running.clear()
+                in_flight = 0
+                if lost:
+                    log_warning("process pool broke, {} videos are rerun one at a time".format(len(lost)))
+                suspects.update(job[2] for job in lost)
+                pending.extend(lost)
+                executor = ProcessPoolExecutor(max_workers=process_num)
+            pending.sort(key=lambda job: job[0], reverse=True)
+    executor.shutdown()
+
+    if failed:
+        log_warning("{} videos could not be preprocessed: {}".format(len(failed), failed))
+    return failed
 
 
 def data_preprocess(preprocess_type, video_path, label_path, **kwargs):
     img_size = kwargs['img_size']
     large_box_coef = kwargs['large_box_coef']
+    stream_decode = kwargs.get('stream_decode', False)
+    detect_interval = kwargs.get('detect_interval', 1)
+    detect_scale = kwargs.get('detect_scale', 1.)
     # detection_model = 'cnn' if dlib.DLIB_USE_CUDA else 'hog'
     detection_model = 'hog'
-    xy_points = pd.DataFrame(columns=['bottom', 'right', 'top', 'left'])
+    detect_kwargs = {'detection_model': detection_model, 'interval': detect_interval, 'scale': detect_scale,
+                     'cache_dir': None}
+    if kwargs.get('cache_boxes', False):
+        detect_kwargs['cache_dir'] = os.path.join(kwargs['save_root_path'], kwargs['dataset_name'], FACE_BOX_DIR)
 
     # for PURE dataset
     if video_path.__contains__("png"):
@@ -286,13 +435,8 @@ def data_preprocess(preprocess_type, video_path, label_path, **kwargs):
         raw_label = get_label(label_path, frame_total)
         hrv = get_hrv_label(raw_label, fs=30.)
 
-        for i in tqdm(range(frame_total), position=0, leave=True, desc=path):
-            frame = cv2.imread(path + "/" + data[i])
-            face_locations = face_recognition.face_locations(frame, 1, model=detection_model)
-            if len(face_locations) >= 1:
-                xy_points.loc[i] = face_locations[0]
-            else:
-                xy_points.loc[i] = (np.NaN, np.NaN, np.NaN, np.NaN)
+        xy_points = cached_detect_boxes(path, (cv2.imread(path + "/" + file) for file in data), frame_total,
+                                        **detect_kwargs)
 
         valid_fr_idx = xy_points[xy_points['top'].notnull()].index.tolist()
         front_idx = valid_fr_idx[0]
@@ -325,13 +469,8 @@ def data_preprocess(preprocess_type, video_path, label_path, **kwargs):
         frame_total = len(frames)
         hrv = get_hrv_label(raw_label, fs=30.)
 
-        for i in tqdm(range(frame_total), position=0, leave=True, desc=video_path):
-            frame = frames[i]
-            face_locations = face_recognition.face_locations((frame * 255.).astype(np.uint8), 1, model=detection_model)
-            if len(face_locations) >= 1:
-                xy_points.loc[i] = face_locations[0]
-            else:
-                xy_points.loc[i] = (np.NaN, np.NaN, np.NaN, np.NaN)
+        xy_points = cached_detect_boxes(video_path, ((frame * 255.).astype(np.uint8) for frame in frames), frame_total,
+                                        **detect_kwargs)
 
         valid_fr_idx = xy_points[xy_points['top'].notnull()].index.tolist()
         front_idx = valid_fr_idx[0]
@@ -354,6 +493,27 @@ def data_preprocess(preprocess_type, video_path, label_path, **kwargs):
                 raw_video[frame_num] = face
             else:
                 raw_video[frame_num] = cv2.resize(face, (img_size, img_size), interpolation=cv2.INTER_AREA)
+    # for UBFC, VIPL-HR dataset, decoded once
+    elif stream_decode:
+        cap = cv2.VideoCapture(video_path)
+        frame_total = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+        fps = cap.get(cv2.CAP_PROP_FPS)
+        cap.release()
+        raw_label = get_label(label_path, frame_total)
+        hrv = get_hrv_label(raw_label, fs=fps)
+
+        cache_file, key, boxes = None, None, None
+        if detect_kwargs['cache_dir'] is not None:
+            cache_file, key = face_box_cache(detect_kwargs['cache_dir'], video_path, detection_model,
+                                             detect_interval, detect_scale)
+            boxes = load_face_boxes(cache_file, key)
+        raw_video, front_idx, rear_idx, detected = stream_crop_video(video_path, img_size, large_box_coef,
+                                                                     detection_model, detect_interval=detect_interval,
+                                                                     detect_scale=detect_scale, boxes=boxes)
+        if cache_file is not None and boxes is None:
+            save_face_boxes(cache_file, key, detected)
+        raw_label = raw_label[front_idx:rear_idx + 1]
+        hrv = hrv[front_idx:rear_idx + 1]
     # for UBFC, VIPL-HR dataset
     else:
         cap = cv2.VideoCapture(video_path)
@@ -362,16 +522,7 @@ def data_preprocess(preprocess_type, video_path, label_path, **kwargs):
         raw_label = get_label(label_path, frame_total)
         hrv = get_hrv_label(raw_label, fs=fps)
 
-        for i in tqdm(range(frame_total), position=0, leave=True, desc=video_path):
-            ret, frame = cap.read()
-            if ret:
-                face_locations = face_recognition.face_locations(frame, 1, model=detection_model)
-                if len(face_locations) >= 1:
-                    xy_points.loc[i] = face_locations[0]
-                else:
-                    xy_points.loc[i] = (np.NaN, np.NaN, np.NaN, np.NaN)
-            else:
-                break
+        xy_points = cached_detect_boxes(video_path, read_frames(cap), frame_total, **detect_kwargs)
         cap.release()
 
         valid_fr_idx = xy_points[xy_points['top'].notnull()].index.tolist()
@@ -408,7 +559,7 @@ def data_preprocess(preprocess_type, video_path, label_path, **kwargs):
         cap.release()
     '''비디오 통째로 고칠거면 여기'''
     if preprocess_type == 'DIFF':
-        raw_video = diff_normalize_video(raw_video)
+        raw_video = diff_normalize_video(raw_video, kwargs.get('diff_chunk_length', 0))
         raw_label = diff_normalize_label(raw_label)
     elif preprocess_type == 'CUSTOM':
         pass
@@ -416,6 +567,196 @@ def data_preprocess(preprocess_type, video_path, label_path, **kwargs):
     return raw_video, raw_label, hrv
 
 
+def read_frames(cap):
+    while True:
+        ret, frame = cap.read()
+        if not ret:
+            break
+        yield frame
+
+
+def detect_face(frame, detection_model='hog', scale=1.):
+    """
+    :return: (top, right, bottom, left) of the first face in frame coordinates, None if no face is found
+    """
+    if scale != 1.:
+        frame = cv2.resize(frame, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    face_locations = face_recognition.face_locations(frame, 1, model=detection_model)
+    if len(face_locations) < 1:
+        return None
+    return tuple(position / scale for position in face_locations[0])
+
+
+def detect_boxes(frames, frame_total, detection_model='hog', interval=1, scale=1., desc=None):
+    """
+    Face box of every frame, searched every `interval` frames on frames downscaled by `scale`. The last frame and
+    every frame after a miss are searched as well, and get_CntYX_Width interpolates the boxes in between.
+
+    :return: DataFrame of (bottom, right, top, left) rows, NaN where no face was searched or found
+    """
+    boxes = np.full((frame_total, 4), np.nan)
+    missed = False
+    for i, frame in enumerate(tqdm(frames, total=frame_total, position=0, leave=True, desc=desc)):
+        if i >= frame_total:
+            break
+        if i % interval == 0 or missed or i == frame_total - 1:
+            box = detect_face(frame, detection_model, scale)
+            missed = box is None
+            if box is not None:
+                boxes[i] = box
+    return pd.DataFrame(boxes, columns=['bottom', 'right', 'top', 'left'])
+
+
+def face_box_cache(cache_dir, video_path, detection_model, interval, scale):
+    """
+    :return: cache file of the face boxes of a video (a .npz named by the hash of its path) and the key it must match
+    """
+    stat = os.stat(video_path)
+    video_path = os.path.abspath(video_path)
+    key = {'version': FACE_BOX_VERSION, 'video_path': video_path, 'size': stat.st_size, 'mtime': stat.st_mtime,
+           'detection_model': detection_model, 'interval': interval, 'scale': float(scale)}
+    cache_file = os.path.join(cache_dir, hashlib.sha1(video_path.encode()).hexdigest() + ".npz")
+    return cache_file, key
+
+
+def load_face_boxes(cache_file, key):
+    """
+    :return: cached (frames, 4) face boxes, None if there is no cache or the video or detector settings changed
+    """
+    if not os.path.isfile(cache_file):
+        return None
+    try:
+        with np.load(cache_file) as cache:
+            if all(cache[name].item() == value for name, value in key.items()):
+                return cache['boxes']
+    except (OSError, KeyError, ValueError):
+        log_warning("broken face box cache, detecting again : " + cache_file)
+    return None
+
+
+def save_face_boxes(cache_file, key, boxes):
+    mkdir_p(os.path.dirname(cache_file))
+    tmp_file = cache_file + ".tmp"
+    try:
+        with open(tmp_file, 'wb') as f:
+            np.savez(f, boxes=boxes, **key)
+        os.replace(tmp_file, cache_file)
+    except OSError:
+        log_warning("could not write face box cache : " + cache_file)
+
+
+def cached_detect_boxes(video_path, frames, frame_total, detection_model='hog', interval=1, scale=1., cache_dir=None):
+    """
+    detect_boxes of a video, reused from cache_dir while the video (size, mtime) and the detector settings are
+    unchanged. Crop, resize and normalization do not depend on them, so they can change without detecting again.
+    """
+    if cache_dir is None:
+        return detect_boxes(frames, frame_total, detection_model, interval, scale, desc=video_path)
+
+    cache_file, key = face_box_cache(cache_dir, video_path, detection_model, interval, scale)
+    boxes = load_face_boxes(cache_file, key)
+    if boxes is None or len(boxes) != frame_total:
+        xy_points = detect_boxes(frames, frame_total, detection_model, interval, scale, desc=video_path)
+        save_face_boxes(cache_file, key, xy_points.values)
+        return xy_points
+    return pd.DataFrame(boxes, columns=['bottom', 'right', 'top', 'left'])
+
+
+def stream_crop_video(video_path, img_size, large_box_coef, detection_model='hog', lookahead=90, alpha=0.1,
+                      detect_interval=1, detect_scale=1., boxes=None):
+    """
+    Single pass equivalent of the detection and crop passes of data_preprocess for video files.
+
+    Each frame is decoded once. Frames after the last detection wait in a ring buffer of at most `lookahead` frames
+    until the next detection interpolates their box (a longer gap holds the last box), and the box centers are
+    smoothed with the same EWM as get_CntYX_Width, which is causal. The crop size is the median face height of
+    the first `lookahead` frames instead of the whole video, so at most 2 * lookahead full frames are held.
+    Faces are searched as in detect_boxes, frames that are not searched are interpolated like missed ones.
+    Given the (frames, 4) boxes of a previous run, no face is searched.
+
+    :return: cropped float32 video (T, img_size, img_size, 3), index of the first and the last frame with a face,
+             (frames, 4) detected boxes
+    """
+    gap = deque()  # (frame_num, frame) since the last detection
+    warm_up = []  # (frame, cnt_y, cnt_x) until the crop size is known
+    heights = []
+    faces = []
+    ewm = np.zeros(3)  # weighted sums of cnt_y, cnt_x and of the weights
+    bbox = {}
+
+    def crop(frame, cnt_y, cnt_x):
+        ewm[:] = np.array([cnt_y, cnt_x, 1.]) + (1 - alpha) * ewm
+        y, x = np.round(ewm[:2] / ewm[2]).astype(int)
+        half_size = bbox['half_size']
+        face = np.take(frame, range(y - half_size, y + half_size), 0, mode='clip')
+        face = np.take(face, range(x - half_size, x + half_size), 1, mode='clip')
+        face = (cv2.cvtColor(face, cv2.COLOR_BGR2RGB) / 255.).astype(np.float32)
+        if img_size != half_size * 2:
+            face = cv2.resize(face, (img_size, img_size), interpolation=cv2.INTER_AREA)
+        faces.append(face)
+
+    def fix_size():
+        bbox['half_size'] = int(np.round(np.median(heights) * (large_box_coef / 2)))
+        for box in warm_up:
+            crop(*box)
+        warm_up.clear()
+
+    def emit(frame, cnt_y, cnt_x):
+        if 'half_size' in bbox:
+            crop(frame, cnt_y, cnt_x)
+        else:
+            warm_up.append((frame, cnt_y, cnt_x))
+            if len(warm_up) >= lookahead:
+                fix_size()
+
+    last = None  # (frame_num, cnt_y, cnt_x) of the last detection
+    front_idx = rear_idx = None
+    missed = False
+    cap = cv2.VideoCapture(video_path)
+    frame_total = int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+    detected = np.full((frame_total, 4), np.nan)
+    for frame_num in tqdm(range(frame_total), position=0, leave=True, desc=video_path):
+        ret, frame = cap.read()
+        if not ret:
+            break
+        box = None
+        if boxes is not None:
+            if frame_num < len(boxes) and not np.isnan(boxes[frame_num][0]):
+                box = boxes[frame_num]
+        elif frame_num % detect_interval == 0 or missed or frame_num == frame_total - 1:
+            box = detect_face(frame, detection_model, detect_scale)
+            missed = box is None
+        if box is not None:
+            detected[frame_num] = box
+            top, right, bottom, left = box
+            y_range_ext = (bottom - top) * 0.2  # for forehead
+            cnt_y, cnt_x = (bottom + top - y_range_ext) / 2, (right + left) / 2
+            heights.append(bottom - top + y_range_ext)
+            if last is not None:
+                # linear interpolation of the boxes since the last detection
+                for gap_num, gap_frame in gap:
+                    ratio = (gap_num - last[0]) / (frame_num - last[0])
+                    emit(gap_frame, last[1] + (cnt_y - last[1]) * ratio, last[2] + (cnt_x - last[2]) * ratio)
+                gap.clear()
+            emit(frame, cnt_y, cnt_x)
+            last = (frame_num, cnt_y, cnt_x)
+            front_idx = frame_num if front_idx is None else front_idx
+            rear_idx = frame_num
+        elif last is not None:
+            if len(gap) == lookahead:
+                gap_num, gap_frame = gap.popleft()
+                emit(gap_frame, last[1], last[2])
+            gap.append((frame_num, frame))
+    cap.release()
+
+    if front_idx is None:
+        raise ValueError("no face detected in {}".format(video_path))
+    if warm_up:
+        fix_size()
+    # frames after the last detection are dropped
+    return np.asarray(faces[:rear_idx - front_idx + 1], dtype=np.float32), front_idx, rear_idx, detected
+
+
 def get_label(label_path, frame_total):
     # Load input
     if label_path.__contains__("hdf5"):
@@ -533,19 +874,31 @@ def diff_normalize_label(label):
     return delta_label
 
 
-def diff_normalize_video(video_data):
+def diff_normalize_video(video_data, chunk_length=0):
+    """
+    [:, :, :, :3] : motion difference normalized by its std, the last frame is zero padding
+    [:, :, :, 3:] : mean subtracted frames
+
+    Written in place into one preallocated float32 array. chunk_length > 0 computes the difference, the mean
+    subtraction and the NaN masking chunk_length frames at a time so their temporaries stay small on long videos;
+    the result is the same as chunk_length = 0.
+    """
     frame_total, h, w, c = video_data.shape
 
-    raw_video = np.empty((frame_total - 1, h, w, 6), dtype=np.float32)
-    padd = np.zeros((1, h, w, 6), dtype=np.float32)
-    for frame_num in range(frame_total - 1):
-        raw_video[frame_num, :, :, :3] = generate_MotionDifference(video_data[frame_num], video_data[frame_num + 1])
-    raw_video[:, :, :, :3] = raw_video[:, :, :, :3] / np.std(raw_video[:, :, :, :3])
-    raw_video = np.append(raw_video, padd, axis=0)
-    video_data = video_data - np.mean(video_data)
-    raw_video[:, :, :, 3:] = video_data / np.std(video_data)
-    raw_video[:, :, :, 3:] = video_data
-    raw_video[np.isnan(raw_video)] = 0
+    raw_video = np.empty((frame_total, h, w, 6), dtype=np.float32)
+    raw_video[-1] = 0
+    motion = raw_video[:-1, :, :, :3]
+    step = chunk_length if chunk_length > 0 else frame_total
+    for start in range(0, frame_total - 1, step):
+        end = min(start + step, frame_total - 1)
+        prev_frame, crop_frame = video_data[start:end], video_data[start + 1:end + 1]
+        np.divide(crop_frame - prev_frame, crop_frame + prev_frame + 0.000000001, out=motion[start:end])
+    motion /= np.std(motion)
+    video_mean = np.mean(video_data)
+    for start in range(0, frame_total, step):
+        chunk = raw_video[start:start + step]
+        np.subtract(video_data[start:start + step], video_mean, out=chunk[:, :, :, 3:])
+        chunk[np.isnan(chunk)] = 0
     return raw_video
 
 
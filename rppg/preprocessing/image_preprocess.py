@@ -30,23 +30,29 @@ def DIFF_preprocess_Video(path, video_data, **kwargs):
     '''
     :param path: dataset path
     :param flag: face detect flag
+    :param chunk_length: frames computed at a time, 0: whole video
     :return: [:,:,:0-2] : motion diff frame
              [:,:,:,3-5] : normalized frame
     '''
     frame_total, h, w, c = video_data.shape
+    step = kwargs.get('chunk_length', 0) or frame_total
 
-    raw_video = np.empty((frame_total - 1, h, w, 6))
-    padd = np.zeros((1, h, w, 6), dtype=np.float32)
+    raw_video = np.empty((frame_total, h, w, 6))
+    raw_video[-1] = 0
+    motion = raw_video[:-1, :, :, :3]
     with tqdm(total=frame_total, position=0, leave=True, desc=path) as pbar:
-        for frame_num in range(frame_total - 1):
-            # raw_video[frame_num, :, :, :3], raw_video[frame_num, :, :, -3:] = preprocess_Image(video_data[frame_num],video_data[frame_num + 1])
-            raw_video[frame_num, :, :, :3] = generate_MotionDifference(video_data[frame_num], video_data[frame_num + 1])
-            pbar.update(1)
-        raw_video[:, :, :, :3] = raw_video[:, :, :, :3] / np.std(raw_video[:, :, :, :3])
-        raw_video = np.append(raw_video, padd, axis=0)
+        for start in range(0, frame_total - 1, step):
+            end = min(start + step, frame_total - 1)
+            prev_frame, crop_frame = video_data[start:end], video_data[start + 1:end + 1]
+            np.divide(crop_frame - prev_frame, crop_frame + prev_frame + 0.000000001, out=motion[start:end])
+            pbar.update(end - start)
+        motion /= np.std(motion)
         video_data = video_data - np.mean(video_data)
-        raw_video[:, :, :, 3:] = video_data / np.std(video_data)
-        raw_video[np.isnan(raw_video)] = 0
+        video_std = np.std(video_data)
+        for start in range(0, frame_total, step):
+            chunk = raw_video[start:start + step]
+            np.divide(video_data[start:start + step], video_std, out=chunk[:, :, :, 3:])
+            chunk[np.isnan(chunk)] = 0
     return raw_video
 
 
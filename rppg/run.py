@@ -2,7 +2,7 @@ import math
 import torch
 import wandb
 from tqdm import tqdm
-from rppg.utils.funcs import (get_hr, MAE, RMSE, MAPE, corr,SD, IrrelevantPowerRatio, normalize_torch)
+from rppg.utils.funcs import (get_hr, get_device, MAE, RMSE, MAPE, corr,SD, IrrelevantPowerRatio, normalize_torch)
 
 import numpy as np
 import os
@@ -35,33 +35,33 @@ def run(model, sweep, optimizer, lr_sch, criterion, cfg, dataloaders):
                 if cfg.fit.eval_flag and (eval_flag or (epoch + 1) % cfg.fit.eval_interval == 0):
                     test_fn(epoch, model, dataloaders[2], vital_type=cfg.fit.test.vital_type,
                             cal_type=cfg.fit.test.cal_type, bpf=cfg.fit.test.bpf, metrics=cfg.fit.test.metric,
-                            eval_time_length=et, wandb_flag=cfg.wandb.flag)
+                            eval_time_length=et, wandb_flag=cfg.wandb.flag, device=cfg.fit.device)
                 eval_flag = False
         if not sweep:
             test_result = test_fn(0, model, dataloaders[2], vital_type=cfg.fit.test.vital_type,
                                   cal_type=cfg.fit.test.cal_type, bpf=cfg.fit.test.bpf,
                                   metrics=cfg.fit.test.metric, eval_time_length=cfg.fit.test.eval_time_length,
-                                  wandb_flag=cfg.wandb.flag)
+                                  wandb_flag=cfg.wandb.flag, device=cfg.fit.device)
         else:
             for et in cfg.fit.test.eval_time_length:
                 test_result.append(test_fn(0, model, dataloaders[2], vital_type=cfg.fit.test.vital_type,
                                            cal_type=cfg.fit.test.cal_type, bpf=cfg.fit.test.bpf,
                                            metrics=cfg.fit.test.metric, eval_time_length=et,
-                                           wandb_flag=cfg.wandb.flag))
+                                           wandb_flag=cfg.wandb.flag, device=cfg.fit.device))
     else:
         # model = torch.load()
         if not sweep:
             test_result.append(test_fn(0, model, dataloaders[0], vital_type=cfg.fit.test.vital_type,
                                        cal_type=cfg.fit.test.cal_type, bpf=cfg.fit.test.bpf,
                                        metrics=cfg.fit.test.metric, eval_time_length=cfg.fit.test.eval_time_length,
-                                       wandb_flag=cfg.wandb.flag))
+                                       wandb_flag=cfg.wandb.flag, device=cfg.fit.device))
         else:
             for et in cfg.fit.test.eval_time_length:
                 print("=========="+str(et)+"s==========")
                 test_result.append(test_fn(0, model, dataloaders[0], vital_type=cfg.fit.test.vital_type,
                                            cal_type=cfg.fit.test.cal_type, bpf=cfg.fit.test.bpf,
                                            metrics=cfg.fit.test.metric, eval_time_length=et,
-                                           wandb_flag=cfg.wandb.flag))
+                                           wandb_flag=cfg.wandb.flag, device=cfg.fit.device))
 
     return test_result
 
@@ -140,7 +140,8 @@ def val_fn(epoch, model, criterion, dataloaders, wandb_flag: bool = True):
         return running_loss / tepoch.__len__()
 
 
-def test_fn(epoch, model, dataloaders, vital_type, cal_type, bpf, metrics, eval_time_length=10, wandb_flag: bool = False):
+def test_fn(epoch, model, dataloaders, vital_type, cal_type, bpf, metrics, eval_time_length=10, wandb_flag: bool = False,
+            device='cuda'):
     # To evaluate a model by subject, you can use the meta option
     step = "Test"
     model_name = model.__module__.split('.')[-1]
@@ -155,32 +156,39 @@ def test_fn(epoch, model, dataloaders, vital_type, cal_type, bpf, metrics, eval_
     fs = 30
 
     interval = fs * eval_time_length
-    empty_tensor = torch.empty(1).to('cuda')
-    empty_tensor2 = torch.empty(1).to('cuda')
+    device = get_device(device)
+    # samples not yet evaluated, HR is computed per window as soon as a sample after the window arrives
+    pred_buffer, target_buffer = [], []
+    buffered = 0
+    hr_preds, hr_targets = [], []
     with tqdm(dataloaders, desc=step, total=len(dataloaders), disable=False) as tepoch:
-        _pred = []
-        _target = []
         with torch.no_grad():
             for te in tepoch:
-                torch.cuda.empty_cache()
                 if model_name == 'PhysFormer':
                     inputs, target, _ = te
                 else:
                     inputs, target = te
                 outputs = model(inputs)
-                if model_type == 'DIFF':
-                    empty_tensor = torch.cat((empty_tensor, outputs.squeeze()), dim=-1)
-                    empty_tensor2 = torch.cat((empty_tensor2, target.squeeze()), dim=-1)
-                else:
-                    if outputs.get_device() != empty_tensor.get_device():  # for non-DNN Methods
-                        outputs = outputs.to('cuda')
-                    empty_tensor = torch.cat((empty_tensor, outputs.view(-1).squeeze()), dim=-1)
-                    empty_tensor2 = torch.cat((empty_tensor2, target.view(-1).squeeze()), dim=-1)
-    pred_chunks = torch.stack(list(torch.split(empty_tensor[1:].detach(), interval))[:-1], dim=0)
-    target_chunks = torch.stack(list(torch.split(empty_tensor2[1:].detach(), interval))[:-1], dim=0)
-
-    hr_pred, hr_target = get_hr(pred_chunks, target_chunks, model_type=model_type, vital_type=vital_type,
-                                cal_type=cal_type, fs=fs, bpf=bpf)
+                # non-DNN methods may return their outputs on another device
+                pred_buffer.append(outputs.detach().reshape(-1).to(device))
+                target_buffer.append(target.detach().reshape(-1).to(device))
+                buffered += len(pred_buffer[-1])
+
+                if buffered > interval:
+                    window_num = (buffered - 1) // interval  # the trailing window is never evaluated
+                    pred = torch.cat(pred_buffer)
+                    target = torch.cat(target_buffer)
+                    hr_pred, hr_target = get_hr(pred[:window_num * interval].view(window_num, interval),
+                                                target[:window_num * interval].view(window_num, interval),
+                                                model_type=model_type, vital_type=vital_type,
+                                                cal_type=cal_type, fs=fs, bpf=bpf)
+                    hr_preds.append(hr_pred)
+                    hr_targets.append(hr_target)
+                    pred_buffer, target_buffer = [pred[window_num * interval:]], [target[window_num * interval:]]
+                    buffered -= window_num * interval
+
+    hr_pred = cat_padded(hr_preds)
+    hr_target = cat_padded(hr_targets)
 
     hr_pred = np.asarray(hr_pred.detach().cpu())
     hr_target = np.asarray(hr_target.detach().cpu())
@@ -201,6 +209,13 @@ def test_fn(epoch, model, dataloaders, vital_type, cal_type, bpf, metrics, eval_
     return test_result
 
 
+def cat_padded(results, value=-1.):
+    # concatenate per window results, (n, width) HRV lists are padded with `value` to the widest one
+    width = max(result.shape[-1] for result in results)
+    return torch.cat([torch.nn.functional.pad(result, (0, width - result.shape[-1]), value=value)
+                      if result.dim() > 1 else result for result in results])
+
+
 def find_lr(model, train_loader, optimizer, criterion, init_value=1e-8, final_value=10., beta=0.98):
     num = len(train_loader) - 1
     mult = (final_value / init_value) ** (1 / num)
@@ -1,18 +1,89 @@
+import functools
+
 import torch
 import numpy as np
 from scipy import signal
-from scipy.sparse import spdiags
+from scipy.linalg import cholesky_banded, cho_solve_banded, solve_triangular
+from scipy.sparse import spdiags, identity
 from rppg.utils.visualization import hrv_comparison_plot, hr_comparison_bpf
+from rppg.log import log_warning
 
 from matplotlib import pyplot as plt
 import neurokit2 as nk
 
 
+def get_device(device='cuda'):
+    """
+    Resolve the device given in the config, falling back to CPU when CUDA is not available.
+
+    :param device: device name, e.g. 'cuda', 'cuda:1' or 'cpu'
+    :return: torch.device
+    """
+    device = torch.device(device)
+    if device.type == 'cuda' and not torch.cuda.is_available():
+        log_warning("CUDA is not available, running on cpu")
+        device = torch.device('cpu')
+    return device
+
+
+def detrend_bands(signal_length, Lambda):
+    """
+    Upper banded form of the pentadiagonal smoothing system (I + Lambda^2 * D^T D) used by detrend,
+    as expected by scipy.linalg.cholesky_banded / solveh_banded.
+
+    :param signal_length: length of the signal
+    :param Lambda: smoothing parameter
+    :return: (3, signal_length) array, row 2 is the main diagonal
+    """
+    # second-order difference matrix
+    ones = np.ones(signal_length)
+    minus_twos = -2 * np.ones(signal_length)
+    diags_data = np.array([ones, minus_twos, ones])
+    diags_index = np.array([0, 1, 2])
+    D = spdiags(diags_data, diags_index, (signal_length - 2), signal_length)
+    A = identity(signal_length) + (Lambda ** 2) * (D.T @ D)
+
+    bands = np.zeros((3, signal_length))
+    bands[0, 2:] = A.diagonal(2)
+    bands[1, 1:] = A.diagonal(1)
+    bands[2, :] = A.diagonal(0)
+    return bands
+
+
+@functools.lru_cache(maxsize=32)
+def detrend_factor(signal_length, Lambda):
+    """
+    Banded Cholesky factor of the detrend smoothing system, memoized per (signal_length, Lambda) so repeated
+    evaluations (e.g. every eval_time_length of a sweep) reuse it. The factor lives on the host in float64,
+    so it is shared by every dtype/device of the signals.
+
+    :return: read-only (3, signal_length) upper banded factor
+    """
+    factor = cholesky_banded(detrend_bands(signal_length, Lambda))
+    factor.flags.writeable = False
+    return factor
+
+
+@functools.lru_cache(maxsize=32)
+def butter_coefficients(fs, low, high, order=6):
+    """
+    Memoized Butterworth band-pass coefficients.
+
+    :return: (b, a) read-only numpy arrays
+    """
+    b, a = signal.butter(order, [low / (0.5 * fs), high / (0.5 * fs)], btype='bandpass')
+    b.flags.writeable = False
+    a.flags.writeable = False
+    return b, a
+
+
 def detrend(signal, Lambda):
     """detrend(signal, Lambda) -> filtered_signal
     This function applies a detrending filter.
     This  is based on the following article "An advanced detrending method with application
     to HRV analysis". Tarvainen et al., IEEE Trans on Biomedical Engineering, 2002.
+    The smoothing system is pentadiagonal, so it is solved with a banded Cholesky factorization
+    in O(N) instead of inverting the dense N x N matrix.
     *Parameters*
       ``signal`` (1d numpy array):
         The signal where you want to remove the trend.
@@ -22,57 +93,146 @@ def detrend(signal, Lambda):
       ``filtered_signal`` (1d numpy array):
         The detrended signal.
     """
+    signal = np.asarray(signal, dtype=np.float64)
     signal_length = len(signal)
 
-    # observation matrix
-    H = np.identity(signal_length)
+    factor = detrend_factor(signal_length, Lambda)
+    filtered_signal = signal - cho_solve_banded((factor, False), signal)
+    return filtered_signal
 
-    # second-order difference matrix
 
-    ones = np.ones(signal_length)
-    minus_twos = -2 * np.ones(signal_length)
-    diags_data = np.array([ones, minus_twos, ones])
-    diags_index = np.array([0, 1, 2])
-    D = spdiags(diags_data, diags_index, (signal_length - 2), signal_length).toarray()
-    filtered_signal = np.dot((H - np.linalg.inv(H + (Lambda ** 2) * np.dot(D.T, D))), signal)
-    return filtered_signal
+@functools.lru_cache(maxsize=32)
+def detrend_blocks(signal_length, Lambda, device, block_size=64):
+    """
+    Blocked form of the lower banded Cholesky factor L of detrend_factor for detrend_torch, memoized on device:
+    the inverses of its block_size x block_size diagonal blocks and the 2 x 2 coupling of every block with the
+    last 2 rows of the previous one (L has 2 sub-diagonals). The length is padded to whole blocks with identity.
+
+    :return: (blocks, block_size, block_size) inverses, (blocks, 2, 2) couplings, float64 tensors
+    """
+    factor = detrend_factor(signal_length, Lambda)
+    blocks = -(-signal_length // block_size)
+    # L[i, i - k] = factor[2 - k, i]
+    diagonals = np.zeros((3, blocks * block_size))
+    diagonals[0] = 1.
+    diagonals[:, :signal_length] = factor[::-1]
+    inverses = np.empty((blocks, block_size, block_size))
+    couplings = np.zeros((blocks, 2, 2))
+    for k in range(blocks):
+        d0, d1, d2 = diagonals[:, k * block_size:(k + 1) * block_size]
+        diagonal_block = np.diag(d0) + np.diag(d1[1:], -1) + np.diag(d2[2:], -2)
+        inverses[k] = solve_triangular(diagonal_block, np.eye(block_size), lower=True)
+        if k > 0:
+            couplings[k] = [[d2[0], d1[0]], [0., d2[1]]]
+    return torch.from_numpy(inverses).to(device), torch.from_numpy(couplings).to(device)
 
 
 def detrend_torch(signals, Lambda=100):
     """
-    Detrend 1D signals with diagonal matrix D, using torch batch matrix multiplication
+    Detrend a batch of 1D signals on their device, differentiable w.r.t. signals.
+    The banded Cholesky system of detrend is solved for all signals at once, block by block in float64:
+    the forward and backward substitutions take one small batched matmul per block of 64 samples,
+    and the result is returned in the dtype of the input.
 
-    :param signals: Singals with linear trend
+    :param signals: Singals with linear trend, (test_n, length)
     :param Lambda:
     :return:
     """
     test_n, length = signals.shape
 
-    H = torch.eye(length)
-    ones = torch.ones(length - 2)
-
-    diag1 = torch.cat((torch.diag(ones), torch.zeros((length - 2, 2))), dim=-1)
-    diag2 = torch.cat((torch.zeros((length - 2, 1)), torch.diag(-2 * ones), torch.zeros((length - 2, 1))), dim=-1)
-    diag3 = torch.cat((torch.zeros((length - 2, 2)), torch.diag(ones)), dim=-1)
-    D = diag1 + diag2 + diag3
-
-    detrended_signal = torch.bmm(signals.unsqueeze(1),
-                                 (H - torch.linalg.inv(H + (Lambda ** 2) * torch.t(D) @ D)).to('cuda').expand(test_n,
-                                                                                                              -1,
-                                                                                                              -1)).squeeze()
+    inverses, couplings = detrend_blocks(length, Lambda, signals.device)
+    blocks, block_size = inverses.shape[:2]
+    rhs = torch.nn.functional.pad(signals.double(), (0, blocks * block_size - length)).view(test_n, blocks, block_size)
+
+    # L y = signals
+    y = []
+    tail = signals.new_zeros((test_n, 2), dtype=torch.float64)
+    for k in range(blocks):
+        b = torch.cat((rhs[:, k, :2] - tail @ couplings[k].T, rhs[:, k, 2:]), dim=1)
+        y.append(b @ inverses[k].T)
+        tail = y[k][:, -2:]
+    # L^T trend = y
+    trend = [None] * blocks
+    head = tail.new_zeros((test_n, 2))
+    for k in reversed(range(blocks)):
+        b = y[k]
+        if k + 1 < blocks:
+            b = torch.cat((b[:, :-2], b[:, -2:] - head @ couplings[k + 1]), dim=1)
+        trend[k] = b @ inverses[k]
+        head = trend[k][:, :2]
+
+    trend = torch.cat(trend, dim=1)[:, :length]
+    detrended_signal = signals - trend.to(signals.dtype)
     return detrended_signal
 
 
 def BPF(input_val, fs=30, low=0.75, high=2.5):
-    low = low / (0.5 * fs)
-    high = high / (0.5 * fs)
-    [b_pulse, a_pulse] = signal.butter(6, [low, high], btype='bandpass')
+    [b_pulse, a_pulse] = butter_coefficients(fs, low, high, 6)
     if type(input_val) == torch.Tensor:
         return signal.filtfilt(b_pulse, a_pulse, np.double(input_val.cpu().numpy()))
     else:
         return signal.filtfilt(b_pulse, a_pulse, np.double(input_val))
 
 
+@functools.lru_cache(maxsize=32)
+def filtfilt_responses(fs, low, high, order, length):
+    """
+    Responses of the Butterworth band-pass IIR over `length` samples, memoized for BPF_torch:
+    the impulse response and the response to the steady-state initial condition (scipy lfilter_zi).
+    An IIR filter is linear and time-invariant, so lfilter(b, a, x, zi=zi * x[0]) == conv(x, h)[:length] + x[0] * r.
+
+    :return: (h, r) read-only numpy arrays of shape (length,)
+    """
+    b, a = butter_coefficients(fs, low, high, order)
+    impulse = np.zeros(length)
+    impulse[0] = 1.
+    h = signal.lfilter(b, a, impulse)
+    r = signal.lfilter(b, a, np.zeros(length), zi=signal.lfilter_zi(b, a))[0]
+    h.flags.writeable = False
+    r.flags.writeable = False
+    return h, r
+
+
+def BPF_torch(input_val, fs=30, low=0.75, high=2.5, order=6):
+    """
+    Zero-phase band-pass filter of a batch of signals on their own device, equivalent to BPF
+    (scipy.signal.filtfilt with odd padding). Both passes are evaluated as FFT convolutions with the
+    cached impulse response, so all chunks are filtered at once without a numpy round trip.
+
+    :param input_val: (test_n, length) or (length,) tensor
+    :return: filtered tensor with the shape and dtype of the input
+    """
+    b, a = butter_coefficients(fs, low, high, order)
+    edge = 3 * max(len(a), len(b))
+    x = input_val.to(torch.float64)
+    squeeze = x.dim() == 1
+    if squeeze:
+        x = x.unsqueeze(0)
+    length = x.shape[-1]
+    if length <= edge:
+        raise ValueError("The length of the input vector must be greater than %d." % edge)
+
+    # odd extension, as scipy.signal.filtfilt(padtype='odd')
+    x = torch.cat((2 * x[:, :1] - torch.flip(x[:, 1:edge + 1], dims=[-1]),
+                   x,
+                   2 * x[:, -1:] - torch.flip(x[:, -edge - 1:-1], dims=[-1])), dim=-1)
+    ext_length = x.shape[-1]
+
+    h, r = filtfilt_responses(fs, low, high, order, ext_length)
+    n_fft = _nearest_power_of_2(2 * ext_length - 1)
+    h_f = torch.fft.rfft(torch.tensor(h, device=x.device), n=n_fft)
+    r = torch.tensor(r, device=x.device)
+
+    def lfilter(sig):
+        return torch.fft.irfft(torch.fft.rfft(sig, n=n_fft) * h_f, n=n_fft)[:, :ext_length] + sig[:, :1] * r
+
+    y = lfilter(x)
+    y = torch.flip(lfilter(torch.flip(y, dims=[-1])), dims=[-1])[:, edge:-edge]
+    if squeeze:
+        y = y.squeeze(0)
+    return y.to(input_val.dtype)
+
+
 def plot_graph(start_point, length, target, inference):
     plt.rcParams["figure.figsize"] = (14, 5)
     plt.plot(range(len(target[start_point:start_point + length])), target[start_point:start_point + length],
@@ -108,11 +268,12 @@ def get_hrv(ppg_signal, fs=30.):
 
 def calc_hr_torch(calc_type, ppg_signals, fs=30.):
     test_n, sig_length = ppg_signals.shape
-    hr_list = torch.empty(test_n)
+    device = ppg_signals.device
+    hr_list = torch.empty(test_n, device=device)
     if calc_type == "FFT":
         ppg_signals = ppg_signals - torch.mean(ppg_signals, dim=-1, keepdim=True)
         N = sig_length
-        k = torch.arange(N)
+        k = torch.arange(N, device=device)
         T = N / fs
         freq = k / T
         amplitude = torch.abs(torch.fft.rfft(ppg_signals, n=N, dim=-1)) / N
@@ -121,23 +282,28 @@ def calc_hr_torch(calc_type, ppg_signals, fs=30.):
 
         return hr_list
     else:  # calc_type == "Peak"
-        hrv_list = -torch.ones((test_n, sig_length // fs * 10))
-        index_list = -torch.ones((test_n, sig_length // fs * 10))
         width = 11  # odd / physnet(5), diff (11)
-        window_maxima = torch.nn.functional.max_pool1d(ppg_signals, width, 1, padding=width // 2, return_indices=True)[
-            1].squeeze()
-
-        for i in range(test_n):
-            candidate = window_maxima[i].unique()
-            nice_peaks = candidate[window_maxima[i][candidate] == candidate]
-            nice_peaks = nice_peaks[
-                ppg_signals[i][nice_peaks] > torch.mean(ppg_signals[i][nice_peaks] / 2)]  # peak thresholding
-            beat_interval = torch.diff(nice_peaks)  # sample
-            hrv = beat_interval / fs  # second
-            hr = torch.mean(60 / hrv)
-            hr_list[i] = hr
-            hrv_list[i, :len(hrv)] = hrv * 1000  # milli second
-            index_list[i, :len(nice_peaks)] = nice_peaks
+        max_len = int(sig_length // fs * 10)
+        position = torch.arange(sig_length, device=device)
+        window_maxima = torch.nn.functional.max_pool1d(ppg_signals.unsqueeze(1), width, 1, padding=width // 2,
+                                                       return_indices=True)[1].squeeze(1)
+
+        # a sample is a peak if it is the maximum of the window centered on it
+        peaks = window_maxima == position
+        peak_num = torch.sum(peaks, dim=-1, keepdim=True)
+        threshold = torch.sum(torch.where(peaks, ppg_signals / 2, 0.), dim=-1, keepdim=True) / peak_num
+        peaks = peaks & (ppg_signals > threshold)  # peak thresholding
+        peak_num = torch.sum(peaks, dim=-1, keepdim=True)
+
+        # pack the ragged peak positions of every chunk to the left, padded with sig_length
+        nice_peaks = torch.sort(torch.where(peaks, position, sig_length), dim=-1)[0]
+        beat_interval = torch.diff(nice_peaks, dim=-1)  # sample
+        valid = position[:-1] < peak_num - 1
+        hrv = beat_interval / fs  # second
+        hr_list = torch.sum(torch.where(valid, 60 / hrv, 0.), dim=-1) / torch.sum(valid, dim=-1)
+
+        hrv_list = torch.where(valid, hrv * 1000, -1.)[:, :max_len]  # milli second
+        index_list = torch.where(position < peak_num, nice_peaks, -1).float()[:, :max_len]
 
         hrv_list = hrv_list[:, :torch.max(torch.sum(hrv_list > 0, dim=-1))]
         index_list = index_list[:, :torch.max(torch.sum(index_list > 0, dim=-1))]
@@ -183,13 +349,12 @@ def get_hr(rppg, bvp, model_type, vital_type='HR', cal_type='FFT', fs=30, bpf=No
 
     if bpf != 'None':
         low, high = bpf
-        bvp = normalize_torch(BPF(bvp, fs, low, high))
-        rppg = normalize_torch(BPF(rppg, fs, low, high))
+        bvp = normalize_torch(BPF_torch(bvp, fs, low, high))
+        rppg = normalize_torch(BPF_torch(rppg, fs, low, high))
     else:
         bvp = normalize_torch(bvp)
         rppg = normalize_torch(rppg)
 
-    # TODO: torch bpf
     hr_pred = calc_hr_torch(cal_type, rppg, fs)
     hr_target = calc_hr_torch(cal_type, bvp, fs)
 
@@ -0,0 +1,88 @@
+import numpy as np
+
+from rppg.log import log_warning
+
+try:
+    # registers the lz4 / blosc filters of HDF5, needed to write and read files compressed with them
+    import hdf5plugin
+except ImportError:
+    hdf5plugin = None
+
+
+def compression_options(compression):
+    """
+    h5py create_dataset options for compression in {'none', 'gzip', 'lz4', 'blosc'}.
+    lz4 / blosc need hdf5plugin, gzip is used instead when it is not installed.
+    """
+    if compression in (None, 'none', False):
+        return {}
+    if compression in ('lz4', 'blosc'):
+        if hdf5plugin is not None:
+            if compression == 'lz4':
+                return dict(hdf5plugin.LZ4())
+            return dict(hdf5plugin.Blosc(cname='lz4', clevel=5, shuffle=hdf5plugin.Blosc.SHUFFLE))
+        log_warning("hdf5plugin is not installed, " + compression + " compression falls back to gzip")
+    return {'compression': 'gzip', 'compression_opts': 4, 'shuffle': True}
+
+
+def write_video(file, video, preprocess_type, storage='float32', chunk_length=0, compression='none'):
+    """
+    Write the preprocessed video as file['raw_video'].
+
+    storage 'float32' keeps the video as is. storage 'compact' stores CONT videos as uint8 with a per-video
+    scale / offset (video = stored * scale + offset) and DIFF videos as float16.
+    chunk_length > 0 chunks the dataset by that many frames (time_length) so a training window reads few chunks.
+    """
+    video = np.asarray(video)
+    attrs = {}
+    if storage == 'compact':
+        if preprocess_type == 'CONT':
+            low, high = float(np.min(video)), float(np.max(video))
+            scale = (high - low) / 255. if high > low else 1.
+            video = np.rint((video - np.float32(low)) / np.float32(scale)).astype(np.uint8)
+            attrs = {'scale': scale, 'offset': low}
+        else:
+            video = video.astype(np.float16)
+    elif storage != 'float32':
+        raise ValueError("storage must be float32 or compact, got " + str(storage))
+
+    options = compression_options(compression)
+    if chunk_length > 0 and len(video) > 0:
+        options['chunks'] = (min(chunk_length, len(video)),) + video.shape[1:]
+    dataset = file.create_dataset('raw_video', data=video, **options)
+    for key, value in attrs.items():
+        dataset.attrs[key] = value
+    return dataset
+
+
+class H5Video:
+    """
+    Read-side view of file['raw_video'] that decodes compact storage back to float32 on indexing.
+    Float32 files written before the storage option are returned unchanged.
+    """
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+        self.scale = dataset.attrs.get('scale')
+        self.offset = dataset.attrs.get('offset', 0.)
+
+    def __getitem__(self, key):
+        data = self.dataset[key]
+        if self.scale is not None:
+            data = data.astype(np.float32)
+            data *= np.float32(self.scale)
+            data += np.float32(self.offset)
+        elif data.dtype == np.float16:
+            data = data.astype(np.float32)
+        return data
+
+    def __len__(self):
+        return len(self.dataset)
+
+    @property
+    def shape(self):
+        return self.dataset.shape
+
+
+def read_video(file):
+    return H5Video(file['raw_video'])